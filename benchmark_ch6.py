@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+第六章离线基准：用 Ollama 替身服务测量客户端、Agent 循环、产品目录查询与 Markdown 格式化
+
+不需要 GPU 和真实模型：替身服务按脚本回放工具调用、结构不完整的 JSON 和需要本地修复的最终文案，
+并模拟预填充与逐块生成耗时。测到的是本项目代码本身（HTTP 往返、流式解析、JSON 修复、工具调度、
+目录索引）的开销，用来发现吞吐回退，不代表模型推理速度。
+
+场景：
+- client          OllamaClient.chat_completion 非流式往返
+- client_stream   OllamaClient.chat_completion_stream 逐块读取完整响应
+- agent           generate_rednote_with_private_model：工具调用 → 缺字段的草稿 → 本地修复后的最终文案
+- agent_stream    同上，stream=True（收到完整 JSON 即提前结束）
+- catalog_10k     enhanced_query_product_database，1 万 SKU：精确、模糊、品牌与未命中查询
+- catalog_100k    同上，10 万 SKU
+- format          format_rednote_for_markdown
+
+每个场景输出 p50 / p95（ms）与每秒请求数；--concurrency 大于 1 时 LLM 相关场景并发执行。
+--save 把结果写成 JSON；--baseline 与之前保存的结果对比，p95 变慢或吞吐下降超过 --tolerance 时退出码为 1。
+
+用法：python benchmark_ch6.py [--scenarios client agent catalog_10k] [--requests 200] [--concurrency 4]
+                              [--chat-latency 0.005] [--token-latency 0.0005]
+                              [--save bench.json] [--baseline bench.json --tolerance 0.2]
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import rednote_ch6_assignment as ch6
+from stub_ollama_server import ScriptedReply, StubOllamaServer
+
+MODEL = "deepseek-r1:8b"
+LLM_SCENARIOS = ("client", "client_stream", "agent", "agent_stream")
+LOCAL_SCENARIOS = ("catalog_10k", "catalog_100k", "format")
+SCENARIOS = LLM_SCENARIOS + LOCAL_SCENARIOS
+CATALOG_SIZES = {"catalog_10k": 10_000, "catalog_100k": 100_000}
+BRANDS = ["Apple", "Sony", "Bose", "华为", "小米", "漫步者", "JBL", "森海塞尔"]
+
+THINK = "<think>" + "用户需要一篇小红书文案，先查询产品信息，再组织卖点和语气。" * 8 + "</think>\n"
+SAMPLE_REDNOTE = {
+    "title": "🎧 通勤党的降噪神器，戴上世界瞬间安静！",
+    "body": "地铁、飞机、开放式办公室统统不怕🔥\n主动降噪 + 通透模式随心切换，续航一整天。" * 3,
+    "hashtags": ["#降噪耳机", "#通勤好物", "#数码测评", "#蓝牙耳机", "#好物分享"],
+    "emojis": ["🎧", "✨", "🔥", "💖", "🚇"],
+}
+# Agent 场景的脚本：工具调用 → 缺少 hashtags/emojis 的草稿（触发纠正重试）→ 单引号、尾随逗号、
+# 标签写成字符串的最终文案（由 repair_json / validate_rednote 在本地修复）
+AGENT_SCRIPT = [
+    {"content": THINK, "tool_calls": [
+        {"function": {"name": "query_product_database", "arguments": {"product_name": "AirPods Pro"}}},
+        {"function": {"name": "generate_emoji", "arguments": {"context": "降噪耳机 通勤"}}},
+    ]},
+    THINK + '```json\n{"title": "降噪耳机", "body": "草稿"}\n```',
+    THINK + "```json\n{'title': '" + SAMPLE_REDNOTE["title"] + "', 'body': '" + SAMPLE_REDNOTE["body"].replace("\n", "\\n")
+    + "', 'hashtags': '#降噪耳机 #通勤好物 #数码测评', 'emojis': ['🎧', '✨', '🔥'],}\n```",
+]
+
+
+def latency_summary(latencies, wall_seconds):
+    """latencies 与 wall_seconds 单位为秒；requests/sec 按墙钟时间计算，并发执行时反映总吞吐"""
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "p50_ms": round(1000 * statistics.median(ordered), 3),
+        "p95_ms": round(1000 * ordered[int(0.95 * (len(ordered) - 1))], 3),
+        "rps": round(len(ordered) / wall_seconds, 1) if wall_seconds else 0.0,
+    }
+
+
+def run_timed(operation, inputs, concurrency=1):
+    """逐个（或用线程池并发）执行 operation(input)，返回每次的耗时与总墙钟时间"""
+    def timed(item):
+        started = time.perf_counter()
+        operation(item)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    if concurrency <= 1:
+        latencies = [timed(item) for item in inputs]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, inputs))
+    return latencies, time.perf_counter() - started
+
+
+def synthetic_catalog(size):
+    """与 test_product_catalog_index 相同规则生成的合成目录"""
+    return ch6.ProductCatalog({
+        f"{BRANDS[i % len(BRANDS)]} 降噪耳机 X{i}": {
+            "brand": BRANDS[i % len(BRANDS)],
+            "price_range": f"{100 + i % 3000}-{300 + i % 3000}元",
+            "features": ["主动降噪", "蓝牙 5.3"],
+        }
+        for i in range(size)
+    })
+
+
+def catalog_queries(size, count):
+    """精确名称、带错别字的模糊查询、品牌与未命中查询各占四分之一"""
+    queries = []
+    for i in range(count):
+        sku = (i * 7919) % size
+        brand = BRANDS[sku % len(BRANDS)]
+        queries.append([f"{brand} 降噪耳机 X{sku}", f"{brand.lower()} 降噪 X{sku}", brand, f"不存在的产品 Z{i}"][i % 4])
+    return queries
+
+
+def build_scenario(name, args, client):
+    """返回 (operation, inputs, concurrency, 准备信息)"""
+    messages = ch6.build_rednote_messages("AirPods Pro", "科技酷炫")
+    if name == "client":
+        def operation(_):
+            assert "error" not in client.chat_completion(messages, tools=ch6.TOOLS_DEFINITION)
+        return operation, range(args.requests), args.concurrency, ""
+    if name == "client_stream":
+        def operation(_):
+            chunks = list(client.chat_completion_stream(messages, tools=ch6.TOOLS_DEFINITION))
+            assert chunks[-1].get("done") and "error" not in chunks[-1]
+        return operation, range(args.requests), args.concurrency, ""
+    if name in ("agent", "agent_stream"):
+        stream = name == "agent_stream"
+
+        def operation(i):
+            # 每次运行使用不同的产品名：替身服务的脚本按对话推进，并发运行互不干扰
+            result = ch6.generate_rednote_with_private_model(f"AirPods Pro {i}", max_iterations=4,
+                                                             stream=stream, use_cache=False)
+            assert "title" in json.loads(result), result
+        return operation, range(args.agent_runs), args.concurrency, ""
+    if name in CATALOG_SIZES:
+        size = CATALOG_SIZES[name]
+        started = time.perf_counter()
+        catalog = synthetic_catalog(size)
+        build_seconds = time.perf_counter() - started
+        ch6.product_catalog = catalog
+        return ch6.enhanced_query_product_database, catalog_queries(size, args.local_ops), 1, \
+            f"建索引 {build_seconds:.2f}s"
+    if name == "format":
+        note = json.dumps(SAMPLE_REDNOTE, ensure_ascii=False)
+        return lambda _: ch6.format_rednote_for_markdown(note), range(args.local_ops), 1, ""
+    raise ValueError(f"未知场景: {name}")
+
+
+def run_benchmarks(args):
+    """运行选定的场景，返回 {场景: {count, p50_ms, p95_ms, rps}}"""
+    logging.getLogger("rednote_ch6").setLevel(logging.ERROR)  # 重试与纠正提示属于脚本的一部分，不逐条输出
+    saved = {name: vars(ch6).get(name) for name in ("ollama_client", "product_catalog", "rednote_cache")}
+    ch6.rednote_cache = None
+    results = {}
+    with StubOllamaServer(chat_models=[MODEL], chat_latency=args.chat_latency, token_latency=args.token_latency,
+                          reply=ScriptedReply(AGENT_SCRIPT)) as stub:
+        client = ch6.OllamaClient(stub.base_url, pool_size=max(10, args.concurrency))
+        client.model_name = MODEL
+        ch6.ollama_client = client
+        try:
+            for name in args.scenarios:
+                operation, inputs, concurrency, note = build_scenario(name, args, client)
+                inputs = list(inputs)
+                operation(inputs[0])  # 预热：建立连接、填充索引缓存
+                latencies, wall = run_timed(operation, inputs, concurrency)
+                results[name] = latency_summary(latencies, wall)
+                if note:
+                    results[name]["note"] = note
+        finally:
+            client.close()
+            for name, value in saved.items():
+                if value is None:
+                    vars(ch6).pop(name, None)
+                else:
+                    setattr(ch6, name, value)
+            if saved["rednote_cache"] is None:
+                ch6.rednote_cache = None
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """返回回退的场景列表：p95 变慢或吞吐下降超过 tolerance（比例）"""
+    regressions = []
+    for name, row in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if row["p95_ms"] > base["p95_ms"] * (1 + tolerance) or row["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="第六章离线基准（Ollama 替身服务）")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="client 场景的请求数")
+    parser.add_argument("--agent-runs", type=int, default=40, help="agent 场景的文案生成次数")
+    parser.add_argument("--local-ops", type=int, default=2000, help="目录查询与格式化的调用次数")
+    parser.add_argument("--concurrency", type=int, default=1, help="LLM 相关场景的并发数")
+    parser.add_argument("--chat-latency", type=float, default=0.0, help="替身服务的预填充耗时（秒）")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="替身服务流式输出每块的耗时（秒）")
+    parser.add_argument("--save", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前 --save 的结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    results = run_benchmarks(args)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    print(f"📊 第六章离线基准（并发 {args.concurrency}，chat_latency={args.chat_latency}s，"
+          f"token_latency={args.token_latency}s）")
+    print(f"{'scenario':<15}{'count':>8}{'p50_ms':>12}{'p95_ms':>12}{'req/s':>12}")
+    for name, row in results.items():
+        line = f"{name:<15}{row['count']:>8}{row['p50_ms']:>12}{row['p95_ms']:>12}{row['rps']:>12}"
+        if name in baseline:
+            line += f"   基线 p95 {baseline[name]['p95_ms']} ms / {baseline[name]['rps']} req/s"
+        print(line + (f"   ({row['note']})" if "note" in row else ""))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存到 {args.save}")
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"❌ 性能回退（超过 {args.tolerance:.0%}）: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
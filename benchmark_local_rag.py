@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地与云端 RAG 链路的延迟对比
+
+- local：嵌入走本机 Ollama 的 /api/embed，生成走第六章的 OllamaClient（DeepSeek-R1）
+- cloud：嵌入走 OpenAI 兼容接口，生成走 api.deepseek.com
+
+两条链路各自把内置 FAQ 文档入库到临时 Milvus Lite collection，然后逐条回答同一组问题，
+输出 embed / retrieve / generate / total 各阶段的 p50、p95。cloud 链路需要设置
+OPENAI_API_KEY 与 DEEPSEEK_API_KEY，未设置时跳过；--stub 时 local 链路改连 Ollama 替身服务，
+只用来检查链路本身的开销（替身不做真实推理，结果不代表模型延迟）。
+
+用法：python benchmark_local_rag.py [--stub] [--paths local cloud] [--repeat 2]
+                                    [--ollama-url http://localhost:11434] [--chat-model deepseek-r1:8b]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from rag import (Answerer, DeepSeekLLM, EmbeddingCache, Ingestor, OllamaEmbeddingFunction, OllamaLLM,
+                 Retriever, create_embedding_function)
+from rag.cli import DEFAULT_BENCH_QUESTIONS
+
+DEFAULT_FILES = ["performance_faq.md", "operational_faq.md", "product_faq.md", "troubleshooting.md"]
+STAGES = ("embed", "retrieve", "generate", "total")
+
+
+def percentile_ms(values, fraction):
+    ordered = sorted(values)
+    return round(1000 * ordered[int(fraction * (len(ordered) - 1))], 1)
+
+
+def build_local(args):
+    from rednote_ch6_assignment import create_ollama_client
+
+    client = create_ollama_client(args.ollama_url, model_name=args.chat_model)
+    embedding = OllamaEmbeddingFunction(args.embed_model, client=client)
+    return embedding, OllamaLLM(args.chat_model, client=client)
+
+
+def build_cloud(args):
+    if not (os.environ.get("OPENAI_API_KEY") and os.environ.get("DEEPSEEK_API_KEY")):
+        return None
+    return create_embedding_function("openai"), DeepSeekLLM()
+
+
+def run_path(name, embedding, llm, milvus_client, tmp, questions, repeat):
+    collection = f"bench_{name}"
+    ingestor = Ingestor(milvus_client, collection, embedding,
+                        manifest_path=os.path.join(tmp, f"{name}_manifest.json"),
+                        cache=EmbeddingCache(os.path.join(tmp, f"{name}_cache.sqlite3")))
+    started = time.perf_counter()
+    ingestor.ingest(DEFAULT_FILES, recreate=True)
+    ingest_seconds = time.perf_counter() - started
+
+    # 每轮开始前清空查询向量缓存，测到的是真实的嵌入往返
+    retriever = Retriever(milvus_client, collection, embedding)
+    answerer = Answerer(retriever, llm)
+    answerer.answer(questions[0])  # 预热：加载模型、建立连接、建 BM25 索引
+
+    timings = {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+        retriever.query_cache.clear()
+        for question in questions:
+            result = answerer.answer(question)
+            for stage in STAGES:
+                timings[stage].append(result["timings"][stage])
+    milvus_client.drop_collection(collection)
+    return ingest_seconds, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地（Ollama）与云端（DeepSeek API）RAG 延迟对比")
+    parser.add_argument("--paths", nargs="+", choices=["local", "cloud"], default=["local", "cloud"])
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--ollama-url", help="默认取 OLLAMA_BASE_URL 或 http://localhost:11434")
+    parser.add_argument("--chat-model", default=os.environ.get("OLLAMA_MODEL", "deepseek-r1:8b"))
+    parser.add_argument("--embed-model", default="nomic-embed-text")
+    parser.add_argument("--stub", action="store_true", help="local 链路连接 Ollama 替身服务")
+    parser.add_argument("--stub-chat-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    from pymilvus import MilvusClient
+
+    stub = None
+    if args.stub and "local" in args.paths:
+        from stub_ollama_server import StubOllamaServer
+
+        stub = StubOllamaServer(chat_models=[args.chat_model], embed_models=[args.embed_model],
+                                dim=768, chat_latency=args.stub_chat_latency).start()
+        args.ollama_url = stub.base_url
+        print(f"⚠️  local 链路使用 Ollama 替身服务 {stub.base_url}，结果只反映链路开销")
+
+    builders = {"local": build_local, "cloud": build_cloud}
+    questions = list(DEFAULT_BENCH_QUESTIONS)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            milvus_client = MilvusClient(uri=os.path.join(tmp, "bench_local_rag.db"))
+            print(f"📊 {len(questions)} 个问题 × {args.repeat} 轮，单位 ms（p50 / p95）")
+            print(f"{'path':<7}{'ingest_s':>10}" + "".join(f"{stage:>18}" for stage in STAGES))
+            for name in args.paths:
+                components = builders[name](args)
+                if components is None:
+                    print(f"{name:<7}  跳过：未设置 OPENAI_API_KEY / DEEPSEEK_API_KEY")
+                    continue
+                ingest_seconds, timings = run_path(name, *components, milvus_client, tmp,
+                                                   questions, args.repeat)
+                cells = "".join(
+                    f"{percentile_ms(timings[stage], 0.5):>9}/{percentile_ms(timings[stage], 0.95):<8}"
+                    for stage in STAGES
+                )
+                print(f"{name:<7}{ingest_seconds:>10.2f}{cells}")
+                print(f"{'':<7}{'':>10}  mean total {1000 * statistics.mean(timings['total']):.1f} ms")
+            milvus_client.close()
+    finally:
+        if stub is not None:
+            stub.stop()
+
+
+if __name__ == "__main__":
+    main()
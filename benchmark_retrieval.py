@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量检索吞吐基准：比较 retrieve_batch 在不同 batch_size 下的每秒问题数
+
+把内置 FAQ 文档切块后写入临时 Milvus Lite collection，用 FAQ 标题生成问题集，
+分别以 batch_size = 1 / 32 / 256 调用 retrieve_batch。默认使用本地确定性嵌入，
+测得的是检索本身的开销；远程嵌入服务的往返延迟会进一步放大批量的收益。
+
+用法：python benchmark_retrieval.py [--questions 1024] [--batch-sizes 1 32 256] [--uri bench.db]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from rag import HashEmbeddingFunction, ensure_collection, ingest_chunks, iter_markdown_chunks
+from rag.retrieval import retrieve_batch
+
+DEFAULT_FILES = ["performance_faq.md", "operational_faq.md", "product_faq.md", "troubleshooting.md"]
+
+
+def build_questions(chunks, count):
+    headings = sorted({chunk["heading"] for chunk in chunks if chunk["heading"]})
+    return [f"{headings[i % len(headings)]} (variant {i // len(headings)})" for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="retrieve_batch 吞吐基准")
+    parser.add_argument("--uri", help="Milvus 地址，默认在临时目录创建 Milvus Lite 数据库")
+    parser.add_argument("--questions", type=int, default=1024)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 256])
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--dim", type=int, default=256)
+    args = parser.parse_args()
+
+    from pymilvus import MilvusClient
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = MilvusClient(uri=args.uri or os.path.join(tmp, "bench_retrieval.db"))
+        embedding = HashEmbeddingFunction(dim=args.dim)
+        chunks = list(iter_markdown_chunks(DEFAULT_FILES))
+        ensure_collection(client, "bench_retrieval", args.dim, recreate=True)
+        ingest_chunks(client, "bench_retrieval", chunks, embedding)
+        questions = build_questions(chunks, args.questions)
+        print(f"📊 {len(chunks)} 个 chunk, {len(questions)} 个问题, top_k={args.top_k}, dim={args.dim}")
+
+        for batch_size in args.batch_sizes:
+            started = time.perf_counter()
+            hits = retrieve_batch(client, "bench_retrieval", questions, embedding,
+                                  top_k=args.top_k, batch_size=batch_size)
+            elapsed = time.perf_counter() - started
+            assert len(hits) == len(questions)
+            print(f"  batch_size={batch_size:<4} {elapsed:7.2f} s  "
+                  f"{len(questions) / elapsed:8.1f} 问题/秒  "
+                  f"{elapsed * 1000 / len(questions):7.2f} ms/问题")
+        client.drop_collection("bench_retrieval")
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
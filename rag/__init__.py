@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+基于 Milvus 的 RAG 流水线
+
+把 rag_milvus_deepseek_custom.ipynb 中的入库与检索逻辑整理为可导入、可测试的模块。
+命令行入口见 rag.cli（python -m rag ingest / query / bench）。
+"""
+
+from rag.chunking import (
+    DEFAULT_MAX_TOKENS,
+    DEFAULT_OVERLAP_TOKENS,
+    chunk_markdown,
+    count_tokens,
+    iter_markdown_chunks,
+    split_sentences,
+)
+from rag.collection import (
+    CONSISTENCY_LEVELS,
+    IndexConfig,
+    apply_index,
+    ensure_collection,
+    search_collection,
+    similarity_score,
+)
+from rag.context import (
+    DEFAULT_CONTEXT_TOKENS,
+    MODEL_CONTEXT_BUDGETS,
+    build_context,
+    context_budget,
+)
+from rag.embedding import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    EmbeddingCache,
+    HashEmbeddingFunction,
+    OllamaEmbeddingFunction,
+    embed_texts,
+    embedding_model_name,
+    ingest_chunks,
+    iter_embedded_batches,
+)
+from rag.hybrid import (
+    BM25Index,
+    HybridRetriever,
+    MilvusModelReranker,
+    TermOverlapReranker,
+    reciprocal_rank_fusion,
+    tokenize,
+)
+from rag.pipeline import (
+    Answerer,
+    DeepSeekLLM,
+    Ingestor,
+    OllamaLLM,
+    RAGPipeline,
+    Retriever,
+    create_embedding_function,
+    create_llm,
+    get_milvus_client,
+    get_pipeline,
+)
+from rag.query_cache import (
+    QueryEmbeddingCache,
+    SemanticAnswerCache,
+    corpus_generation,
+    normalize_question,
+)
+from rag.retrieval import DEFAULT_QUERY_BATCH_SIZE, BatchHits, retrieve_batch
+from rag.sync import chunk_id, load_manifest, sync_index
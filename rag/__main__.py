@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""python -m rag 的入口，见 rag.cli"""
+
+import sys
+
+from rag.cli import main
+
+sys.exit(main())
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+结构感知的 Markdown 切块器
+
+替代 notebook 中的 file_text.split("# ")：
+- 按标题层级切分章节，代码块内的 # 不会被当作标题
+- 每个 chunk 不超过 max_tokens，超长段落按句子、再按词切开，超长的单个词（长 URL、哈希等）按字符硬切
+- 同一章节内相邻 chunk 之间保留 overlap_tokens 的重叠
+- 每个 chunk 带有来源文件和标题路径等元数据
+- 以生成器方式逐行读取文件、逐个产出 chunk，不需要一次读入整个语料
+"""
+
+import glob
+import math
+import os
+import re
+import statistics
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+DEFAULT_MAX_TOKENS = 256
+DEFAULT_OVERLAP_TOKENS = 32
+
+_TOKEN_PATTERN = re.compile(
+    r"[぀-ヿ㐀-䶿一-鿿가-힯]|[A-Za-z0-9_]+|[^\sA-Za-z0-9_]"
+)
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？；;])\s+|(?<=[。！？；])|\n+")
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+_COMMENT_PATTERN = re.compile(r"<!--.*?-->")
+
+
+def count_tokens(text: str) -> int:
+    """
+    估算文本的 token 数：中日韩字符和标点各算 1 个，英文单词每 4 个字符算 1 个。
+
+    与 BPE 分词器的结果通常相差在 20% 以内，足够用于切块和上下文预算，且不依赖分词器。
+    """
+    total = 0
+    for token in _TOKEN_PATTERN.findall(text):
+        total += math.ceil(len(token) / 4) if token[0].isascii() and token[0].isalnum() else 1
+    return total
+
+
+def split_sentences(text: str) -> List[str]:
+    """按中英文句末标点和换行切分句子，保留句末标点"""
+    return [s.strip() for s in _SENTENCE_END.split(text) if s and s.strip()]
+
+
+def _hard_split(token: str, max_tokens: int) -> List[str]:
+    """单个英文/数字 token 超出预算时（长 URL、base64、哈希等）按 max_tokens × 4 个字符硬切"""
+    if count_tokens(token) <= max_tokens:
+        return [token]
+    width = max_tokens * 4
+    return [token[i:i + width] for i in range(0, len(token), width)]
+
+
+def _split_words(text: str, max_tokens: int) -> List[str]:
+    """单个句子仍超出预算时，按词（中文按字）切成不超过 max_tokens 的片段"""
+    pieces, current, used = [], "", 0
+    for match in re.finditer(r"\S+\s*", text):
+        word = match.group()
+        parts = [word]
+        if count_tokens(word) > max_tokens:
+            parts = [piece for token in _TOKEN_PATTERN.findall(word) for piece in _hard_split(token, max_tokens)]
+        for part in parts:
+            cost = count_tokens(part)
+            if current and used + cost > max_tokens:
+                pieces.append(current.strip())
+                current, used = "", 0
+            current += part
+            used += cost
+    if current.strip():
+        pieces.append(current.strip())
+    return pieces
+
+
+def _iter_sections(lines: Iterable[str]) -> Iterator[Tuple[List[str], List[Tuple[str, bool]]]]:
+    """
+    逐行解析 Markdown，按标题产出 (标题路径, 块列表)。
+
+    块为 (文本, 是否代码块)，段落之间以空行分隔；会跳过 YAML front matter 和 HTML 注释。
+    """
+    path: List[Tuple[int, str]] = []
+    blocks: List[Tuple[str, bool]] = []
+    paragraph: List[str] = []
+    fence: Optional[List[str]] = None
+    front_matter = None
+
+    def flush_paragraph():
+        text = "\n".join(paragraph).strip()
+        paragraph.clear()
+        if text:
+            blocks.append((text, False))
+
+    for line_number, raw in enumerate(lines):
+        line = raw.rstrip("\r\n")
+        if line_number == 0 and line.strip() == "---":
+            front_matter = True
+            continue
+        if front_matter:
+            if line.strip() == "---":
+                front_matter = False
+            continue
+
+        if fence is not None:
+            fence.append(line)
+            if _FENCE_PATTERN.match(line):
+                blocks.append(("\n".join(fence), True))
+                fence = None
+            continue
+        if _FENCE_PATTERN.match(line):
+            flush_paragraph()
+            fence = [line]
+            continue
+
+        heading = _HEADING_PATTERN.match(line)
+        if heading:
+            flush_paragraph()
+            if blocks:
+                yield [title for _, title in path], list(blocks)
+                blocks.clear()
+            level = len(heading.group(1))
+            while path and path[-1][0] >= level:
+                path.pop()
+            path.append((level, heading.group(2).strip()))
+            continue
+
+        line = _COMMENT_PATTERN.sub("", line)
+        if line.strip():
+            paragraph.append(line)
+        else:
+            flush_paragraph()
+
+    if fence is not None:
+        blocks.append(("\n".join(fence), True))
+    flush_paragraph()
+    if blocks:
+        yield [title for _, title in path], list(blocks)
+
+
+def _section_units(blocks: List[Tuple[str, bool]], budget: int) -> List[Tuple[str, int, int]]:
+    """把章节拆成不超过预算的最小单元 (文本, token 数, 所属块序号)"""
+    units = []
+    for block_index, (text, is_code) in enumerate(blocks):
+        if count_tokens(text) <= budget:
+            pieces = [text]
+        elif is_code:
+            pieces = text.splitlines()
+        else:
+            pieces = split_sentences(text)
+        for piece in pieces:
+            cost = count_tokens(piece)
+            if cost > budget:
+                for part in _split_words(piece, budget):
+                    units.append((part, count_tokens(part), block_index))
+            else:
+                units.append((piece, cost, block_index))
+    return units
+
+
+def _join_units(units: List[Tuple[str, int, int]], code_blocks: set) -> str:
+    text = ""
+    for i, (piece, _, block_index) in enumerate(units):
+        if i == 0:
+            text = piece
+        elif units[i - 1][2] != block_index:
+            text += "\n\n" + piece
+        else:
+            text += ("\n" if block_index in code_blocks else " ") + piece
+    return text
+
+
+def chunk_markdown(lines: Union[str, Iterable[str]], source: str = "",
+                   max_tokens: int = DEFAULT_MAX_TOKENS,
+                   overlap_tokens: int = DEFAULT_OVERLAP_TOKENS) -> Iterator[Dict]:
+    """
+    把一篇 Markdown 切成带元数据的 chunk。
+
+    lines 可以是整段文本，也可以是逐行迭代的文件对象。每个 chunk 以所在章节标题开头，
+    包含 text / source / heading / heading_path / chunk_index / tokens 字段。
+    """
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens 必须小于 max_tokens")
+
+    chunk_index = 0
+    for path, blocks in _iter_sections(lines):
+        heading = path[-1] if path else ""
+        prefix = f"{heading}\n\n" if heading else ""
+        budget = max(max_tokens - count_tokens(prefix), 1)
+        units = _section_units(blocks, budget)
+        code_blocks = {i for i, (_, is_code) in enumerate(blocks) if is_code}
+
+        start = 0
+        while start < len(units):
+            end, used = start, 0
+            while end < len(units) and (end == start or used + units[end][1] <= budget):
+                used += units[end][1]
+                end += 1
+            text = prefix + _join_units(units[start:end], code_blocks)
+            yield {
+                "text": text,
+                "source": source,
+                "heading": heading,
+                "heading_path": " > ".join(path),
+                "chunk_index": chunk_index,
+                "tokens": count_tokens(text),
+            }
+            chunk_index += 1
+            if end >= len(units):
+                break
+            # 下一个 chunk 从末尾若干单元开始，保证重叠但一定向前推进
+            overlap_start, carried = end, 0
+            while overlap_start - 1 > start and carried + units[overlap_start - 1][1] <= overlap_tokens:
+                overlap_start -= 1
+                carried += units[overlap_start][1]
+            start = overlap_start
+
+
+def _expand_paths(paths: Union[str, Iterable[str]]) -> List[str]:
+    """把文件、目录（递归匹配其中的 *.md）和 glob 模式展开为文件列表"""
+    if isinstance(paths, str):
+        paths = [paths]
+    expanded = []
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            if os.path.isdir(path):
+                expanded.extend(sorted(glob.glob(os.path.join(path, "**", "*.md"), recursive=True)))
+            else:
+                expanded.append(path)
+    return expanded
+
+
+def iter_markdown_chunks(paths: Union[str, Iterable[str]], max_tokens: int = DEFAULT_MAX_TOKENS,
+                         overlap_tokens: int = DEFAULT_OVERLAP_TOKENS) -> Iterator[Dict]:
+    """逐个文件流式切块，paths 可以是文件路径、目录或 glob 模式（单个或列表）"""
+    for path in _expand_paths(paths):
+        with open(path, "r", encoding="utf-8") as file:
+            yield from chunk_markdown(file, source=os.path.basename(path),
+                                      max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+
+
+def legacy_split_chunks(paths: Union[str, Iterable[str]]) -> Iterator[Dict]:
+    """原 notebook 的 split("# ") 切分方式，仅用于基准对比"""
+    for path in _expand_paths(paths):
+        with open(path, "r", encoding="utf-8") as file:
+            for text in file.read().split("# "):
+                yield {"text": text, "source": os.path.basename(path), "tokens": count_tokens(text)}
+
+
+def benchmark_chunkers(paths: Union[str, Iterable[str]], max_tokens: int = DEFAULT_MAX_TOKENS,
+                       overlap_tokens: int = DEFAULT_OVERLAP_TOKENS, repeat: int = 20) -> Dict[str, Dict]:
+    """对比 split("# ") 与结构感知切块的 chunk 数量、token 分布和切块耗时"""
+    paths = _expand_paths(paths)
+    runners = {
+        'split("# ")': lambda: list(legacy_split_chunks(paths)),
+        "markdown": lambda: list(iter_markdown_chunks(paths, max_tokens, overlap_tokens)),
+    }
+    report = {}
+    for name, run in runners.items():
+        started = time.perf_counter()
+        for _ in range(repeat):
+            chunks = run()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        sizes = [chunk["tokens"] for chunk in chunks]
+        report[name] = {
+            "chunks": len(chunks),
+            "tiny_chunks": sum(1 for size in sizes if size < 16),
+            "min_tokens": min(sizes),
+            "median_tokens": statistics.median(sizes),
+            "max_tokens": max(sizes),
+            "total_tokens": sum(sizes),
+            "elapsed_ms": round(elapsed_ms, 2),
+        }
+    return report
+
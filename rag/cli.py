@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+RAG 命令行入口
+
+    python -m rag ingest [路径/glob ...] [--recreate]
+    python -m rag query "How is data stored in milvus?" [--llm ollama] [--retrieve-only]
+    python -m rag query "How is data stored in milvus?" --local   # 嵌入与生成都走本机 Ollama
+    python -m rag bench [--questions-file questions.txt] [--repeat 3] [--answer]
+
+连接与模型配置取命令行参数，未指定时取环境变量（RAG_MILVUS_URI、RAG_COLLECTION、RAG_EMBEDDING、
+RAG_LLM、DEEPSEEK_API_KEY、OPENAI_API_KEY 等）。一次命令中的多个问题共用同一条流水线。
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from typing import List, Optional
+
+from rag.collection import INDEX_DEFAULTS, IndexConfig
+from rag.pipeline import (
+    DEFAULT_DOCS,
+    DEFAULT_EMBEDDING_CACHE,
+    DEFAULT_MANIFEST,
+    EMBEDDING_PROVIDERS,
+    LLM_PROVIDERS,
+    RAGPipeline,
+)
+
+DEFAULT_BENCH_QUESTIONS = [
+    "How is data stored in milvus?",
+    "What are the main features of Milvus?",
+    "How does Milvus handle performance optimization?",
+    "What are the common troubleshooting steps for Milvus?",
+    "How does Milvus support different vector types?",
+    "What is the architecture of Milvus?",
+    "What is datacoord.segment.maxSize?",
+    "How to choose nprobe for IVF indexes?",
+]
+
+
+def _add_common_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--uri", help="Milvus 地址，默认 RAG_MILVUS_URI 或 ./milvus_demo.db")
+    parser.add_argument("--collection", help="collection 名称，默认 RAG_COLLECTION 或 my_rag_collection")
+    parser.add_argument("--embedding", choices=EMBEDDING_PROVIDERS, help="嵌入模型，默认 RAG_EMBEDDING")
+    parser.add_argument("--local", action="store_true",
+                        help="完全本地：嵌入与生成都使用 Ollama（等同 --embedding ollama --llm ollama）")
+    parser.add_argument("--index", choices=sorted(INDEX_DEFAULTS), help="向量索引类型")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help="增量同步的 manifest 路径")
+    parser.add_argument("--embedding-cache", default=DEFAULT_EMBEDDING_CACHE,
+                        help="文档嵌入缓存（SQLite）路径")
+    parser.add_argument("--dense", action="store_true", help="只用向量检索，不做 BM25 混合检索")
+    parser.add_argument("--top-k", type=int, default=3)
+
+
+def _add_llm_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--llm", choices=LLM_PROVIDERS, help="LLM 后端，默认 RAG_LLM 或 deepseek")
+    parser.add_argument("--model", help="LLM 模型名，如 deepseek-chat、deepseek-r1:8b")
+    parser.add_argument("--answer-cache", action="store_true", help="启用语义答案缓存")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m rag", description="基于 Milvus 的 RAG 流水线")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser("ingest", help="增量同步文档到 Milvus")
+    ingest.add_argument("paths", nargs="*", default=[DEFAULT_DOCS], help="Markdown 文件、目录或 glob")
+    ingest.add_argument("--recreate", action="store_true", help="删除 collection 后全部重建")
+    _add_common_arguments(ingest)
+
+    query = subparsers.add_parser("query", help="检索并回答问题")
+    query.add_argument("questions", nargs="+")
+    query.add_argument("--retrieve-only", action="store_true", help="只输出检索结果，不调用 LLM")
+    query.add_argument("--json", action="store_true", help="以 JSON 输出")
+    _add_common_arguments(query)
+    _add_llm_arguments(query)
+
+    bench = subparsers.add_parser("bench", help="测量检索（和问答）的延迟与吞吐")
+    bench.add_argument("--questions-file", help="问题文件，每行一个问题")
+    bench.add_argument("--repeat", type=int, default=3, help="问题集重复的轮数")
+    bench.add_argument("--answer", action="store_true", help="同时测量完整问答（会调用 LLM）")
+    bench.add_argument("--batch-size", type=int, default=32, help="批量检索的 batch_size")
+    _add_common_arguments(bench)
+    _add_llm_arguments(bench)
+    return parser
+
+
+def pipeline_from_args(args) -> RAGPipeline:
+    local = "ollama" if args.local else None
+    return RAGPipeline.from_env(
+        uri=args.uri,
+        collection_name=args.collection,
+        embedding=local or args.embedding,
+        llm=local or getattr(args, "llm", None),
+        llm_model=getattr(args, "model", None),
+        index=IndexConfig(args.index) if args.index else None,
+        hybrid=not args.dense,
+        manifest_path=args.manifest,
+        embedding_cache=args.embedding_cache,
+        top_k=args.top_k,
+        answer_cache=getattr(args, "answer_cache", False),
+    )
+
+
+def latency_summary(latencies: List[float]) -> dict:
+    """latencies 单位为秒，返回 p50 / p95（毫秒）与每秒请求数"""
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "p50_ms": round(1000 * statistics.median(ordered), 2),
+        "p95_ms": round(1000 * ordered[int(0.95 * (len(ordered) - 1))], 2),
+        "qps": round(len(ordered) / sum(ordered), 1) if sum(ordered) else 0.0,
+    }
+
+
+def run_ingest(pipeline: RAGPipeline, args) -> int:
+    started = time.perf_counter()
+    stats = pipeline.ingest(args.paths, recreate=args.recreate)
+    print(f"✅ 同步完成 ({time.perf_counter() - started:.2f}s): {stats}")
+    return 0
+
+
+def run_query(pipeline: RAGPipeline, args) -> int:
+    for question in args.questions:
+        if args.retrieve_only:
+            result = {"question": question, "hits": pipeline.retrieve(question, top_k=args.top_k)}
+        else:
+            result = pipeline.query(question, top_k=args.top_k)
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False, default=str))
+            continue
+        print(f"\n❓ {question}")
+        for rank, hit in enumerate(result["hits"], start=1):
+            print(f"  {rank}. [{hit['score']:.4f}] {hit['text'][:100].replace(chr(10), ' ')}")
+        if "answer" in result:
+            source = "缓存" if result["cached"] else f"{result['context_tokens']} tokens 上下文"
+            print(f"💬 ({source}, {result['timings']['total']:.2f}s)\n{result['answer']}")
+    return 0
+
+
+def run_bench(pipeline: RAGPipeline, args) -> int:
+    if args.questions_file:
+        with open(args.questions_file, "r", encoding="utf-8") as file:
+            questions = [line.strip() for line in file if line.strip()]
+    else:
+        questions = list(DEFAULT_BENCH_QUESTIONS)
+    workload = questions * max(1, args.repeat)
+
+    # 预热：建 BM25 索引、加载模型、建立连接，不计入结果
+    pipeline.retrieve(questions[0], top_k=args.top_k)
+
+    latencies = []
+    for question in workload:
+        started = time.perf_counter()
+        pipeline.retrieve(question, top_k=args.top_k)
+        latencies.append(time.perf_counter() - started)
+    print(f"📊 逐条检索: {latency_summary(latencies)}")
+
+    started = time.perf_counter()
+    pipeline.retriever.retrieve_batch(workload, top_k=args.top_k, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"📊 批量检索 (batch_size={args.batch_size}): {len(workload) / elapsed:.1f} 问题/秒")
+
+    if args.answer:
+        latencies, stages = [], {"embed": [], "retrieve": [], "generate": []}
+        for question in questions:
+            result = pipeline.query(question, top_k=args.top_k)
+            latencies.append(result["timings"]["total"])
+            for stage in stages:
+                if stage in result["timings"]:
+                    stages[stage].append(result["timings"][stage])
+        print(f"📊 完整问答 ({pipeline.llm.provider}:{pipeline.llm.model_name}): {latency_summary(latencies)}")
+        for stage, values in stages.items():
+            if values:
+                print(f"  {stage:<9} p50 {latency_summary(values)['p50_ms']} ms")
+    return 0
+
+
+COMMANDS = {"ingest": run_ingest, "query": run_query, "bench": run_bench}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        pipeline = pipeline_from_args(args)
+        return COMMANDS[args.command](pipeline, args)
+    except (ValueError, ImportError, RuntimeError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
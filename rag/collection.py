@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Milvus collection 管理
+
+- 入库改为增量同步后，collection 只在不存在时创建，不再每次运行都删除重建
+- IndexConfig 描述 ANN 索引（FLAT / IVF_FLAT / IVF_SQ8 / HNSW / AUTOINDEX）及其构建和搜索参数
+- search_collection 支持按次指定一致性级别，检索路径不必每次都付出 Strong 一致性的等待
+"""
+
+import math
+from typing import Dict, List, Optional, Sequence
+
+DEFAULT_METRIC_TYPE = "IP"
+DEFAULT_CONSISTENCY_LEVEL = "Strong"
+CONSISTENCY_LEVELS = ("Strong", "Session", "Bounded", "Eventually")
+# 距离越小越相似的度量；IP、COSINE 则是越大越相似
+DISTANCE_METRICS = ("L2", "HAMMING", "JACCARD")
+
+# 各索引类型的默认构建参数与搜索参数，取值参考 performance_faq.md 与 Milvus 官方建议
+INDEX_DEFAULTS = {
+    "FLAT": ({}, {}),
+    "AUTOINDEX": ({}, {}),
+    "IVF_FLAT": ({"nlist": 128}, {"nprobe": 16}),
+    "IVF_SQ8": ({"nlist": 128}, {"nprobe": 16}),
+    "HNSW": ({"M": 16, "efConstruction": 200}, {"ef": 64}),
+}
+
+
+def similarity_score(distance: float, metric_type: str = DEFAULT_METRIC_TYPE) -> float:
+    """把 Milvus 返回的 distance 转换为越大越相似的分数（L2 等距离度量取相反数）"""
+    return -float(distance) if metric_type.upper() in DISTANCE_METRICS else float(distance)
+
+
+class IndexConfig:
+    """向量字段的索引配置：索引类型、距离度量、构建参数和默认搜索参数"""
+
+    def __init__(self, index_type: str = "AUTOINDEX", metric_type: str = DEFAULT_METRIC_TYPE,
+                 params: Optional[Dict] = None, search_params: Optional[Dict] = None):
+        index_type = index_type.upper()
+        if index_type not in INDEX_DEFAULTS:
+            raise ValueError(f"不支持的索引类型: {index_type}，可选 {', '.join(INDEX_DEFAULTS)}")
+        default_params, default_search = INDEX_DEFAULTS[index_type]
+        self.index_type = index_type
+        self.metric_type = metric_type
+        self.params = dict(default_params, **(params or {}))
+        self.search_params = dict(default_search, **(search_params or {}))
+
+    @classmethod
+    def ivf(cls, num_entities: int, index_type: str = "IVF_FLAT", nprobe: Optional[int] = None,
+            metric_type: str = DEFAULT_METRIC_TYPE) -> "IndexConfig":
+        """
+        按数据量给出 IVF 配置：nlist 取 4 × sqrt(n)（performance_faq.md 的经验值），
+        nprobe 默认取 nlist 的 1/8，需要更高召回时调大。
+        """
+        nlist = max(1, min(65536, int(4 * math.sqrt(max(num_entities, 1)))))
+        nprobe = nprobe or max(1, nlist // 8)
+        return cls(index_type, metric_type, {"nlist": nlist}, {"nprobe": nprobe})
+
+    def build_index_params(self, milvus_client):
+        index_params = milvus_client.prepare_index_params()
+        index_params.add_index(field_name="vector", index_type=self.index_type,
+                               metric_type=self.metric_type, params=self.params)
+        return index_params
+
+    def to_search_params(self, **overrides) -> Dict:
+        """生成 search 的 search_params，overrides 覆盖默认搜索参数（如 nprobe=32、ef=128）"""
+        return {"metric_type": self.metric_type, "params": dict(self.search_params, **overrides)}
+
+    def matches(self, description: Dict) -> bool:
+        """与 describe_index 的结果比较，判断已有索引是否就是本配置"""
+        if description.get("index_type") != self.index_type:
+            return False
+        if description.get("metric_type", self.metric_type) != self.metric_type:
+            return False
+        # 部分部署（如 Milvus Lite）不回显构建参数，只比较回显了的那些
+        return all(str(description[key]) == str(value)
+                   for key, value in self.params.items() if key in description)
+
+    def __repr__(self):
+        return (f"IndexConfig({self.index_type!r}, {self.metric_type!r}, "
+                f"params={self.params}, search_params={self.search_params})")
+
+
+def _build_schema(milvus_client, dimension: int):
+    from pymilvus import DataType
+
+    schema = milvus_client.create_schema(auto_id=False, enable_dynamic_field=True)
+    schema.add_field("id", DataType.INT64, is_primary=True)
+    schema.add_field("vector", DataType.FLOAT_VECTOR, dim=dimension)
+    return schema
+
+
+def ensure_collection(milvus_client, collection_name: str, dimension: int,
+                      metric_type: str = DEFAULT_METRIC_TYPE,
+                      consistency_level: str = DEFAULT_CONSISTENCY_LEVEL,
+                      recreate: bool = False, index: Optional[IndexConfig] = None) -> bool:
+    """
+    确保 collection 存在，返回是否新建。
+
+    recreate=True 时先删除已有 collection，相当于原 notebook 的 drop + create；
+    已有 collection 的维度与 dimension 不一致时抛出 ValueError，避免写入后才发现向量不可用。
+    指定 index 时按该配置建索引；collection 已存在且索引不同时就地重建索引，数据不受影响。
+    """
+    if milvus_client.has_collection(collection_name):
+        if not recreate:
+            existing = collection_dimension(milvus_client, collection_name)
+            if existing is not None and existing != dimension:
+                raise ValueError(
+                    f"collection {collection_name} 的向量维度为 {existing}，"
+                    f"与嵌入模型维度 {dimension} 不一致，请使用 recreate=True 重建"
+                )
+            if index is not None:
+                apply_index(milvus_client, collection_name, index)
+            # 重新打开的 Milvus Lite 数据库中 collection 处于 released 状态，需要先加载才能检索
+            milvus_client.load_collection(collection_name)
+            return False
+        milvus_client.drop_collection(collection_name)
+    if index is None:
+        milvus_client.create_collection(
+            collection_name=collection_name,
+            dimension=dimension,
+            metric_type=metric_type,
+            consistency_level=consistency_level,
+        )
+    else:
+        milvus_client.create_collection(
+            collection_name=collection_name,
+            schema=_build_schema(milvus_client, dimension),
+            index_params=index.build_index_params(milvus_client),
+            consistency_level=consistency_level,
+        )
+    return True
+
+
+def apply_index(milvus_client, collection_name: str, index: IndexConfig) -> bool:
+    """已有索引与配置不同时重建向量索引，返回是否发生了重建"""
+    if "vector" in milvus_client.list_indexes(collection_name):
+        if index.matches(milvus_client.describe_index(collection_name, "vector")):
+            return False
+        milvus_client.release_collection(collection_name)
+        milvus_client.drop_index(collection_name, "vector")
+    milvus_client.create_index(collection_name, index.build_index_params(milvus_client))
+    milvus_client.load_collection(collection_name)
+    return True
+
+
+def collection_dimension(milvus_client, collection_name: str) -> Optional[int]:
+    """读取已有 collection 的向量维度，collection 不存在时返回 None"""
+    if not milvus_client.has_collection(collection_name):
+        return None
+    for field in milvus_client.describe_collection(collection_name).get("fields", []):
+        dim = field.get("params", {}).get("dim")
+        if dim is not None:
+            return int(dim)
+    return None
+
+
+def search_collection(milvus_client, collection_name: str, query_vectors: Sequence,
+                      limit: int = 3, index: Optional[IndexConfig] = None,
+                      consistency_level: Optional[str] = None,
+                      output_fields: Sequence[str] = ("text",),
+                      filter: str = "", **search_overrides) -> List[List[Dict]]:
+    """
+    按索引配置搜索，可按次指定一致性级别。
+
+    consistency_level 为 None 时沿用 collection 的设置；问答检索通常用 "Bounded"
+    即可，刚写入就要读到时再用 "Strong"。search_overrides 覆盖索引的默认搜索参数。
+    """
+    if consistency_level is not None and consistency_level not in CONSISTENCY_LEVELS:
+        raise ValueError(f"不支持的一致性级别: {consistency_level}")
+    index = index or IndexConfig("FLAT")
+    kwargs = {}
+    if consistency_level is not None:
+        kwargs["consistency_level"] = consistency_level
+    return milvus_client.search(
+        collection_name=collection_name,
+        data=list(query_vectors),
+        limit=limit,
+        search_params=index.to_search_params(**search_overrides),
+        output_fields=list(output_fields),
+        filter=filter,
+        **kwargs
+    )
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+按 token 预算组装 RAG 上下文
+
+notebook 原来直接 "\\n".join 全部检索结果，上下文大小不可控。build_context：
+- 按相似度从高到低放入 chunk（L2 等距离度量按距离从小到大）
+- 去掉重复 chunk，以及相邻 chunk 之间因切块重叠而重复的句子
+- 超出预算的 chunk 在句子边界截断，不会留下半句话
+- 返回实际使用的 token 数，提示词大小可预测
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence
+
+from rag.chunking import count_tokens, split_sentences
+from rag.collection import DEFAULT_METRIC_TYPE, similarity_score
+
+DEFAULT_CONTEXT_TOKENS = 1500
+MIN_TRUNCATED_TOKENS = 32
+
+# 各模型留给检索上下文的 token 预算（已为系统提示、问题和回答留出余量）
+MODEL_CONTEXT_BUDGETS = {
+    "deepseek-chat": 3000,
+    "deepseek-reasoner": 3000,
+    "deepseek-r1:1.5b": 1200,  # Ollama 默认 num_ctx=2048
+    "deepseek-r1:7b": 1500,
+    "deepseek-r1:8b": 1500,
+    "deepseek-r1:14b": 2500,
+}
+
+
+def context_budget(model_name: Optional[str], default: int = DEFAULT_CONTEXT_TOKENS) -> int:
+    """按模型名取上下文预算；精确匹配优先，其次按最长前缀匹配（如 deepseek-r1:8b-llama-distill-q4）"""
+    if not model_name:
+        return default
+    if model_name in MODEL_CONTEXT_BUDGETS:
+        return MODEL_CONTEXT_BUDGETS[model_name]
+    prefixes = [name for name in MODEL_CONTEXT_BUDGETS if model_name.startswith(name)]
+    return MODEL_CONTEXT_BUDGETS[max(prefixes, key=len)] if prefixes else default
+
+
+def _normalize_hit(hit, metric_type: str) -> Dict:
+    """
+    接受 Retriever / HybridRetriever 的结果字典、Milvus 原始命中或 (text, distance) 元组。
+
+    结果字典中的 score / rerank_score 已经是越大越相似；原始的 distance 按 metric_type 换算。
+    """
+    if isinstance(hit, (tuple, list)):
+        return {"text": hit[0], "score": similarity_score(hit[1], metric_type) if len(hit) > 1 else 0.0}
+    if "entity" in hit:
+        return {"id": hit.get("id"), "text": hit["entity"].get("text", ""),
+                "score": similarity_score(hit.get("distance", 0.0), metric_type)}
+    if "rerank_score" in hit or "score" in hit:
+        score = float(hit.get("rerank_score", hit.get("score")))
+    else:
+        score = similarity_score(hit.get("distance", 0.0), metric_type)
+    return {"id": hit.get("id"), "text": hit.get("text", ""), "score": score}
+
+
+def _sentence_key(sentence: str) -> str:
+    return re.sub(r"\s+", " ", sentence).strip().lower()
+
+
+def build_context(hits: Sequence, max_tokens: int = DEFAULT_CONTEXT_TOKENS,
+                  separator: str = "\n\n", dedupe_ratio: float = 0.8,
+                  metric_type: str = DEFAULT_METRIC_TYPE) -> Dict:
+    """
+    在 max_tokens 以内组装上下文。
+
+    metric_type 为 collection 的距离度量，用于换算 Milvus 原始命中中的 distance。
+
+    已放入的句子再次出现时会被去掉；一个 chunk 有 dedupe_ratio 以上的句子都已出现过时整体跳过。
+    返回 {"context", "tokens", "ids", "used", "skipped", "truncated"}。
+    """
+    ordered = sorted((_normalize_hit(hit, metric_type) for hit in hits), key=lambda hit: -hit["score"])
+    separator_tokens = count_tokens(separator)
+    seen = set()
+    pieces: List[str] = []
+    ids = []
+    used_tokens = 0
+    truncated = False
+
+    for hit in ordered:
+        sentences = split_sentences(hit["text"])
+        fresh = [s for s in sentences if _sentence_key(s) not in seen]
+        if not fresh or len(fresh) <= (1 - dedupe_ratio) * len(sentences):
+            continue
+
+        remaining = max_tokens - used_tokens - (separator_tokens if pieces else 0)
+        text = hit["text"].strip() if len(fresh) == len(sentences) else " ".join(fresh)
+        cost = count_tokens(text)
+        if cost > remaining:
+            # 在句子边界截断；能放下的部分太少时跳过，看分数更低但更短的 chunk 能否放下
+            kept, kept_cost = [], 0
+            for sentence in fresh:
+                sentence_cost = count_tokens(sentence)
+                if kept_cost + sentence_cost > remaining:
+                    break
+                kept.append(sentence)
+                kept_cost += sentence_cost
+            if kept_cost < min(MIN_TRUNCATED_TOKENS, remaining) or not kept:
+                continue
+            text, cost, fresh = " ".join(kept), kept_cost, kept
+            truncated = True
+
+        pieces.append(text)
+        ids.append(hit.get("id"))
+        seen.update(_sentence_key(s) for s in fresh)
+        used_tokens += cost + (separator_tokens if len(pieces) > 1 else 0)
+        if truncated:
+            break
+
+    context = separator.join(pieces)
+    return {
+        "context": context,
+        "tokens": count_tokens(context),
+        "ids": ids,
+        "used": len(pieces),
+        "skipped": len(ordered) - len(pieces),
+        "truncated": truncated,
+    }
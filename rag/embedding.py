@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+RAG 入库的嵌入流水线
+
+- 按批次调用嵌入模型，并发数有上限，单批失败自动退避重试
+- 嵌入结果按 (模型名, 文本哈希) 缓存在磁盘上，重新入库只嵌入新增或改动的文本
+- 每嵌入完一批就直接写入 Milvus，不在内存里攒整个语料
+- HashEmbeddingFunction 是确定性的本地嵌入替身，离线测试不依赖任何远程服务
+- OllamaEmbeddingFunction 调用本机 Ollama 的 /api/embed，嵌入不出本机
+"""
+
+import hashlib
+import math
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_CONCURRENCY = 4
+DEFAULT_OLLAMA_EMBEDDING_MODEL = "nomic-embed-text"
+
+# 部分嵌入模型要求给查询和文档加上任务前缀，不加时检索质量明显下降
+OLLAMA_EMBEDDING_PREFIXES = {
+    "nomic-embed-text": ("search_query: ", "search_document: "),
+}
+
+_TOKEN_PATTERN = re.compile(r"[0-9a-z_.]+|[^\s0-9a-z_.]", re.IGNORECASE)
+
+
+class HashEmbeddingFunction:
+    """
+    确定性的本地嵌入替身：把词和字符三元组哈希到固定维度后做 L2 归一化。
+
+    接口与 pymilvus.model 的嵌入函数一致（encode_documents / encode_queries / dim），
+    同一文本永远得到同一向量，词面相近的文本内积也更高，足够离线跑通整条 RAG 链路。
+    """
+
+    def __init__(self, dim: int = 64, model_name: str = "hash-embedding"):
+        self._dim = dim
+        self.model_name = f"{model_name}-{dim}"
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    def _bucket(self, feature: str) -> Tuple[int, float]:
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self._dim, (1.0 if value >> 63 else -1.0)
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self._dim
+        lowered = text.lower()
+        features = _TOKEN_PATTERN.findall(lowered)
+        features += [lowered[i:i + 3] for i in range(max(len(lowered) - 2, 0))]
+        for feature in features:
+            index, sign = self._bucket(feature)
+            vector[index] += sign
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def encode_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def encode_queries(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def __call__(self, texts: List[str]) -> List[List[float]]:
+        return self.encode_documents(texts)
+
+
+class OllamaEmbeddingFunction:
+    """
+    通过本地 Ollama 的 /api/embed 生成嵌入，接口与 pymilvus.model 的嵌入函数一致。
+
+    复用第六章的 OllamaClient（连接池、重试、熔断，也可以是多节点的 OllamaBackendPool）；
+    未传入 client 时与 RAG 的生成端共用全局客户端。每 batch_size 条文本一次请求，
+    keep_alive 让嵌入模型常驻内存，避免每次查询都重新加载。
+    """
+
+    def __init__(self, model_name: str = DEFAULT_OLLAMA_EMBEDDING_MODEL, client=None,
+                 batch_size: int = 64, keep_alive: Optional[str] = "30m",
+                 query_prefix: Optional[str] = None, document_prefix: Optional[str] = None):
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.keep_alive = keep_alive
+        default_query, default_document = OLLAMA_EMBEDDING_PREFIXES.get(model_name.split(":")[0], ("", ""))
+        self.query_prefix = default_query if query_prefix is None else query_prefix
+        self.document_prefix = default_document if document_prefix is None else document_prefix
+        self._client = client
+        self._dim = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from rednote_ch6_assignment import get_ollama_client
+
+            self._client = get_ollama_client()
+        return self._client
+
+    @property
+    def dim(self) -> int:
+        """嵌入维度，第一次访问时用一条探测文本向 Ollama 询问"""
+        if self._dim is None:
+            self._dim = len(self._embed(["dimension probe"])[0])
+        return self._dim
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            response = self.client.embed(batch, model=self.model_name, keep_alive=self.keep_alive)
+            if "error" in response:
+                raise RuntimeError(f"Ollama 嵌入失败: {response['error']}")
+            embeddings = response.get("embeddings", [])
+            if len(embeddings) != len(batch):
+                raise RuntimeError(f"Ollama 返回了 {len(embeddings)} 个向量，期望 {len(batch)} 个")
+            vectors.extend(embeddings)
+        if vectors and self._dim is None:
+            self._dim = len(vectors[0])
+        return vectors
+
+    def encode_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed([self.document_prefix + text for text in texts])
+
+    def encode_queries(self, texts: List[str]) -> List[List[float]]:
+        return self._embed([self.query_prefix + text for text in texts])
+
+    def __call__(self, texts: List[str]) -> List[List[float]]:
+        return self.encode_documents(texts)
+
+
+def embedding_model_name(embedding_fn) -> str:
+    """取嵌入函数的模型名作为缓存命名空间，没有 model_name 属性时退回类名"""
+    return getattr(embedding_fn, "model_name", None) or type(embedding_fn).__name__
+
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的嵌入缓存，键为 sha256(模型名 + 文本)，向量以 float32 字节存储。
+
+    path 默认为内存库；传入文件路径即可跨进程、跨次运行复用。
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """批量查询，返回命中的 key → 向量"""
+        found = {}
+        with self._lock:
+            # SQLite 单条语句的参数个数有上限，分段查询
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                    part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in items.items()]
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def _normalize_chunk(chunk) -> Dict:
+    """字符串视为只有 text 字段的 chunk，字典原样保留其余元数据"""
+    if isinstance(chunk, str):
+        return {"text": chunk}
+    return dict(chunk)
+
+
+def _iter_batches(items: Iterable, batch_size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def embed_texts(texts: List[str], embedding_fn, cache: Optional[EmbeddingCache] = None,
+                model_name: Optional[str] = None, max_retries: int = 2,
+                backoff_base: float = 0.5, stats: Optional[Dict] = None) -> List[List[float]]:
+    """
+    嵌入一批文本：先查缓存，只把未命中的文本发给模型，失败时指数退避重试。
+    """
+    model_name = model_name or embedding_model_name(embedding_fn)
+    keys = [EmbeddingCache.make_key(model_name, text) for text in texts]
+    cached = cache.get_many(keys) if cache is not None else {}
+
+    # 同一批内重复的文本只嵌入一次
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cached and key not in missing:
+            missing[key] = text
+
+    if missing:
+        attempt = 0
+        while True:
+            try:
+                vectors = embedding_fn.encode_documents(list(missing.values()))
+                break
+            except Exception:
+                if attempt >= max_retries:
+                    raise
+                time.sleep(backoff_base * (2 ** attempt))
+                attempt += 1
+        fresh = {key: [float(v) for v in vector] for key, vector in zip(missing, vectors)}
+        if cache is not None:
+            cache.put_many(fresh)
+        cached.update(fresh)
+
+    if stats is not None:
+        stats["embedded"] = stats.get("embedded", 0) + len(missing)
+        stats["cached"] = stats.get("cached", 0) + len(texts) - len(missing)
+    return [cached[key] for key in keys]
+
+
+def iter_embedded_batches(chunks: Iterable, embedding_fn, batch_size: int = DEFAULT_BATCH_SIZE,
+                          concurrency: int = DEFAULT_CONCURRENCY,
+                          cache: Optional[EmbeddingCache] = None,
+                          model_name: Optional[str] = None, max_retries: int = 2,
+                          stats: Optional[Dict] = None) -> Iterator[Tuple[List[Dict], List[List[float]]]]:
+    """
+    按批嵌入 chunk，按输入顺序逐批产出 (chunks, vectors)。
+
+    chunks 可以是任意可迭代对象（包括生成器），同一时刻最多有 concurrency 个批次在嵌入，
+    内存占用与 batch_size * concurrency 成正比，与语料总量无关。
+    """
+    model_name = model_name or embedding_model_name(embedding_fn)
+    stats = stats if stats is not None else {}
+    pending = deque()
+
+    def embed(batch):
+        # 每批单独计数，回到调用线程再汇总，避免多线程同时改 stats
+        batch_stats = {}
+        vectors = embed_texts([chunk["text"] for chunk in batch], embedding_fn, cache=cache,
+                              model_name=model_name, max_retries=max_retries, stats=batch_stats)
+        return vectors, batch_stats
+
+    def collect(future):
+        vectors, batch_stats = future.result()
+        for key, value in batch_stats.items():
+            stats[key] = stats.get(key, 0) + value
+        return vectors
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        try:
+            for batch in _iter_batches((_normalize_chunk(c) for c in chunks), batch_size):
+                pending.append((batch, executor.submit(embed, batch)))
+                if len(pending) >= max(1, concurrency):
+                    batch, future = pending.popleft()
+                    yield batch, collect(future)
+            while pending:
+                batch, future = pending.popleft()
+                yield batch, collect(future)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def ingest_chunks(milvus_client, collection_name: str, chunks: Iterable, embedding_fn,
+                  batch_size: int = DEFAULT_BATCH_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+                  cache: Optional[EmbeddingCache] = None, model_name: Optional[str] = None,
+                  id_start: int = 0, max_retries: int = 2, show_progress: bool = False,
+                  upsert: bool = False) -> Dict:
+    """
+    嵌入并写入 Milvus：每嵌入完一批就调用一次 milvus_client.insert。
+
+    chunk 为字符串或带 text 字段的字典，其余字段作为动态字段一并写入；
+    没有 id 字段的 chunk 从 id_start 起按顺序编号。upsert=True 时改用 upsert，
+    同 id 的旧数据会被覆盖。返回入库统计。
+    """
+    write = milvus_client.upsert if upsert else milvus_client.insert
+    stats = {"chunks": 0, "batches": 0, "embedded": 0, "cached": 0}
+    progress = None
+    if show_progress:
+        from tqdm import tqdm
+        progress = tqdm(desc="Creating embeddings", unit="chunk")
+
+    next_id = id_start
+    try:
+        for batch, vectors in iter_embedded_batches(
+                chunks, embedding_fn, batch_size=batch_size, concurrency=concurrency,
+                cache=cache, model_name=model_name, max_retries=max_retries, stats=stats):
+            rows = []
+            for chunk, vector in zip(batch, vectors):
+                row = dict(chunk)
+                if "id" not in row:
+                    row["id"] = next_id
+                    next_id += 1
+                row["vector"] = vector
+                rows.append(row)
+            write(collection_name=collection_name, data=rows)
+            stats["chunks"] += len(rows)
+            stats["batches"] += 1
+            if progress is not None:
+                progress.update(len(rows))
+    finally:
+        if progress is not None:
+            progress.close()
+    return stats
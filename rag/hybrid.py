@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+BM25 + 向量的混合检索
+
+稠密检索对 `datacoord.segment.maxSize`、`nprobe` 这类精确术语经常召回不到对应 FAQ：
+- BM25Index 在同一批 chunk 上建本地倒排索引，点号连接的配置项既作为整体也拆成各段索引
+- reciprocal_rank_fusion 用 RRF 融合稠密与稀疏两路排名，不需要对两种分数做归一化
+- 融合后的前 N 条可以再交给 CPU 重排器（默认按查询词覆盖率，也可接入 milvus_model 的交叉编码器）
+"""
+
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from rag.collection import IndexConfig, search_collection
+from rag.retrieval import retrieve_batch
+
+DEFAULT_RRF_K = 60
+DEFAULT_CANDIDATES = 20
+
+_TERM_PATTERN = re.compile(r"[a-z0-9_]+(?:[.\-][a-z0-9_]+)*|[぀-ヿ㐀-䶿一-鿿가-힯]")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it of on or that the this "
+    "to what when where which why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    BM25 分词：英文小写、去停用词；`a.b.c`、`a-b` 这类术语保留整体并追加各段；中文按字切分。
+    """
+    terms = []
+    for term in _TERM_PATTERN.findall(text.lower()):
+        if term in _STOPWORDS:
+            continue
+        terms.append(term)
+        if "." in term or "-" in term:
+            terms.extend(part for part in re.split(r"[.\-]", term) if part and part not in _STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    """内存中的 BM25 倒排索引，支持增删文档"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self._lengths: Dict[int, int] = {}
+        self._texts: Dict[int, str] = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, doc_id: int, text: str):
+        if doc_id in self._lengths:
+            self.remove(doc_id)
+        terms = tokenize(text)
+        for term, count in Counter(terms).items():
+            self._postings[term][doc_id] = count
+        self._lengths[doc_id] = len(terms)
+        self._texts[doc_id] = text
+        self._total_length += len(terms)
+
+    def remove(self, doc_id: int):
+        if doc_id not in self._lengths:
+            return
+        for term in set(tokenize(self._texts[doc_id])):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._lengths.pop(doc_id)
+        del self._texts[doc_id]
+
+    def text(self, doc_id: int) -> Optional[str]:
+        return self._texts.get(doc_id)
+
+    def idf(self, term: str) -> float:
+        df = len(self._postings.get(term, ()))
+        return math.log(1 + (len(self._lengths) - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = DEFAULT_CANDIDATES) -> List[Tuple[int, float]]:
+        """返回 [(doc_id, score), ...]，按分数从高到低"""
+        if not self._lengths:
+            return []
+        avg_length = self._total_length / len(self._lengths) or 1.0
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[Dict], **kwargs) -> "BM25Index":
+        index = cls(**kwargs)
+        for chunk in chunks:
+            index.add(chunk["id"], chunk["text"])
+        return index
+
+    @classmethod
+    def from_collection(cls, milvus_client, collection_name: str, batch_size: int = 1000,
+                        **kwargs) -> "BM25Index":
+        """从 Milvus collection 读出全部 chunk 的 text 建索引，与向量检索使用同一份数据"""
+        index = cls(**kwargs)
+        iterator = milvus_client.query_iterator(collection_name, batch_size=batch_size,
+                                                filter="id >= 0", output_fields=["text"])
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                for row in rows:
+                    index.add(row["id"], row.get("text", ""))
+        finally:
+            iterator.close()
+        return index
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = DEFAULT_RRF_K,
+                           weights: Optional[Sequence[float]] = None) -> List[Tuple[int, float]]:
+    """RRF：score(d) = Σ weight / (k + rank)，rank 从 1 开始；返回按融合分数排序的 [(id, score)]"""
+    weights = weights or [1.0] * len(rankings)
+    fused: Dict[int, float] = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] += weight / (k + rank)
+    return sorted(fused.items(), key=lambda item: (-item[1], item[0]))
+
+
+class TermOverlapReranker:
+    """
+    轻量 CPU 重排：按 idf 加权的查询词覆盖率打分，完整出现的多段术语额外加分。
+
+    不需要模型文件，单条 chunk 的打分是微秒级。
+    """
+
+    def __init__(self, bm25: BM25Index, phrase_bonus: float = 0.5):
+        self.bm25 = bm25
+        self.phrase_bonus = phrase_bonus
+
+    def __call__(self, query: str, texts: List[str]) -> List[float]:
+        query_terms = set(tokenize(query))
+        weights = {term: self.bm25.idf(term) for term in query_terms}
+        total = sum(weights.values()) or 1.0
+        phrases = [term for term in query_terms if "." in term or "-" in term]
+        scores = []
+        for text in texts:
+            doc_terms = set(tokenize(text))
+            score = sum(weight for term, weight in weights.items() if term in doc_terms) / total
+            lowered = text.lower()
+            score += self.phrase_bonus * sum(1 for phrase in phrases if phrase in lowered)
+            scores.append(score)
+        return scores
+
+
+class MilvusModelReranker:
+    """
+    适配 pymilvus.model 的重排函数（如 CrossEncoderRerankFunction、BGERerankFunction），
+    在 CPU 上运行交叉编码器，精度更高但每条需要毫秒级。
+    """
+
+    def __init__(self, rerank_fn):
+        self.rerank_fn = rerank_fn
+
+    def __call__(self, query: str, texts: List[str]) -> List[float]:
+        scores = [0.0] * len(texts)
+        for result in self.rerank_fn(query, texts, top_k=len(texts)):
+            scores[result.index] = float(result.score)
+        return scores
+
+
+class HybridRetriever:
+    """
+    混合检索：Milvus 稠密检索 + BM25 稀疏检索，RRF 融合后可选重排。
+
+    每路各取 candidates 条候选，融合后的前 rerank_top_n 条交给 reranker 重新打分，最终返回 top_k 条。
+    """
+
+    def __init__(self, milvus_client, collection_name: str, embedding_fn,
+                 bm25: Optional[BM25Index] = None, index: Optional[IndexConfig] = None,
+                 candidates: int = DEFAULT_CANDIDATES, rrf_k: int = DEFAULT_RRF_K,
+                 weights: Tuple[float, float] = (1.0, 1.0),
+                 reranker: Optional[Callable[[str, List[str]], List[float]]] = None,
+                 rerank_top_n: int = 10, consistency_level: Optional[str] = "Bounded"):
+        self.milvus_client = milvus_client
+        self.collection_name = collection_name
+        self.embedding_fn = embedding_fn
+        self.bm25 = bm25 if bm25 is not None else BM25Index.from_collection(milvus_client, collection_name)
+        self.index = index
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.weights = weights
+        self.reranker = reranker
+        self.rerank_top_n = rerank_top_n
+        self.consistency_level = consistency_level
+
+    def refresh(self):
+        """语料重新索引后重建 BM25 索引"""
+        self.bm25 = BM25Index.from_collection(self.milvus_client, self.collection_name)
+
+    def _fuse(self, question: str, dense: List[Tuple[int, float, Dict]], top_k: int) -> List[Dict]:
+        texts = {doc_id: entity.get("text", "") for doc_id, _, entity in dense}
+        sparse = self.bm25.search(question, self.candidates)
+        fused = reciprocal_rank_fusion(
+            [[doc_id for doc_id, _, _ in dense], [doc_id for doc_id, _ in sparse]],
+            k=self.rrf_k, weights=self.weights,
+        )
+        dense_rank = {doc_id: rank for rank, (doc_id, _, _) in enumerate(dense, start=1)}
+        sparse_rank = {doc_id: rank for rank, (doc_id, _) in enumerate(sparse, start=1)}
+        hits = [{
+            "id": doc_id,
+            "text": texts.get(doc_id) or self.bm25.text(doc_id) or "",
+            "score": score,
+            "dense_rank": dense_rank.get(doc_id),
+            "sparse_rank": sparse_rank.get(doc_id),
+        } for doc_id, score in fused]
+
+        if self.reranker is not None and hits:
+            head = hits[:max(self.rerank_top_n, top_k)]
+            for hit, score in zip(head, self.reranker(question, [hit["text"] for hit in head])):
+                hit["rerank_score"] = score
+            head.sort(key=lambda hit: -hit["rerank_score"])
+            hits = head + hits[len(head):]
+        return hits[:top_k]
+
+    def search(self, question: str, top_k: int = 3) -> List[Dict]:
+        """返回 [{id, text, score, dense_rank, sparse_rank[, rerank_score]}, ...]"""
+        vector = self.embedding_fn.encode_queries([question])
+        results = search_collection(self.milvus_client, self.collection_name, vector,
+                                    limit=self.candidates, index=self.index,
+                                    consistency_level=self.consistency_level)
+        dense = [(hit["id"], hit["distance"], hit.get("entity", {})) for hit in results[0]]
+        return self._fuse(question, dense, top_k)
+
+    def search_batch(self, questions: Sequence[str], top_k: int = 3,
+                     batch_size: int = 32) -> List[List[Dict]]:
+        """批量版本：稠密检索走 retrieve_batch，BM25 与融合逐个问题在本地完成"""
+        dense = retrieve_batch(self.milvus_client, self.collection_name, questions, self.embedding_fn,
+                               top_k=self.candidates, batch_size=batch_size, index=self.index,
+                               consistency_level=self.consistency_level)
+        return [self._fuse(question, dense.hits(i), top_k) for i, question in enumerate(questions)]
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+可复用的 RAG 流水线
+
+把 rag_milvus_deepseek_custom.ipynb 中分散在各个 cell 的流程整理为三个类：
+- Ingestor：确保 collection 存在，并把 Markdown 文档增量同步进去
+- Retriever：查询向量缓存 + 混合检索（或纯向量检索）
+- Answerer：按模型预算组装上下文，调用可插拔的 LLM 后端（DeepSeek 云端 API 或本地 Ollama）
+
+嵌入与生成都选 Ollama（RAG_EMBEDDING=ollama、RAG_LLM=ollama）时，整条检索问答链路都在本机完成，
+两端共用第六章的同一个 OllamaClient 连接池。
+
+RAGPipeline 把三者组合在一起；Milvus 客户端、嵌入模型和 LLM 客户端只创建一次，
+之后的每次查询都复用它们。配置默认取环境变量，API Key 只从环境变量读取，不再写在代码里。
+"""
+
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Union
+
+from rag.chunking import DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP_TOKENS
+from rag.collection import (
+    DEFAULT_METRIC_TYPE,
+    IndexConfig,
+    ensure_collection,
+    search_collection,
+    similarity_score,
+)
+from rag.context import build_context, context_budget
+from rag.embedding import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_OLLAMA_EMBEDDING_MODEL,
+    EmbeddingCache,
+    HashEmbeddingFunction,
+    OllamaEmbeddingFunction,
+)
+from rag.hybrid import DEFAULT_CANDIDATES, HybridRetriever, TermOverlapReranker
+from rag.query_cache import QueryEmbeddingCache, SemanticAnswerCache, corpus_generation
+from rag.retrieval import DEFAULT_QUERY_BATCH_SIZE, retrieve_batch
+from rag.sync import sync_index
+
+DEFAULT_MILVUS_URI = "./milvus_demo.db"
+DEFAULT_COLLECTION = "my_rag_collection"
+DEFAULT_DOCS = "milvus_docs/en/faq/*.md"
+DEFAULT_MANIFEST = "index_manifest.json"
+DEFAULT_EMBEDDING_CACHE = "embedding_cache.sqlite3"
+DEFAULT_DEEPSEEK_BASE_URL = "https://api.deepseek.com/v1"
+DEFAULT_DEEPSEEK_MODEL = "deepseek-chat"
+DEFAULT_OPENAI_EMBEDDING_MODEL = "text-embedding-3-large"
+DEFAULT_EMBEDDING_DIM = 512
+
+EMBEDDING_PROVIDERS = ("openai", "ollama", "default", "hash")
+LLM_PROVIDERS = ("deepseek", "ollama")
+
+# 提示词与 notebook 保持一致
+SYSTEM_PROMPT = """
+Human: 你是一个 AI 助手。你能够从提供的上下文段落片段中找到问题的答案。
+"""
+USER_PROMPT_TEMPLATE = """
+请使用以下用 <context> 标签括起来的信息片段来回答用 <question> 标签括起来的问题。最后追加原始回答的中文翻译，并用 <translated>和</translated> 标签标注。
+<context>
+{context}
+</context>
+<question>
+{question}
+</question>
+<translated>
+</translated>
+"""
+
+_THINK_PATTERN = re.compile(r"<think>.*?</think>", re.DOTALL)
+
+
+def build_messages(question: str, context: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": USER_PROMPT_TEMPLATE.format(context=context, question=question)},
+    ]
+
+
+# ---------------------------------------------------------------------------
+# 客户端与模型：按配置创建一次，进程内复用
+# ---------------------------------------------------------------------------
+
+_milvus_clients: Dict[str, object] = {}
+_milvus_lock = threading.Lock()
+
+
+def get_milvus_client(uri: Optional[str] = None, token: Optional[str] = None):
+    """返回按 uri 共享的 MilvusClient；uri 默认取环境变量 RAG_MILVUS_URI（pymilvus 导入时自己会读取 MILVUS_URI，且不接受本地文件路径）"""
+    uri = uri or os.environ.get("RAG_MILVUS_URI", DEFAULT_MILVUS_URI)
+    client = _milvus_clients.get(uri)
+    if client is None:
+        with _milvus_lock:
+            client = _milvus_clients.get(uri)
+            if client is None:
+                from pymilvus import MilvusClient
+
+                token = token or os.environ.get("RAG_MILVUS_TOKEN", "")
+                client = MilvusClient(uri=uri, token=token)
+                _milvus_clients[uri] = client
+    return client
+
+
+def create_embedding_function(provider: Optional[str] = None, dimensions: Optional[int] = None,
+                              model_name: Optional[str] = None):
+    """
+    创建嵌入模型。provider 默认取环境变量 RAG_EMBEDDING：
+
+    - "openai"：OpenAI 兼容接口（milvus_model），Key 与地址取 OPENAI_API_KEY / OPENAI_BASE_URL
+    - "ollama"：本地 Ollama 的 /api/embed，模型取 RAG_EMBEDDING_MODEL，默认 nomic-embed-text
+    - "default"：milvus_model 自带的本地轻量模型
+    - "hash"：确定性的本地哈希嵌入，离线调试和测试用
+    """
+    provider = (provider or os.environ.get("RAG_EMBEDDING", "openai")).lower()
+    if provider not in EMBEDDING_PROVIDERS:
+        raise ValueError(f"不支持的嵌入模型: {provider}，可选 {', '.join(EMBEDDING_PROVIDERS)}")
+    dimensions = dimensions or int(os.environ.get("RAG_EMBEDDING_DIM", DEFAULT_EMBEDDING_DIM))
+    if provider == "hash":
+        return HashEmbeddingFunction(dim=dimensions)
+    if provider == "ollama":
+        return OllamaEmbeddingFunction(
+            model_name or os.environ.get("RAG_EMBEDDING_MODEL", DEFAULT_OLLAMA_EMBEDDING_MODEL)
+        )
+
+    from pymilvus import model as milvus_model
+
+    if provider == "default":
+        return milvus_model.DefaultEmbeddingFunction()
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("未设置 OPENAI_API_KEY 环境变量")
+    kwargs = {"base_url": os.environ["OPENAI_BASE_URL"]} if os.environ.get("OPENAI_BASE_URL") else {}
+    return milvus_model.dense.OpenAIEmbeddingFunction(
+        model_name=model_name or os.environ.get("RAG_EMBEDDING_MODEL", DEFAULT_OPENAI_EMBEDDING_MODEL),
+        api_key=api_key,
+        dimensions=dimensions,
+        **kwargs
+    )
+
+
+def embedding_dimension(embedding_fn) -> int:
+    """嵌入维度：优先读 dim 属性，否则编码一条探测文本"""
+    dim = getattr(embedding_fn, "dim", None)
+    if isinstance(dim, int) and dim > 0:
+        return dim
+    return len(embedding_fn.encode_queries(["dimension probe"])[0])
+
+
+class DeepSeekLLM:
+    """DeepSeek 云端 API（OpenAI 兼容），Key 取 DEEPSEEK_API_KEY"""
+
+    provider = "deepseek"
+
+    def __init__(self, model_name: Optional[str] = None, api_key: Optional[str] = None,
+                 base_url: Optional[str] = None, client=None):
+        self.model_name = model_name or os.environ.get("DEEPSEEK_MODEL", DEFAULT_DEEPSEEK_MODEL)
+        if client is None:
+            api_key = api_key or os.environ.get("DEEPSEEK_API_KEY")
+            if not api_key:
+                raise ValueError("未设置 DEEPSEEK_API_KEY 环境变量")
+            from openai import OpenAI
+
+            client = OpenAI(api_key=api_key,
+                            base_url=base_url or os.environ.get("DEEPSEEK_BASE_URL", DEFAULT_DEEPSEEK_BASE_URL))
+        self.client = client
+
+    def chat(self, messages: List[Dict], **options) -> str:
+        response = self.client.chat.completions.create(model=self.model_name, messages=messages, **options)
+        return response.choices[0].message.content or ""
+
+
+class OllamaLLM:
+    """
+    本地 Ollama 上的 DeepSeek-R1，复用 rednote_ch6_assignment 的 OllamaClient（连接池、重试、熔断）。
+
+    未传入 client 时使用第六章的全局共享客户端，首次调用时才创建；回答中的 <think> 推理过程会被去掉。
+    指定的 model_name 随每次请求传给客户端，不会改动共享客户端的 model_name。
+    """
+
+    provider = "ollama"
+
+    def __init__(self, model_name: Optional[str] = None, client=None, options: Optional[Dict] = None):
+        self._model_name = model_name
+        self._client = client
+        self.options = options
+
+    @property
+    def client(self):
+        if self._client is None:
+            from rednote_ch6_assignment import get_ollama_client
+
+            self._client = get_ollama_client()
+        return self._client
+
+    @property
+    def model_name(self) -> str:
+        if self._model_name is None:
+            self._model_name = self.client.model_name
+        return self._model_name
+
+    def chat(self, messages: List[Dict], **options) -> str:
+        response = self.client.chat_completion(messages, options=dict(self.options or {}, **options) or None,
+                                               model=self._model_name)
+        if "error" in response:
+            raise RuntimeError(f"Ollama 调用失败: {response['error']}")
+        content = response.get("message", {}).get("content", "")
+        return _THINK_PATTERN.sub("", content).strip()
+
+
+def create_llm(provider: Optional[str] = None, model_name: Optional[str] = None):
+    """按 provider（默认取环境变量 RAG_LLM）创建 LLM 后端"""
+    provider = (provider or os.environ.get("RAG_LLM", "deepseek")).lower()
+    if provider == "deepseek":
+        return DeepSeekLLM(model_name)
+    if provider == "ollama":
+        return OllamaLLM(model_name)
+    raise ValueError(f"不支持的 LLM 后端: {provider}，可选 {', '.join(LLM_PROVIDERS)}")
+
+
+# ---------------------------------------------------------------------------
+# 流水线各阶段
+# ---------------------------------------------------------------------------
+
+class Ingestor:
+    """入库：collection 不存在时创建，然后按 manifest 增量同步文档"""
+
+    def __init__(self, milvus_client, collection_name: str, embedding_fn,
+                 manifest_path: str = DEFAULT_MANIFEST,
+                 cache: Union[EmbeddingCache, str, None] = DEFAULT_EMBEDDING_CACHE,
+                 index: Optional[IndexConfig] = None, metric_type: str = "IP",
+                 max_tokens: int = DEFAULT_MAX_TOKENS, overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+                 batch_size: int = DEFAULT_BATCH_SIZE, concurrency: int = DEFAULT_CONCURRENCY):
+        self.milvus_client = milvus_client
+        self.collection_name = collection_name
+        self.embedding_fn = embedding_fn
+        self.manifest_path = manifest_path
+        self.cache = EmbeddingCache(cache) if isinstance(cache, str) else cache
+        self.index = index
+        self.metric_type = metric_type
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._dimension = None
+
+    @property
+    def dimension(self) -> int:
+        if self._dimension is None:
+            self._dimension = embedding_dimension(self.embedding_fn)
+        return self._dimension
+
+    @property
+    def generation(self) -> int:
+        return corpus_generation(self.manifest_path)
+
+    def ensure_collection(self, recreate: bool = False) -> bool:
+        return ensure_collection(self.milvus_client, self.collection_name, self.dimension,
+                                 metric_type=self.metric_type, recreate=recreate, index=self.index)
+
+    def ingest(self, paths=DEFAULT_DOCS, recreate: bool = False) -> Dict:
+        """同步 paths（文件、目录或 glob），返回 sync_index 的统计"""
+        self.ensure_collection(recreate=recreate)
+        return sync_index(self.milvus_client, self.collection_name, paths, self.embedding_fn,
+                          manifest_path=self.manifest_path, cache=self.cache,
+                          max_tokens=self.max_tokens, overlap_tokens=self.overlap_tokens,
+                          batch_size=self.batch_size, concurrency=self.concurrency)
+
+
+class Retriever:
+    """
+    检索：查询向量经 QueryEmbeddingCache 缓存，hybrid=True 时走 BM25 + 向量混合检索并重排，
+    否则只做向量检索。返回的命中统一为 {id, text, score, ...} 字典，score 越大越相似
+    （L2 索引的 score 为距离的相反数）。
+    """
+
+    def __init__(self, milvus_client, collection_name: str, embedding_fn,
+                 index: Optional[IndexConfig] = None, hybrid: bool = True,
+                 candidates: int = DEFAULT_CANDIDATES, consistency_level: Optional[str] = "Bounded",
+                 query_cache_size: int = 1024, query_cache_ttl: Optional[float] = 3600):
+        self.milvus_client = milvus_client
+        self.collection_name = collection_name
+        self.index = index
+        self.metric_type = index.metric_type if index is not None else DEFAULT_METRIC_TYPE
+        self.hybrid = hybrid
+        self.candidates = candidates
+        self.consistency_level = consistency_level
+        self.query_cache = QueryEmbeddingCache(embedding_fn, max_entries=query_cache_size,
+                                               ttl=query_cache_ttl)
+        self._hybrid_retriever = None
+        self._loaded = False
+
+    def load(self):
+        """检索前确保 collection 已加载（新进程打开的 Milvus Lite 数据库中 collection 处于 released 状态）"""
+        if self._loaded:
+            return
+        if not self.milvus_client.has_collection(self.collection_name):
+            raise ValueError(f"collection {self.collection_name} 不存在，请先运行 ingest")
+        self.milvus_client.load_collection(self.collection_name)
+        self._loaded = True
+
+    @property
+    def hybrid_retriever(self) -> HybridRetriever:
+        """首次混合检索时才从 collection 读取 chunk 建 BM25 索引"""
+        if self._hybrid_retriever is None:
+            self.load()
+            retriever = HybridRetriever(self.milvus_client, self.collection_name, self.query_cache,
+                                        index=self.index, candidates=self.candidates,
+                                        consistency_level=self.consistency_level)
+            retriever.reranker = TermOverlapReranker(retriever.bm25)
+            self._hybrid_retriever = retriever
+        return self._hybrid_retriever
+
+    def refresh(self, generation: int):
+        """语料版本变化时清空查询向量缓存并重建 BM25 索引"""
+        if generation == self.query_cache.generation:
+            return
+        self.query_cache.set_generation(generation)
+        if self._hybrid_retriever is not None:
+            self._hybrid_retriever.refresh()
+            self._hybrid_retriever.reranker = TermOverlapReranker(self._hybrid_retriever.bm25)
+
+    def encode(self, question: str) -> List[float]:
+        return self.query_cache.encode([question])[0]
+
+    def retrieve(self, question: str, top_k: int = 3) -> List[Dict]:
+        self.load()
+        if self.hybrid:
+            return self.hybrid_retriever.search(question, top_k=top_k)
+        results = search_collection(self.milvus_client, self.collection_name, [self.encode(question)],
+                                    limit=top_k, index=self.index,
+                                    consistency_level=self.consistency_level)
+        return [{"id": hit["id"], "text": hit.get("entity", {}).get("text", ""),
+                 "score": similarity_score(hit["distance"], self.metric_type)} for hit in results[0]]
+
+    def retrieve_batch(self, questions: Sequence[str], top_k: int = 3,
+                       batch_size: int = DEFAULT_QUERY_BATCH_SIZE) -> List[List[Dict]]:
+        self.load()
+        if self.hybrid:
+            return self.hybrid_retriever.search_batch(questions, top_k=top_k, batch_size=batch_size)
+        hits = retrieve_batch(self.milvus_client, self.collection_name, questions, self.query_cache,
+                              top_k=top_k, batch_size=batch_size, index=self.index,
+                              consistency_level=self.consistency_level)
+        return [[{"id": doc_id, "text": entity.get("text", ""),
+                  "score": similarity_score(distance, self.metric_type)}
+                 for doc_id, distance, entity in hits.hits(i)] for i in range(len(hits))]
+
+
+class Answerer:
+    """
+    问答：检索 → 按模型预算组装上下文 → 调用 LLM。
+
+    传入 answer_cache（SemanticAnswerCache）时，相似问题直接返回缓存的答案。
+    """
+
+    def __init__(self, retriever: Retriever, llm, top_k: int = 3,
+                 context_tokens: Optional[int] = None,
+                 answer_cache: Optional[SemanticAnswerCache] = None):
+        self.retriever = retriever
+        self.llm = llm
+        self.top_k = top_k
+        self.context_tokens = context_tokens
+        self.answer_cache = answer_cache
+
+    def answer(self, question: str, top_k: Optional[int] = None) -> Dict:
+        """
+        返回 {"question", "answer", "hits", "context_tokens", "cached", "timings"}。
+
+        timings 为各阶段耗时（秒）：embed、retrieve、generate 与 total，命中答案缓存时只有 embed 与 total。
+        """
+        started = time.perf_counter()
+        # 先单独嵌入问题（结果进入查询向量缓存，检索时直接命中），以便分别统计嵌入与检索耗时
+        query_vector = self.retriever.encode(question)
+        timings = {"embed": time.perf_counter() - started}
+        if self.answer_cache is not None:
+            cached = self.answer_cache.lookup(query_vector)
+            if cached is not None:
+                timings["total"] = time.perf_counter() - started
+                return {"question": question, "answer": cached["answer"], "hits": [],
+                        "context_tokens": 0, "cached": True, "timings": timings}
+
+        retrieve_started = time.perf_counter()
+        hits = self.retriever.retrieve(question, top_k=top_k or self.top_k)
+        timings["retrieve"] = time.perf_counter() - retrieve_started
+        context = build_context(hits, max_tokens=self.context_tokens or context_budget(self.llm.model_name))
+
+        generate_started = time.perf_counter()
+        answer = self.llm.chat(build_messages(question, context["context"]))
+        timings["generate"] = time.perf_counter() - generate_started
+        if self.answer_cache is not None:
+            self.answer_cache.store(question, query_vector, answer)
+        timings["total"] = time.perf_counter() - started
+        return {"question": question, "answer": answer, "hits": hits,
+                "context_tokens": context["tokens"], "cached": False, "timings": timings}
+
+
+class RAGPipeline:
+    """
+    组合 Ingestor / Retriever / Answerer。
+
+    LLM 在第一次问答时才创建，只做入库或检索时不需要 API Key。
+    """
+
+    def __init__(self, ingestor: Ingestor, retriever: Retriever, llm=None,
+                 llm_provider: Optional[str] = None, llm_model: Optional[str] = None,
+                 top_k: int = 3, answer_cache: bool = False):
+        self.ingestor = ingestor
+        self.retriever = retriever
+        self.top_k = top_k
+        self._llm = llm
+        self._llm_provider = llm_provider
+        self._llm_model = llm_model
+        self._use_answer_cache = answer_cache
+        self._answerer = None
+        self.refresh()
+
+    @classmethod
+    def from_env(cls, uri: Optional[str] = None, collection_name: Optional[str] = None,
+                 embedding: Optional[str] = None, llm: Optional[str] = None,
+                 llm_model: Optional[str] = None, index: Optional[IndexConfig] = None,
+                 hybrid: bool = True, manifest_path: str = DEFAULT_MANIFEST,
+                 embedding_cache: Optional[str] = DEFAULT_EMBEDDING_CACHE,
+                 top_k: int = 3, answer_cache: bool = False) -> "RAGPipeline":
+        """按参数和环境变量（RAG_MILVUS_URI、RAG_COLLECTION、RAG_EMBEDDING、RAG_LLM 等）组装流水线"""
+        milvus_client = get_milvus_client(uri)
+        collection_name = collection_name or os.environ.get("RAG_COLLECTION", DEFAULT_COLLECTION)
+        embedding_fn = create_embedding_function(embedding)
+        ingestor = Ingestor(milvus_client, collection_name, embedding_fn, manifest_path=manifest_path,
+                            cache=embedding_cache, index=index)
+        retriever = Retriever(milvus_client, collection_name, embedding_fn, index=index, hybrid=hybrid)
+        return cls(ingestor, retriever, llm_provider=llm, llm_model=llm_model,
+                   top_k=top_k, answer_cache=answer_cache)
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            self._llm = create_llm(self._llm_provider, self._llm_model)
+        return self._llm
+
+    @property
+    def answerer(self) -> Answerer:
+        if self._answerer is None:
+            answer_cache = None
+            if self._use_answer_cache:
+                answer_cache = SemanticAnswerCache(
+                    self.ingestor.milvus_client, self.ingestor.dimension,
+                    namespace=f"{self.llm.provider}:{self.llm.model_name}",
+                    generation=self.ingestor.generation,
+                )
+            self._answerer = Answerer(self.retriever, self.llm, top_k=self.top_k,
+                                      answer_cache=answer_cache)
+        return self._answerer
+
+    def refresh(self):
+        """按 manifest 中的语料版本刷新检索侧缓存"""
+        generation = self.ingestor.generation
+        self.retriever.refresh(generation)
+        if self._answerer is not None and self._answerer.answer_cache is not None:
+            self._answerer.answer_cache.set_generation(generation)
+
+    def ingest(self, paths=DEFAULT_DOCS, recreate: bool = False) -> Dict:
+        stats = self.ingestor.ingest(paths, recreate=recreate)
+        self.refresh()
+        return stats
+
+    def retrieve(self, question: str, top_k: Optional[int] = None) -> List[Dict]:
+        return self.retriever.retrieve(question, top_k=top_k or self.top_k)
+
+    def query(self, question: str, top_k: Optional[int] = None) -> Dict:
+        return self.answerer.answer(question, top_k=top_k)
+
+
+_pipeline_lock = threading.Lock()
+_pipelines: Dict[tuple, RAGPipeline] = {}
+
+
+def get_pipeline(**kwargs) -> RAGPipeline:
+    """返回按参数共享的 RAGPipeline，同一进程内多次调用复用同一套客户端和模型"""
+    key = tuple(sorted((name, repr(value)) for name, value in kwargs.items()))
+    pipeline = _pipelines.get(key)
+    if pipeline is None:
+        with _pipeline_lock:
+            pipeline = _pipelines.get(key)
+            if pipeline is None:
+                pipeline = RAGPipeline.from_env(**kwargs)
+                _pipelines[key] = pipeline
+    return pipeline
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+RAG 问题的两级缓存
+
+- QueryEmbeddingCache：规范化后的问题 → 查询向量的精确匹配 LRU，重复问题不再请求嵌入服务
+- SemanticAnswerCache：以独立的 Milvus collection 存储「问题向量 → 答案」，
+  新问题与已缓存问题的余弦相似度超过阈值时直接返回已有答案，跳过检索和 LLM 调用
+
+两级缓存都有 TTL，并以语料的 generation（见 rag.sync.sync_index）为版本：
+重新索引导致 generation 变化时，旧条目全部失效。
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from rag.collection import ensure_collection
+from rag.sync import load_manifest
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.92
+ANSWER_CACHE_COLLECTION = "rag_answer_cache"
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?？!！。.,，]+$")
+
+
+def normalize_question(question: str) -> str:
+    """NFKC 规范化、小写、合并空白并去掉句末标点，使仅格式不同的问题命中同一条缓存"""
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = " ".join(text.split())
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+def corpus_generation(manifest_path: str) -> int:
+    """读取索引 manifest 中的语料版本号"""
+    return load_manifest(manifest_path).get("generation", 0)
+
+
+class _LRUCache:
+    """线程安全的内存 LRU，条目写入 ttl 秒后过期（ttl=None 表示永不过期）"""
+
+    def __init__(self, max_entries: int, ttl: Optional[float]):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0, "size": len(self._data)}
+
+
+class QueryEmbeddingCache:
+    """
+    查询向量的精确匹配缓存（第一级）。
+
+    encode() 与嵌入函数的 encode_queries 用法相同，只把未命中的问题批量发给嵌入模型。
+    缓存只服务于构造时传入的 embedding_fn，更换嵌入模型时请新建一个实例。
+    """
+
+    def __init__(self, embedding_fn, max_entries: int = 1024, ttl: Optional[float] = 3600):
+        self.embedding_fn = embedding_fn
+        self.generation = None
+        self._cache = _LRUCache(max_entries=max_entries, ttl=ttl)
+
+    def set_generation(self, generation: int):
+        """语料重新索引后调用；版本号变化时清空缓存"""
+        if generation != self.generation:
+            self._cache.clear()
+            self.generation = generation
+
+    def encode(self, questions: List[str]) -> List[List[float]]:
+        keys = [normalize_question(q) for q in questions]
+        vectors = [self._cache.get(key) for key in keys]
+        missing = {}
+        for i, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            fresh = self.embedding_fn.encode_queries(list(missing))
+            for (key, positions), vector in zip(missing.items(), fresh):
+                vector = [float(v) for v in vector]
+                self._cache.set(key, vector)
+                for i in positions:
+                    vectors[i] = vector
+        return vectors
+
+    def encode_queries(self, questions: List[str]) -> List[List[float]]:
+        return self.encode(questions)
+
+    def stats(self) -> Dict:
+        return self._cache.stats()
+
+    def clear(self):
+        self._cache.clear()
+
+
+class SemanticAnswerCache:
+    """
+    基于 Milvus 的语义答案缓存（第二级）。
+
+    每条记录包含问题向量、原问题、答案、写入时间、语料版本和命名空间（如 LLM 模型名），
+    查找时只在同一命名空间、同一语料版本且未过期的记录中检索最相似的一条。
+    """
+
+    def __init__(self, milvus_client, dimension: int,
+                 collection_name: str = ANSWER_CACHE_COLLECTION,
+                 threshold: float = DEFAULT_SIMILARITY_THRESHOLD, ttl: Optional[float] = 86400,
+                 namespace: str = "default", generation: int = 0):
+        self.milvus_client = milvus_client
+        self.collection_name = collection_name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.namespace = namespace
+        self.generation = generation
+        self.hits = 0
+        self.misses = 0
+        ensure_collection(milvus_client, collection_name, dimension,
+                          metric_type="COSINE", consistency_level="Session")
+
+    def _filter(self) -> str:
+        conditions = [f"namespace == {json.dumps(self.namespace)}",
+                      f"generation == {int(self.generation)}"]
+        if self.ttl is not None:
+            conditions.append(f"created_at >= {time.time() - self.ttl:.3f}")
+        return " and ".join(conditions)
+
+    def _entry_id(self, question: str) -> int:
+        key = f"{self.namespace}\0{self.generation}\0{normalize_question(question)}"
+        return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+    def set_generation(self, generation: int) -> int:
+        """语料版本变化时删除旧版本的全部条目，返回删除数量"""
+        if generation == self.generation:
+            return 0
+        self.generation = generation
+        result = self.milvus_client.delete(
+            collection_name=self.collection_name,
+            filter=f"namespace == {json.dumps(self.namespace)} and generation != {int(generation)}"
+        )
+        return result.get("delete_count", 0) if isinstance(result, dict) else len(result)
+
+    def lookup(self, query_vector: List[float]) -> Optional[Dict]:
+        """返回 {"answer", "question", "score"}；没有足够相似的缓存时返回 None"""
+        results = self.milvus_client.search(
+            collection_name=self.collection_name,
+            data=[query_vector],
+            limit=1,
+            filter=self._filter(),
+            search_params={"metric_type": "COSINE", "params": {}},
+            output_fields=["question", "answer"],
+        )
+        if results and results[0] and results[0][0]["distance"] >= self.threshold:
+            hit = results[0][0]
+            self.hits += 1
+            return {"answer": hit["entity"]["answer"], "question": hit["entity"]["question"],
+                    "score": hit["distance"]}
+        self.misses += 1
+        return None
+
+    def store(self, question: str, query_vector: List[float], answer: str):
+        self.milvus_client.upsert(collection_name=self.collection_name, data=[{
+            "id": self._entry_id(question),
+            "vector": list(query_vector),
+            "question": question,
+            "answer": answer,
+            "namespace": self.namespace,
+            "generation": int(self.generation),
+            "created_at": time.time(),
+        }])
+
+    def purge_expired(self):
+        """删除已过期的条目（查找时已经会忽略它们，这里只是回收空间）"""
+        if self.ttl is not None:
+            self.milvus_client.delete(collection_name=self.collection_name,
+                                      filter=f"created_at < {time.time() - self.ttl:.3f}")
+
+    def clear(self):
+        self.milvus_client.delete(collection_name=self.collection_name,
+                                  filter=f"namespace == {json.dumps(self.namespace)}")
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
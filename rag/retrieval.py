@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+批量检索
+
+retrieve_batch 把成批的问题按 batch_size 分组：每组一次嵌入请求、一次 Milvus search，
+并在搜索当前组时预取下一组的嵌入。结果以紧凑的 numpy 数组返回，适合离线评测和批量问答。
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from rag.collection import IndexConfig, search_collection
+
+DEFAULT_QUERY_BATCH_SIZE = 32
+
+
+class BatchHits:
+    """
+    批量检索结果。
+
+    ids / distances 形状为 (问题数, top_k)，不足 top_k 的位置 id 为 -1、距离为 NaN；
+    entities 按 id 去重保存输出字段，多个问题命中同一 chunk 时只存一份。
+    """
+
+    def __init__(self, ids: np.ndarray, distances: np.ndarray, entities: Dict[int, Dict]):
+        self.ids = ids
+        self.distances = distances
+        self.entities = entities
+
+    def __len__(self):
+        return len(self.ids)
+
+    def hits(self, index: int) -> List[Tuple[int, float, Dict]]:
+        """第 index 个问题的命中列表 [(id, distance, entity), ...]"""
+        return [(int(i), float(d), self.entities.get(int(i), {}))
+                for i, d in zip(self.ids[index], self.distances[index]) if i >= 0]
+
+    def texts(self, index: int, field: str = "text") -> List[str]:
+        return [entity.get(field, "") for _, _, entity in self.hits(index)]
+
+
+def retrieve_batch(milvus_client, collection_name: str, questions: Sequence[str], embedding_fn,
+                   top_k: int = 3, batch_size: int = DEFAULT_QUERY_BATCH_SIZE,
+                   index: Optional[IndexConfig] = None, consistency_level: Optional[str] = "Bounded",
+                   output_fields: Sequence[str] = ("text",), **search_overrides) -> BatchHits:
+    """
+    批量检索 questions，返回 BatchHits。
+
+    embedding_fn 需要提供 encode_queries（可直接传入 QueryEmbeddingCache 复用查询向量缓存）。
+    """
+    total = len(questions)
+    ids = np.full((total, top_k), -1, dtype=np.int64)
+    distances = np.full((total, top_k), np.nan, dtype=np.float32)
+    entities: Dict[int, Dict] = {}
+    starts = list(range(0, total, max(1, batch_size)))
+
+    def embed(start):
+        return embedding_fn.encode_queries(list(questions[start:start + batch_size]))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(embed, starts[0]) if starts else None
+        for position, start in enumerate(starts):
+            vectors = pending.result()
+            if position + 1 < len(starts):
+                pending = executor.submit(embed, starts[position + 1])
+            results = search_collection(milvus_client, collection_name, vectors, limit=top_k,
+                                        index=index, consistency_level=consistency_level,
+                                        output_fields=output_fields, **search_overrides)
+            for offset, row in enumerate(results):
+                for rank, hit in enumerate(row[:top_k]):
+                    ids[start + offset, rank] = hit["id"]
+                    distances[start + offset, rank] = hit["distance"]
+                    if output_fields:
+                        entities.setdefault(hit["id"], hit.get("entity", {}))
+    return BatchHits(ids, distances, entities)
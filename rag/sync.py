@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+增量、幂等的索引同步
+
+- chunk 主键由 (来源文件相对 manifest 所在目录的路径, 文本) 的哈希得到，内容不变 id 就不变；
+  不同目录下的同名文件互不覆盖，从哪个工作目录运行同步都得到相同的 id
+- manifest 记录每个已入库文件的 mtime、大小、内容哈希和 chunk id
+- 同步时 mtime 与大小都未变的文件直接跳过，内容变化的文件只 upsert 新 chunk、删除消失的 chunk，
+  已删除的文件清理其全部 chunk，刷新语料的代价与改动量成正比
+- 各步骤都可以重复执行：中途失败后重新同步即可恢复一致
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, Optional, Union
+
+from rag.chunking import DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP_TOKENS, _expand_paths, chunk_markdown
+from rag.embedding import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    EmbeddingCache,
+    embedding_model_name,
+    ingest_chunks,
+)
+
+# 版本 1 的 chunk id 与 source 只按文件名计算，读到旧 manifest 时全部重新入库并删除旧 id
+MANIFEST_VERSION = 2
+
+
+def chunk_id(source: str, text: str) -> int:
+    """由来源和文本计算稳定的 INT64 主键（取 sha256 前 8 字节并去掉符号位）"""
+    digest = hashlib.sha256(f"{source}\0{text}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def source_key(path: str, root: str) -> str:
+    """文件相对 root 的路径（统一使用 / 分隔），作为 manifest 键与 chunk 的 source；
+    跨盘符等无法求相对路径时退回绝对路径"""
+    path = os.path.abspath(path)
+    try:
+        path = os.path.relpath(path, root)
+    except ValueError:
+        pass
+    return path.replace(os.sep, "/")
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(path: str) -> Dict:
+    """读取 manifest，不存在或损坏时返回空 manifest"""
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        if manifest.get("version") in (1, MANIFEST_VERSION):
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "generation": 0, "files": {}}
+
+
+def save_manifest(manifest: Dict, path: str):
+    """先写临时文件再原子替换，避免中断时留下半个 manifest"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _file_chunks(path: str, source: str, max_tokens: int, overlap_tokens: int) -> Dict[int, Dict]:
+    """切块并按内容哈希编号；同一文件内完全相同的 chunk 只保留一个"""
+    chunks = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for chunk in chunk_markdown(file, source=source, max_tokens=max_tokens,
+                                    overlap_tokens=overlap_tokens):
+            chunk["id"] = chunk_id(source, chunk["text"])
+            chunks.setdefault(chunk["id"], chunk)
+    return chunks
+
+
+def sync_index(milvus_client, collection_name: str, paths: Union[str, Iterable[str]],
+               embedding_fn, manifest_path: str, cache: Optional[EmbeddingCache] = None,
+               max_tokens: int = DEFAULT_MAX_TOKENS, overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+               batch_size: int = DEFAULT_BATCH_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+               model_name: Optional[str] = None) -> Dict:
+    """
+    把 paths 指向的 Markdown 文件增量同步到 collection，返回本次同步的统计。
+
+    文件以相对 manifest 所在目录的路径记录，因此同一个 manifest 从任何工作目录同步结果都一致。
+
+    collection 需要已存在（见 rag.collection.ensure_collection）。manifest 中记录的嵌入模型
+    与本次不同时，所有文件都按已改动处理，用新模型的向量覆盖旧向量。
+    若 collection 为空而 manifest 非空（例如 collection 被手动删除重建），同样全部重新入库。
+    """
+    model_name = model_name or embedding_model_name(embedding_fn)
+    manifest = load_manifest(manifest_path)
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    chunk_params = {"max_tokens": max_tokens, "overlap_tokens": overlap_tokens}
+    full_rebuild = (
+        manifest.get("version") != MANIFEST_VERSION
+        or manifest.get("model") != model_name
+        or manifest.get("collection") != collection_name
+        or manifest.get("chunking") != chunk_params
+        or (manifest["files"] and _collection_is_empty(milvus_client, collection_name))
+    )
+    old_files = manifest["files"]
+    new_files = {}
+    stats = {"files": 0, "changed_files": 0, "removed_files": 0,
+             "upserted": 0, "deleted": 0, "embedded": 0}
+
+    for path in _expand_paths(paths):
+        source = source_key(path, root)
+        stat = os.stat(path)
+        entry = old_files.get(source)
+        reusable = entry is not None and not full_rebuild
+        stats["files"] += 1
+        if reusable and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            new_files[source] = entry
+            continue
+
+        sha256 = file_sha256(path)
+        if reusable and entry["sha256"] == sha256:
+            # 只是被 touch 过，内容没变
+            new_files[source] = dict(entry, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            continue
+
+        chunks = _file_chunks(path, source, max_tokens, overlap_tokens)
+        old_ids = set(entry["ids"]) if entry else set()
+        added = [chunk for chunk_id_, chunk in chunks.items()
+                 if full_rebuild or chunk_id_ not in old_ids]
+        removed = sorted(old_ids - set(chunks))
+        if added:
+            result = ingest_chunks(milvus_client, collection_name, added, embedding_fn,
+                                   batch_size=batch_size, concurrency=concurrency, cache=cache,
+                                   model_name=model_name, upsert=True)
+            stats["upserted"] += result["chunks"]
+            stats["embedded"] += result["embedded"]
+        if removed:
+            milvus_client.delete(collection_name=collection_name, ids=removed)
+            stats["deleted"] += len(removed)
+        stats["changed_files"] += 1
+        new_files[source] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": sha256,
+            "ids": sorted(chunks),
+        }
+
+    for source, entry in old_files.items():
+        if source not in new_files:
+            if entry["ids"]:
+                milvus_client.delete(collection_name=collection_name, ids=entry["ids"])
+            stats["removed_files"] += 1
+            stats["deleted"] += len(entry["ids"])
+
+    generation = manifest.get("generation", 0)
+    if full_rebuild or stats["upserted"] or stats["deleted"]:
+        generation += 1
+    save_manifest({
+        "version": MANIFEST_VERSION,
+        "generation": generation,
+        "collection": collection_name,
+        "model": model_name,
+        "chunking": chunk_params,
+        "files": new_files,
+    }, manifest_path)
+    stats["generation"] = generation
+    return stats
+
+
+def _collection_is_empty(milvus_client, collection_name: str) -> bool:
+    stats = milvus_client.get_collection_stats(collection_name)
+    return int(stats.get("row_count", 0)) == 0
+
@@ -20,99 +20,1282 @@
 日期：2025年8月
 """
 
+import bisect
+import contextvars
+import csv
+import hashlib
+import heapq
+import io
+import logging
 import os
-import requests
 import json
+import mmap
+import random
 import re
-from typing import Dict, List, Optional
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional
 
-print("🔧 第六章作业环境准备中...")
-print("✅ 导入必要的 Python 库完成！")
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+# HTTP 库在首次创建客户端时才导入（requests 导入本身就要上百毫秒），
+# 使只用到产品目录、提示词或格式化函数的进程可以毫秒级导入本模块；
+# 可选依赖 httpx 仅 AsyncOllamaClient 需要
+requests = None
+httpx = None
+
+def _import_requests():
+    global requests
+    if requests is None:
+        import requests as requests_module
+        import requests.adapters  # noqa: F401  HTTPAdapter 所在子模块
+        requests = requests_module
+    return requests
+
+def _import_httpx():
+    global httpx
+    if httpx is None:
+        try:
+            import httpx as httpx_module
+        except ImportError:
+            raise ImportError("AsyncOllamaClient 需要 httpx，请先运行: pip install httpx") from None
+        httpx = httpx_module
+    return httpx
+
+# 模型在 Ollama 中的驻留时间与上下文窗口。每次请求都带上相同的值：空闲超时卸载后重新加载要几十秒，
+# 而 num_ctx 一旦变化 Ollama 就会重新加载模型并丢弃提示缓存
+DEFAULT_KEEP_ALIVE = "30m"
+DEFAULT_NUM_CTX = 8192
+
+def default_keep_alive() -> str:
+    """请求中的 keep_alive，可用环境变量 OLLAMA_KEEP_ALIVE 覆盖（如 "1h"、"-1" 表示常驻）"""
+    return os.environ.get("OLLAMA_KEEP_ALIVE", DEFAULT_KEEP_ALIVE)
+
+def default_num_ctx() -> int:
+    """Agent 请求的上下文窗口，可用环境变量 OLLAMA_NUM_CTX 覆盖"""
+    try:
+        return max(512, int(os.environ.get("OLLAMA_NUM_CTX", DEFAULT_NUM_CTX)))
+    except ValueError:
+        return DEFAULT_NUM_CTX
+
+# ---- 可观测性：结构化日志、指标与调用链 ----
+# 库代码只写日志，不直接 print；命令行入口 main() 才配置输出格式
+logger = logging.getLogger("rednote_ch6")
+
+# 时长直方图的桶边界（秒）：覆盖从毫秒级的工具调用到 CPU 上几分钟的生成
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 生成速度直方图的桶边界（tokens/秒）
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+
+def _label_key(labelnames: tuple, labels: Dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames: tuple, key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    """单调递增的计数器，按标签分组"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+    
+    def value(self, **labels) -> float:
+        return self.values.get(_label_key(self.labelnames, labels), 0.0)
+    
+    def samples(self) -> List[tuple]:
+        """[(指标名后缀, 标签键, 附加标签, 值)]"""
+        with self._lock:
+            return [("", key, "", value) for key, value in sorted(self.values.items())]
+
+class Histogram:
+    """按标签分组的直方图，记录各桶计数、总和与样本数"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+    
+    def series(self, **labels) -> Optional[Dict]:
+        return self.values.get(_label_key(self.labelnames, labels))
+    
+    def samples(self) -> List[tuple]:
+        samples = []
+        with self._lock:
+            for key, series in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                    cumulative += count
+                    samples.append(("_bucket", key, f'le="{_format_number(bound)}"', cumulative))
+                samples.append(("_sum", key, "", series["sum"]))
+                samples.append(("_count", key, "", series["count"]))
+        return samples
+
+class Span:
+    """
+    一段计时操作，字段与 OpenTelemetry 的 span 对应。
+    
+    通过 Telemetry.span() 创建时自动成为当前 span 并在退出时结束；
+    Telemetry.start_span() 创建的 span 不改变当前上下文，适合跨越多次 yield 的流式调用，需手动 end()。
+    """
+    
+    def __init__(self, telemetry: "Telemetry", name: str, parent: Optional["Span"], kind: str, attributes: Dict):
+        self.telemetry = telemetry
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self._started = time.perf_counter()
+    
+    @property
+    def duration(self) -> float:
+        """已结束的 span 返回总时长，未结束的返回到目前为止的时长（秒）"""
+        if self.end_ns is not None:
+            return (self.end_ns - self.start_ns) / 1e9
+        return time.perf_counter() - self._started
+    
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+    
+    def end(self, error: Optional[str] = None):
+        if self.end_ns is not None:
+            return
+        if error is not None:
+            self.error = error
+        self.end_ns = self.start_ns + int((time.perf_counter() - self._started) * 1e9)
+        self.telemetry._finish(self)
+    
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "duration": round(self.duration, 6),
+            "attributes": dict(self.attributes),
+            "error": self.error,
+        }
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+class Telemetry:
+    """
+    进程内的指标注册表与 span 收集器。
+    
+    - 指标：render_prometheus() 输出 Prometheus 文本格式，可由 start_metrics_server() 暴露为 /metrics
+    - 调用链：结束的 span 保存在容量为 max_spans 的环形缓冲中，
+      otlp_traces() / otlp_metrics() 生成 OTLP/JSON 请求体，export_otlp() 推送到 OpenTelemetry Collector
+    - 当前 span 保存在 contextvars 中：线程池任务需要 contextvars.copy_context() 传递，
+      asyncio.to_thread 会自动传递
+    """
+    
+    SERVICE_NAME = "rednote-ch6"
+    
+    def __init__(self, max_spans: int = 2048):
+        self.metrics: Dict[str, object] = {}
+        self.spans = deque(maxlen=max_spans)
+        self.start_ns = time.time_ns()
+        self._current = contextvars.ContextVar(f"rednote_span_{id(self)}", default=None)
+        self._lock = threading.Lock()
+        
+        self.llm_requests = self.counter("rednote_llm_requests_total", "Ollama /api/chat 请求数",
+                                         ("model", "stream", "status"))
+        self.llm_seconds = self.histogram("rednote_llm_request_seconds", "客户端测得的 /api/chat 耗时",
+                                          ("model", "stream"))
+        self.llm_stage_seconds = self.histogram("rednote_llm_stage_seconds",
+                                                "Ollama 报告的各阶段耗时（load / prompt_eval / eval）",
+                                                ("model", "stage"))
+        self.llm_tokens = self.counter("rednote_llm_tokens_total", "提示与生成的 token 数",
+                                       ("model", "kind"))
+        self.llm_tokens_per_second = self.histogram("rednote_llm_tokens_per_second", "各阶段的 token 吞吐",
+                                                     ("model", "stage"), buckets=TOKENS_PER_SECOND_BUCKETS)
+        self.llm_retries = self.counter("rednote_llm_retries_total", "Ollama 请求重试次数", ("reason",))
+        self.tool_calls = self.counter("rednote_tool_calls_total", "工具调用次数", ("tool", "status"))
+        self.tool_seconds = self.histogram("rednote_tool_call_seconds", "工具调用耗时", ("tool",))
+        self.agent_iterations = self.counter("rednote_agent_iterations_total", "Agent 循环迭代次数",
+                                             ("outcome",))
+        self.agent_runs = self.counter("rednote_agent_runs_total", "文案生成次数", ("outcome",))
+        self.agent_seconds = self.histogram("rednote_agent_run_seconds", "一次文案生成的总耗时", ("outcome",))
+        self.cache_requests = self.counter("rednote_cache_requests_total", "文案缓存查询次数", ("result",))
+    
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+    
+    def _register(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+    
+    # ---- span ----
+    
+    def current_span(self) -> Optional[Span]:
+        return self._current.get()
+    
+    def start_span(self, name: str, kind: str = "internal", **attributes) -> Span:
+        return Span(self, name, self._current.get(), kind, attributes)
+    
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", **attributes):
+        span = self.start_span(name, kind, **attributes)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = span.error or f"{e.__class__.__name__}: {e}"
+            raise
+        finally:
+            self._current.reset(token)
+            span.end()
+    
+    def _finish(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+        logger.debug("span %s %.3fs %s", span.name, span.duration, span.attributes)
+    
+    def snapshot_spans(self) -> List[Span]:
+        """复制当前缓冲中的 span；工作线程随时在追加，不能直接遍历 deque"""
+        with self._lock:
+            return list(self.spans)
+    
+    def drain_spans(self) -> List[Span]:
+        """取出并清空已结束的 span（导出后调用，避免重复上报）"""
+        with self._lock:
+            spans = list(self.spans)
+            self.spans.clear()
+        return spans
+    
+    # ---- 记录 ----
+    
+    def record_chat(self, model: str, stream: bool, elapsed: float, response: Optional[Dict],
+                    span: Optional[Span] = None):
+        """记录一次 /api/chat 调用：客户端耗时以及响应中 Ollama 报告的阶段耗时与 token 数"""
+        response = response or {}
+        status = "error" if "error" in response else ("early_stop" if response.get("early_stop") else "ok")
+        stream_label = "true" if stream else "false"
+        self.llm_requests.inc(model=model, stream=stream_label, status=status)
+        self.llm_seconds.observe(elapsed, model=model, stream=stream_label)
+        
+        stages = {stage: response[f"{stage}_duration"] / 1e9
+                  for stage in ("load", "prompt_eval", "eval") if response.get(f"{stage}_duration")}
+        for stage, seconds in stages.items():
+            self.llm_stage_seconds.observe(seconds, model=model, stage=stage)
+        tokens = {"prompt": response.get("prompt_eval_count"), "completion": response.get("eval_count")}
+        for kind, count in tokens.items():
+            if count:
+                self.llm_tokens.inc(count, model=model, kind=kind)
+        for stage, kind in (("prompt_eval", "prompt"), ("eval", "completion")):
+            if tokens[kind] and stages.get(stage):
+                self.llm_tokens_per_second.observe(tokens[kind] / stages[stage], model=model, stage=stage)
+        
+        if span is not None:
+            span.set(status=status, prompt_tokens=tokens["prompt"], completion_tokens=tokens["completion"],
+                     **{f"{stage}_seconds": round(seconds, 6) for stage, seconds in stages.items()})
+            if status == "error":
+                span.error = str(response["error"])
+    
+    def record_retry(self, reason: str):
+        """记录一次重试，同时累加到当前 span 的 retries 属性"""
+        self.llm_retries.inc(reason=reason)
+        span = self._current.get()
+        if span is not None:
+            span.set(retries=span.attributes.get("retries", 0) + 1)
+    
+    def summary(self) -> Dict:
+        """汇总的派生指标：请求数、各阶段总耗时、平均生成速度与文案缓存命中率"""
+        stage_totals = {}
+        for key, series in self.llm_stage_seconds.values.items():
+            stage = key[1]
+            stage_totals[stage] = stage_totals.get(stage, 0.0) + series["sum"]
+        completion_tokens = sum(value for key, value in self.llm_tokens.values.items() if key[1] == "completion")
+        prompt_tokens = sum(value for key, value in self.llm_tokens.values.items() if key[1] == "prompt")
+        hits = self.cache_requests.value(result="hit")
+        lookups = hits + self.cache_requests.value(result="miss")
+        return {
+            "llm_requests": int(sum(self.llm_requests.values.values())),
+            "retries": int(sum(self.llm_retries.values.values())),
+            "tool_calls": int(sum(self.tool_calls.values.values())),
+            "prompt_tokens": int(prompt_tokens),
+            "completion_tokens": int(completion_tokens),
+            "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stage_totals.items()},
+            "prompt_tokens_per_second": (round(prompt_tokens / stage_totals["prompt_eval"], 1)
+                                         if stage_totals.get("prompt_eval") else None),
+            "completion_tokens_per_second": (round(completion_tokens / stage_totals["eval"], 1)
+                                             if stage_totals.get("eval") else None),
+            "cache_hit_rate": hits / lookups if lookups else None,
+        }
+    
+    def reset(self):
+        """清空全部指标与 span（测试与基准测试之间使用）"""
+        with self._lock:
+            for metric in self.metrics.values():
+                with metric._lock:
+                    metric.values.clear()
+            self.spans.clear()
+            self.start_ns = time.time_ns()
+    
+    # ---- 导出 ----
+    
+    def render_prometheus(self) -> str:
+        """Prometheus 文本格式（version 0.0.4）"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, key, extra, value in metric.samples():
+                labels = _format_labels(metric.labelnames, key, extra)
+                lines.append(f"{metric.name}{suffix}{labels} {_format_number(value)}")
+        cache = rednote_cache
+        if cache is not None:
+            lines.append("# HELP rednote_cache_entries 文案缓存中的条目数")
+            lines.append("# TYPE rednote_cache_entries gauge")
+            lines.append(f"rednote_cache_entries {len(cache)}")
+        return "\n".join(lines) + "\n"
+    
+    def _otlp_resource(self) -> Dict:
+        return {"attributes": _otlp_attributes({"service.name": self.SERVICE_NAME})}
+    
+    def otlp_traces(self, spans: Optional[List[Span]] = None) -> Dict:
+        """OTLP/JSON 格式的 ExportTraceServiceRequest；未指定 spans 时导出缓冲中的全部 span"""
+        spans = self.snapshot_spans() if spans is None else spans
+        kinds = {"internal": 1, "server": 2, "client": 3}
+        return {"resourceSpans": [{
+            "resource": self._otlp_resource(),
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                    "name": span.name,
+                    "kind": kinds.get(span.kind, 1),
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": _otlp_attributes(span.attributes),
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                } for span in spans if span.end_ns is not None],
+            }],
+        }]}
+    
+    def otlp_metrics(self) -> Dict:
+        """OTLP/JSON 格式的 ExportMetricsServiceRequest（累计值）"""
+        now, start = str(time.time_ns()), str(self.start_ns)
+        metrics = []
+        for metric in self.metrics.values():
+            with metric._lock:
+                items = sorted(metric.values.items())
+            points = []
+            for key, value in items:
+                point = {"attributes": _otlp_attributes(dict(zip(metric.labelnames, key))),
+                         "startTimeUnixNano": start, "timeUnixNano": now}
+                if metric.kind == "counter":
+                    point["asDouble"] = value
+                else:
+                    point.update(count=str(value["count"]), sum=value["sum"],
+                                 bucketCounts=[str(count) for count in value["counts"]],
+                                 explicitBounds=list(metric.buckets))
+                points.append(point)
+            data = {"dataPoints": points, "aggregationTemporality": 2}
+            if metric.kind == "counter":
+                metrics.append({"name": metric.name, "description": metric.documentation,
+                                "sum": {**data, "isMonotonic": True}})
+            else:
+                metrics.append({"name": metric.name, "description": metric.documentation, "histogram": data})
+        return {"resourceMetrics": [{
+            "resource": self._otlp_resource(),
+            "scopeMetrics": [{"scope": {"name": __name__}, "metrics": metrics}],
+        }]}
+    
+    def export_otlp(self, endpoint: Optional[str] = None, timeout: float = 5.0) -> Dict:
+        """
+        以 OTLP/HTTP JSON 推送 span 与指标，endpoint 默认取 OTEL_EXPORTER_OTLP_ENDPOINT
+        或 http://localhost:4318。推送成功的 span 从缓冲中移除，失败时放回。
+        """
+        endpoint = (endpoint or os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")).rstrip("/")
+        _import_requests()
+        spans = self.drain_spans()
+        result = {}
+        for path, body in (("/v1/traces", self.otlp_traces(spans)), ("/v1/metrics", self.otlp_metrics())):
+            try:
+                response = requests.post(endpoint + path, json=body, timeout=timeout)
+                result[path] = response.status_code
+            except Exception as e:
+                logger.warning("⚠️  OTLP 导出到 %s 失败: %s", endpoint + path, e)
+                result[path] = None
+        if result["/v1/traces"] != 200:
+            with self._lock:
+                self.spans.extendleft(reversed(spans))
+        return result
+
+def start_metrics_server(port: int = 9464, host: str = "127.0.0.1",
+                         registry: Optional[Telemetry] = None) -> "ThreadingHTTPServer":
+    """
+    在后台线程中提供 GET /metrics（Prometheus 抓取）与 GET /spans（最近的 span，JSON）。
+    
+    span 属性中含有产品名等业务数据，默认只监听本机；需要被其他主机抓取时显式传入 host="0.0.0.0"。
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    registry = registry or telemetry
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+        
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = registry.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/spans":
+                body = json.dumps([span.to_dict() for span in registry.snapshot_spans()], ensure_ascii=False)
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="rednote-metrics", daemon=True).start()
+    logger.info("📈 指标服务运行在 http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+# 全局的指标与调用链收集器
+telemetry = Telemetry()
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，Ollama 服务被判定为不可用"""
+
+# 客户端返回的错误结果带有 error_type，OllamaBackendPool 只对以下类型做故障转移：
+# 连接失败、熔断中、5xx/429 说明节点本身不可用；4xx 是请求本身的问题，换节点也会失败；
+# 读超时时生成可能仍在原节点上执行，重发只会重复占用算力
+FAILOVER_ERROR_TYPES = ("connection", "circuit_open", "server")
+
+def _http_error(status_code: int, **extra) -> Dict:
+    """把非 200 的响应转换为错误结果"""
+    error_type = "server" if status_code >= 500 or status_code == 429 else "client"
+    return {"error": f"HTTP {status_code}", "error_type": error_type, **extra}
+
+def _exception_error(exc: BaseException, **extra) -> Dict:
+    """把请求异常转换为错误结果，error_type 为 connection / circuit_open / timeout / unknown"""
+    if isinstance(exc, CircuitOpenError):
+        error_type = "circuit_open"
+    elif requests is not None and isinstance(exc, requests.exceptions.ConnectionError):
+        error_type = "connection"  # 包括 ConnectTimeout
+    elif requests is not None and isinstance(exc, requests.exceptions.Timeout):
+        error_type = "timeout"
+    elif httpx is not None and isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout,
+                                                httpx.RemoteProtocolError)):
+        error_type = "connection"
+    elif httpx is not None and isinstance(exc, httpx.TimeoutException):
+        error_type = "timeout"
+    else:
+        error_type = "unknown"
+    return {"error": str(exc), "error_type": error_type, **extra}
+
+class CircuitBreaker:
+    """
+    简单的熔断器：连续失败达到阈值后打开，在冷却时间内直接拒绝请求；
+    冷却结束后放行一次试探请求（半开），成功则关闭，失败则重新打开。
+    """
+    
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failure_count = 0
+        self.opened_at = None
+        self._half_open_probe = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self) -> str:
+        """当前状态：closed / open / half_open"""
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.recovery_timeout:
+                return "half_open"
+            return "open"
+    
+    def allow_request(self) -> bool:
+        """判断是否放行本次请求"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            # 半开状态只放行一个试探请求
+            if self._half_open_probe:
+                return False
+            self._half_open_probe = True
+            return True
+    
+    def record_success(self):
+        with self._lock:
+            self.failure_count = 0
+            self.opened_at = None
+            self._half_open_probe = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            self._half_open_probe = False
+            if self.opened_at is not None or self.failure_count >= self.failure_threshold:
+                self.opened_at = time.monotonic()
 
 class OllamaClient:
     """私有化部署的 Ollama 客户端"""
     
-    def __init__(self, base_url: str = "http://localhost:11434"):
+    # 模型加载中或服务繁忙时 Ollama 会返回这些状态码，可以安全重试
+    RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+    
+    def __init__(self, base_url: str = "http://localhost:11434",
+                 connect_timeout: float = 5.0, read_timeout: float = 300.0,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 pool_size: int = 10, circuit_breaker: Optional[CircuitBreaker] = None,
+                 keep_alive: Optional[str] = None):
         self.base_url = base_url
         self.model_name = "deepseek-r1:8b"  # 默认使用 8B 模型
+        self.keep_alive = keep_alive or default_keep_alive()
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        
+        # 复用 TCP 连接，避免每次请求重新握手
+        _import_requests()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+    
+    def close(self):
+        """关闭连接池"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def _backoff_delay(self, attempt: int) -> float:
+        """带随机抖动的指数退避（full jitter）"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    def _request(self, method: str, path: str, **kwargs) -> "requests.Response":
+        """
+        发送 HTTP 请求，对连接失败和可重试状态码做指数退避重试，并接入熔断器。
+        
+        读超时不会重试：生成请求可能已在服务端执行，重试只会重复占用算力。
+        """
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError(f"Ollama 服务 {self.base_url} 暂不可用（熔断中）")
+        
+        kwargs.setdefault("timeout", self.timeout)
+        url = f"{self.base_url}{path}"
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout) as e:
+                if attempt >= self.max_retries:
+                    self.circuit_breaker.record_failure()
+                    raise
+                delay = self._backoff_delay(attempt)
+                telemetry.record_retry(e.__class__.__name__)
+                logger.warning("⚠️  连接 Ollama 失败（%s），%.2f 秒后重试...", e.__class__.__name__, delay)
+                time.sleep(delay)
+                continue
+            except requests.exceptions.Timeout:
+                self.circuit_breaker.record_failure()
+                raise
+            except Exception:
+                # 其他异常（ChunkedEncodingError、InvalidURL 等）也要计入失败，否则半开试探永远不会释放
+                self.circuit_breaker.record_failure()
+                raise
+            
+            if response.status_code in self.RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                response.close()
+                delay = self._backoff_delay(attempt)
+                telemetry.record_retry(f"HTTP {response.status_code}")
+                logger.warning("⚠️  Ollama 返回 %d，%.2f 秒后重试...", response.status_code, delay)
+                time.sleep(delay)
+                continue
+            
+            # 重试用尽后仍是 429/5xx，说明服务本身不可用：计入失败，持续限流的节点也会触发熔断
+            if response.status_code >= 500 or response.status_code in self.RETRYABLE_STATUS_CODES:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+            return response
         
     def list_models(self) -> List[Dict]:
         """列出可用的模型"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags")
+            response = self._request("GET", "/api/tags")
             if response.status_code == 200:
                 return response.json().get("models", [])
             else:
-                print(f"❌ 获取模型列表失败: {response.status_code}")
+                logger.error("❌ 获取模型列表失败: %d", response.status_code)
                 return []
         except Exception as e:
-            print(f"❌ 连接 Ollama 服务失败: {e}")
+            logger.error("❌ 连接 Ollama 服务失败: %s", e)
             return []
     
-    def chat_completion(self, messages: List[Dict], tools: Optional[List] = None) -> Dict:
-        """调用私有化部署的模型进行对话"""
+    def _build_chat_payload(self, messages: List[Dict], tools: Optional[List], stream: bool,
+                            options: Optional[Dict] = None, model: Optional[str] = None) -> Dict:
+        """
+        构造 /api/chat 请求体，options 为 Ollama 采样参数（temperature、seed 等）。
+        
+        model 只作用于本次请求，不修改客户端的 model_name（全局客户端被多个调用方共享）。
+        """
+        payload = {
+            "model": model or self.model_name,
+            "messages": messages,
+            "stream": stream,
+            "keep_alive": self.keep_alive
+        }
+        
+        if tools:
+            payload["tools"] = tools
+            payload["tool_choice"] = "auto"
+        
+        if options:
+            payload["options"] = options
+        
+        return payload
+    
+    def embed(self, texts: List[str], model: Optional[str] = None, truncate: bool = True,
+              keep_alive: Optional[str] = None) -> Dict:
+        """调用 /api/embed 批量生成嵌入，一次请求可以包含多条文本；返回值中 embeddings 与 texts 一一对应"""
         try:
-            payload = {
-                "model": self.model_name,
-                "messages": messages,
-                "stream": False
-            }
+            payload = {"model": model or self.model_name, "input": list(texts), "truncate": truncate}
+            if keep_alive is not None:
+                payload["keep_alive"] = keep_alive
             
-            if tools:
-                payload["tools"] = tools
-                payload["tool_choice"] = "auto"
+            response = self._request("POST", "/api/embed", json=payload)
             
-            response = requests.post(
-                f"{self.base_url}/api/chat",
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
+            if response.status_code == 200:
+                return response.json()
+            else:
+                logger.error("❌ 嵌入调用失败: %d", response.status_code)
+                return _http_error(response.status_code)
+                
+        except Exception as e:
+            logger.error("❌ 调用私有化嵌入模型失败: %s", e)
+            return _exception_error(e)
+    
+    def chat_completion(self, messages: List[Dict], tools: Optional[List] = None,
+                        options: Optional[Dict] = None, model: Optional[str] = None) -> Dict:
+        """调用私有化部署的模型进行对话，耗时以及 Ollama 报告的阶段耗时与 token 数记入 telemetry"""
+        model = model or self.model_name
+        with telemetry.span("llm.chat", kind="client", model=model, stream=False,
+                            messages=len(messages)) as span:
+            result = self._chat(messages, tools, options, model)
+            telemetry.record_chat(model, False, span.duration, result, span)
+        return result
+    
+    def _chat(self, messages: List[Dict], tools: Optional[List], options: Optional[Dict],
+              model: Optional[str] = None) -> Dict:
+        try:
+            payload = self._build_chat_payload(messages, tools, stream=False, options=options, model=model)
+            
+            response = self._request("POST", "/api/chat", json=payload)
             
             if response.status_code == 200:
                 return response.json()
             else:
-                print(f"❌ 模型调用失败: {response.status_code}")
-                return {"error": f"HTTP {response.status_code}"}
+                logger.error("❌ 模型调用失败: %d", response.status_code)
+                return _http_error(response.status_code)
                 
         except Exception as e:
-            print(f"❌ 调用私有化模型失败: {e}")
-            return {"error": str(e)}
+            logger.error("❌ 调用私有化模型失败: %s", e)
+            return _exception_error(e)
+    
+    def chat_completion_stream(self, messages: List[Dict], tools: Optional[List] = None,
+                               options: Optional[Dict] = None, model: Optional[str] = None) -> Iterator[Dict]:
+        """
+        以流式方式调用私有化模型，逐个产出 Ollama 返回的 NDJSON 数据块。
+        
+        调用方提前关闭生成器（例如已拿到完整 JSON 文案）时会同时关闭 HTTP 连接，
+        Ollama 检测到连接断开后会停止生成，不再浪费算力。生成器结束时记录一次 telemetry，
+        提前关闭的请求没有 Ollama 的统计字段，状态记为 early_stop。
+        """
+        model = model or self.model_name
+        span = telemetry.start_span("llm.chat", kind="client", model=model, stream=True,
+                                    messages=len(messages))
+        final = {"early_stop": True}
+        chunks = self._chat_stream(messages, tools, options, model)
+        try:
+            for chunk in chunks:
+                if chunk.get("done"):
+                    final = chunk
+                yield chunk
+        finally:
+            chunks.close()
+            telemetry.record_chat(model, True, span.duration, final, span)
+            span.end()
+    
+    def _chat_stream(self, messages: List[Dict], tools: Optional[List],
+                     options: Optional[Dict], model: Optional[str] = None) -> Iterator[Dict]:
+        payload = self._build_chat_payload(messages, tools, stream=True, options=options, model=model)
+        
+        try:
+            response = self._request("POST", "/api/chat", json=payload, stream=True)
+        except Exception as e:
+            logger.error("❌ 调用私有化模型失败: %s", e)
+            yield _exception_error(e, done=True)
+            return
+        
+        try:
+            if response.status_code != 200:
+                logger.error("❌ 模型调用失败: %d", response.status_code)
+                yield _http_error(response.status_code, done=True)
+                return
+            
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                yield chunk
+                if chunk.get("done"):
+                    break
+        finally:
+            response.close()
     
     def set_model(self, model_name: str):
         """设置要使用的模型"""
         self.model_name = model_name
-        print(f"✅ 模型已设置为: {model_name}")
-
-# 初始化私有化模型客户端
-ollama_client = OllamaClient()
-
-print("✅ 私有化 DeepSeek-R1 模型客户端初始化完成！")
-print(f"🔧 当前配置的模型: {ollama_client.model_name}")
-print(f"🌐 Ollama API 地址: {ollama_client.base_url}")
-
-# 检查私有化部署的模型状态
-print("\n🔍 检查私有化部署的模型状态...")
-
-# 列出可用模型
-available_models = ollama_client.list_models()
-print(f"\n📋 可用的模型列表:")
-for model in available_models:
-    print(f"  - {model.get('name', 'Unknown')} (大小: {model.get('size', 'Unknown')})")
-
-# 检查是否有 DeepSeek-R1 模型
-deepseek_models = [m for m in available_models if 'deepseek' in m.get('name', '').lower()]
-if deepseek_models:
-    print(f"\n✅ 找到 DeepSeek 模型: {len(deepseek_models)} 个")
-    for model in deepseek_models:
-        print(f"  🎯 {model.get('name')}")
+        logger.info("✅ 模型已设置为: %s", model_name)
+
+class AsyncOllamaClient:
+    """
+    基于 httpx 的异步 Ollama 客户端。
+    
+    接口与 OllamaClient 对应，单个事件循环即可复用连接池同时处理大量在途请求，
+    无需为每个生成任务占用一个线程。
+    """
+    
+    RETRYABLE_STATUS_CODES = OllamaClient.RETRYABLE_STATUS_CODES
+    _build_chat_payload = OllamaClient._build_chat_payload
+    
+    def __init__(self, base_url: str = "http://localhost:11434",
+                 connect_timeout: float = 5.0, read_timeout: float = 300.0,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 pool_size: int = 100, circuit_breaker: Optional[CircuitBreaker] = None,
+                 transport=None, keep_alive: Optional[str] = None):
+        _import_httpx()
+        
+        self.base_url = base_url
+        self.model_name = "deepseek-r1:8b"
+        self.keep_alive = keep_alive or default_keep_alive()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            transport=transport,
+        )
+    
+    async def aclose(self):
+        """关闭连接池"""
+        await self.client.aclose()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    def _backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    async def _send(self, method: str, path: str, stream: bool = False, **kwargs):
+        """发送请求，重试、退避与熔断策略与 OllamaClient._request 一致"""
+        import asyncio  # 仅异步接口需要，按需导入以保持模块导入轻量
+        
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError(f"Ollama 服务 {self.base_url} 暂不可用（熔断中）")
+        
+        for attempt in range(self.max_retries + 1):
+            request = self.client.build_request(method, path, **kwargs)
+            try:
+                response = await self.client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                if attempt >= self.max_retries:
+                    self.circuit_breaker.record_failure()
+                    raise
+                delay = self._backoff_delay(attempt)
+                telemetry.record_retry(e.__class__.__name__)
+                logger.warning("⚠️  连接 Ollama 失败（%s），%.2f 秒后重试...", e.__class__.__name__, delay)
+                await asyncio.sleep(delay)
+                continue
+            except httpx.TimeoutException:
+                self.circuit_breaker.record_failure()
+                raise
+            except BaseException:
+                # 其他异常以及任务取消也要计入失败，否则半开试探永远不会释放
+                self.circuit_breaker.record_failure()
+                raise
+            
+            if response.status_code in self.RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                await response.aclose()
+                delay = self._backoff_delay(attempt)
+                telemetry.record_retry(f"HTTP {response.status_code}")
+                logger.warning("⚠️  Ollama 返回 %d，%.2f 秒后重试...", response.status_code, delay)
+                await asyncio.sleep(delay)
+                continue
+            
+            # 重试用尽后仍是 429/5xx，说明服务本身不可用：计入失败，持续限流的节点也会触发熔断
+            if response.status_code >= 500 or response.status_code in self.RETRYABLE_STATUS_CODES:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+            return response
+    
+    async def list_models(self) -> List[Dict]:
+        """列出可用的模型"""
+        try:
+            response = await self._send("GET", "/api/tags")
+            if response.status_code == 200:
+                return response.json().get("models", [])
+            logger.error("❌ 获取模型列表失败: %d", response.status_code)
+            return []
+        except Exception as e:
+            logger.error("❌ 连接 Ollama 服务失败: %s", e)
+            return []
+    
+    async def chat_completion(self, messages: List[Dict], tools: Optional[List] = None,
+                              options: Optional[Dict] = None, model: Optional[str] = None) -> Dict:
+        """调用私有化部署的模型进行对话，与 OllamaClient 一样记入 telemetry"""
+        model = model or self.model_name
+        with telemetry.span("llm.chat", kind="client", model=model, stream=False,
+                            messages=len(messages)) as span:
+            result = await self._chat(messages, tools, options, model)
+            telemetry.record_chat(model, False, span.duration, result, span)
+        return result
+    
+    async def _chat(self, messages: List[Dict], tools: Optional[List], options: Optional[Dict],
+                    model: Optional[str] = None) -> Dict:
+        try:
+            payload = self._build_chat_payload(messages, tools, stream=False, options=options, model=model)
+            response = await self._send("POST", "/api/chat", json=payload)
+            if response.status_code == 200:
+                return response.json()
+            logger.error("❌ 模型调用失败: %d", response.status_code)
+            return _http_error(response.status_code)
+        except Exception as e:
+            logger.error("❌ 调用私有化模型失败: %s", e)
+            return _exception_error(e)
+    
+    async def chat_completion_stream(self, messages: List[Dict], tools: Optional[List] = None,
+                                     options: Optional[Dict] = None, model: Optional[str] = None):
+        """以异步生成器的形式逐个产出 NDJSON 数据块，提前 aclose 会断开连接并终止生成"""
+        model = model or self.model_name
+        span = telemetry.start_span("llm.chat", kind="client", model=model, stream=True,
+                                    messages=len(messages))
+        final = {"early_stop": True}
+        chunks = self._chat_stream(messages, tools, options, model)
+        try:
+            async for chunk in chunks:
+                if chunk.get("done"):
+                    final = chunk
+                yield chunk
+        finally:
+            await chunks.aclose()
+            telemetry.record_chat(model, True, span.duration, final, span)
+            span.end()
+    
+    async def _chat_stream(self, messages: List[Dict], tools: Optional[List], options: Optional[Dict],
+                           model: Optional[str] = None):
+        payload = self._build_chat_payload(messages, tools, stream=True, options=options, model=model)
+        
+        try:
+            response = await self._send("POST", "/api/chat", stream=True, json=payload)
+        except Exception as e:
+            logger.error("❌ 调用私有化模型失败: %s", e)
+            yield _exception_error(e, done=True)
+            return
+        
+        try:
+            if response.status_code != 200:
+                logger.error("❌ 模型调用失败: %d", response.status_code)
+                yield _http_error(response.status_code, done=True)
+                return
+            
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                yield chunk
+                if chunk.get("done"):
+                    break
+        finally:
+            await response.aclose()
+    
+    def set_model(self, model_name: str):
+        """设置要使用的模型"""
+        self.model_name = model_name
+        logger.info("✅ 模型已设置为: %s", model_name)
+
+class OllamaBackend:
+    """负载均衡池中的一个 Ollama 节点及其运行状态"""
+    
+    # 延迟指数移动平均的平滑系数
+    LATENCY_ALPHA = 0.3
+    
+    def __init__(self, client: OllamaClient):
+        self.client = client
+        self.outstanding = 0           # 在途请求数
+        self.latency_ewma = None       # 最近请求耗时的指数移动平均（秒）
+        self.healthy = True
+        self.available_models = set()  # /api/tags 中已下载的模型
+        self.loaded_models = set()     # /api/ps 中已加载到内存的模型
+        self._lock = threading.Lock()
+    
+    @property
+    def base_url(self) -> str:
+        return self.client.base_url
+    
+    def begin(self):
+        with self._lock:
+            self.outstanding += 1
+    
+    def end(self, elapsed: Optional[float], model_name: str, success: bool):
+        """记录一次请求结束；成功的请求会更新延迟并标记模型已加载"""
+        with self._lock:
+            self.outstanding -= 1
+            if not success:
+                return
+            if elapsed is not None:
+                if self.latency_ewma is None:
+                    self.latency_ewma = elapsed
+                else:
+                    self.latency_ewma += self.LATENCY_ALPHA * (elapsed - self.latency_ewma)
+            self.loaded_models.add(model_name)
+    
+    def load_score(self) -> float:
+        """路由分数，越小越优先：在途请求数 × 平均延迟（没有历史延迟时只看在途请求数）"""
+        return (self.outstanding + 1) * (self.latency_ewma or 1.0)
+    
+    def snapshot(self) -> Dict:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "latency_ewma": self.latency_ewma,
+            "loaded_models": sorted(self.loaded_models),
+        }
+
+class OllamaBackendPool:
+    """
+    多个 Ollama 实例组成的负载均衡池，接口与 OllamaClient 一致，可直接替换全局客户端。
+    
+    - 路由：优先选择已加载目标模型的节点（模型亲和），再按 在途请求数 × 平均延迟 选最空闲的节点
+    - 故障转移：连接失败、5xx 或熔断时把节点标记为不健康并换下一个节点重试；
+      4xx（如模型未下载）与读超时原样返回给调用方，不影响节点健康状态
+    - 健康检查：check_health 通过 /api/tags 探测节点并刷新 /api/ps 中已加载的模型，恢复的节点重新加入
+    """
+    
+    def __init__(self, base_urls: List[str], health_check_interval: float = 10.0, **client_kwargs):
+        if not base_urls:
+            raise ValueError("OllamaBackendPool 至少需要一个 Ollama 地址")
+        self.backends = [OllamaBackend(OllamaClient(url, **client_kwargs)) for url in base_urls]
+        self.health_check_interval = health_check_interval
+        self._model_name = self.backends[0].client.model_name
+        self._health_thread = None
+        self._stop_event = threading.Event()
+    
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+    
+    @model_name.setter
+    def model_name(self, model_name: str):
+        self._model_name = model_name
+        for backend in self.backends:
+            backend.client.model_name = model_name
+    
+    @property
+    def base_url(self) -> str:
+        return ",".join(backend.base_url for backend in self.backends)
+    
+    def set_model(self, model_name: str):
+        """设置要使用的模型（同步到所有节点）"""
+        self.model_name = model_name
+        logger.info("✅ 模型已设置为: %s", model_name)
+    
+    def _check_backend(self, backend: OllamaBackend) -> bool:
+        try:
+            response = backend.client._request("GET", "/api/tags")
+            if response.status_code != 200:
+                return False
+            backend.available_models = {m.get("name", "") for m in response.json().get("models", [])}
+            response = backend.client._request("GET", "/api/ps")
+            if response.status_code == 200:
+                backend.loaded_models = {m.get("name", "") for m in response.json().get("models", [])}
+            return True
+        except Exception:
+            return False
+    
+    def check_health(self) -> List[Dict]:
+        """探测所有节点，更新健康状态与模型信息，返回各节点快照"""
+        for backend in self.backends:
+            healthy = self._check_backend(backend)
+            if healthy and not backend.healthy:
+                logger.info("✅ Ollama 节点恢复：%s", backend.base_url)
+            elif not healthy and backend.healthy:
+                logger.warning("⚠️  Ollama 节点不可用，暂时移出负载均衡：%s", backend.base_url)
+            backend.healthy = healthy
+        return [backend.snapshot() for backend in self.backends]
+    
+    def start_health_checks(self):
+        """启动后台健康检查线程"""
+        if self._health_thread is not None:
+            return
+        
+        def run():
+            while not self._stop_event.wait(self.health_check_interval):
+                self.check_health()
+        
+        self._health_thread = threading.Thread(target=run, name="ollama-health-check", daemon=True)
+        self._health_thread.start()
+    
+    def close(self):
+        self._stop_event.set()
+        for backend in self.backends:
+            backend.client.close()
+    
+    def _candidates(self, model: Optional[str] = None) -> List[OllamaBackend]:
+        """按路由优先级排列的候选节点；全部不健康时仍尝试所有节点，避免整体不可用"""
+        model = model or self._model_name
+        healthy = [b for b in self.backends if b.healthy] or list(self.backends)
+        # 已下载目标模型的节点优先（未做过健康检查时 available_models 为空，视为可能拥有）
+        capable = [b for b in healthy if not b.available_models or model in b.available_models]
+        candidates = capable or healthy
+        return sorted(candidates, key=lambda b: (model not in b.loaded_models, b.load_score()))
+    
+    @staticmethod
+    def _should_failover(response: Dict) -> bool:
+        return response.get("error_type") in FAILOVER_ERROR_TYPES
+    
+    def _evict(self, backend: OllamaBackend):
+        """请求失败的节点移出负载均衡，由后台健康检查在其恢复后重新加入"""
+        backend.healthy = False
+        logger.warning("⚠️  节点 %s 调用失败，暂时移出负载均衡", backend.base_url)
+        self.start_health_checks()
+    
+    def select_backend(self) -> OllamaBackend:
+        """选择当前最合适的节点"""
+        return self._candidates()[0]
+    
+    def list_models(self) -> List[Dict]:
+        """合并所有健康节点上的模型列表（按名称去重）"""
+        models = {}
+        for backend in self.backends:
+            if backend.healthy:
+                for model in backend.client.list_models():
+                    models.setdefault(model.get("name"), model)
+        return list(models.values())
+    
+    def chat_completion(self, messages: List[Dict], tools: Optional[List] = None,
+                        options: Optional[Dict] = None, model: Optional[str] = None) -> Dict:
+        """路由到最合适的节点，节点不可用时依次转移到其他节点"""
+        model = model or self._model_name
+        response = {"error": "没有可用的 Ollama 节点"}
+        for backend in self._candidates(model):
+            backend.begin()
+            start = time.perf_counter()
+            response = backend.client.chat_completion(messages, tools=tools, options=options, model=model)
+            success = "error" not in response
+            backend.end(time.perf_counter() - start, model, success)
+            if not self._should_failover(response):
+                return response
+            self._evict(backend)
+        return response
+    
+    def embed(self, texts: List[str], model: Optional[str] = None, truncate: bool = True,
+              keep_alive: Optional[str] = None) -> Dict:
+        """嵌入请求同样按负载路由，节点不可用时转移到其他节点；嵌入模型未下载（404）不会移出节点"""
+        model = model or self._model_name
+        response = {"error": "没有可用的 Ollama 节点"}
+        for backend in self._candidates(model):
+            backend.begin()
+            start = time.perf_counter()
+            response = backend.client.embed(texts, model=model, truncate=truncate, keep_alive=keep_alive)
+            success = "error" not in response
+            backend.end(time.perf_counter() - start, model, success)
+            if not self._should_failover(response):
+                return response
+            self._evict(backend)
+        return response
+    
+    def chat_completion_stream(self, messages: List[Dict], tools: Optional[List] = None,
+                               options: Optional[Dict] = None, model: Optional[str] = None) -> Iterator[Dict]:
+        """流式版本：只在尚未产出任何数据时做故障转移"""
+        model = model or self._model_name
+        last_error = {"error": "没有可用的 Ollama 节点", "done": True}
+        for backend in self._candidates(model):
+            backend.begin()
+            start = time.perf_counter()
+            success = False
+            stream = backend.client.chat_completion_stream(messages, tools=tools, options=options, model=model)
+            try:
+                first_chunk = next(stream, last_error)
+                if self._should_failover(first_chunk):
+                    last_error = first_chunk
+                    self._evict(backend)
+                    continue
+                if "error" in first_chunk:
+                    yield first_chunk
+                    return
+                # 延迟按首个数据块到达的时间计算，更能反映节点的排队与加载情况；
+                # 调用方拿到完整 JSON 后提前关闭数据流也算成功
+                elapsed = time.perf_counter() - start
+                success = True
+                yield first_chunk
+                yield from stream
+            finally:
+                stream.close()
+                backend.end(elapsed if success else None, model, success)
+            return
+        yield last_error
+
+DEFAULT_OLLAMA_BASE_URL = "http://localhost:11434"
+
+# 惰性创建的全局客户端：导入模块时不做任何网络请求，首次使用时才创建并探测模型
+_client_lock = threading.Lock()
+
+def select_deepseek_model(client: OllamaClient, verbose: bool = True) -> Optional[str]:
+    """列出 Ollama 上可用的模型，并自动选择第一个 DeepSeek 模型"""
+    if verbose:
+        logger.info("🔍 检查私有化部署的模型状态...")
+    
+    available_models = client.list_models()
+    if verbose:
+        logger.info("📋 可用的模型列表:")
+        for model in available_models:
+            logger.info("  - %s (大小: %s)", model.get('name', 'Unknown'), model.get('size', 'Unknown'))
+    
+    deepseek_models = [m for m in available_models if 'deepseek' in m.get('name', '').lower()]
+    if deepseek_models:
+        if verbose:
+            logger.info("✅ 找到 DeepSeek 模型: %d 个", len(deepseek_models))
+            for model in deepseek_models:
+                logger.info("  🎯 %s", model.get('name'))
         # 自动选择第一个可用的 DeepSeek 模型
-        ollama_client.set_model(model.get('name'))
-        break
-else:
-    print("\n⚠️  未找到 DeepSeek 模型，请确保已正确部署")
-    print("💡 建议运行: docker exec ollama-deepseek ollama pull deepseek-r1:8b")
+        client.set_model(deepseek_models[0].get('name'))
+        return client.model_name
     
-print(f"\n🎯 当前使用的模型: {ollama_client.model_name}")
+    if verbose:
+        logger.warning("⚠️  未找到 DeepSeek 模型，请确保已正确部署")
+        logger.warning("💡 建议运行: docker exec ollama-deepseek ollama pull deepseek-r1:8b")
+    return None
+
+def create_ollama_client(base_url: Optional[str] = None, model_name: Optional[str] = None,
+                         discover_model: bool = True, **client_kwargs) -> OllamaClient:
+    """
+    创建 OllamaClient。
+    
+    地址与模型默认取环境变量 OLLAMA_BASE_URL / OLLAMA_MODEL；显式指定模型时跳过模型探测，
+    否则调用一次 /api/tags 自动选择 DeepSeek 模型。
+    
+    地址中包含多个以逗号分隔的 URL（或设置了 OLLAMA_BASE_URLS）时返回 OllamaBackendPool。
+    """
+    base_url = (base_url or os.environ.get("OLLAMA_BASE_URLS")
+                or os.environ.get("OLLAMA_BASE_URL", DEFAULT_OLLAMA_BASE_URL))
+    base_urls = [url.strip() for url in base_url.split(",") if url.strip()]
+    if len(base_urls) > 1:
+        client = OllamaBackendPool(base_urls, **client_kwargs)
+    else:
+        client = OllamaClient(base_urls[0], **client_kwargs)
+    model_name = model_name or os.environ.get("OLLAMA_MODEL")
+    if model_name:
+        client.model_name = model_name
+    elif discover_model:
+        select_deepseek_model(client, verbose=False)
+    return client
+
+def get_ollama_client() -> OllamaClient:
+    """返回全局共享的 OllamaClient，首次调用时创建（模型探测只做一次）"""
+    client = globals().get("ollama_client")
+    if client is None:
+        with _client_lock:
+            client = globals().get("ollama_client")
+            if client is None:
+                client = create_ollama_client()
+                globals()["ollama_client"] = client
+    return client
 
 # 系统提示词（与第五章保持一致）
 SYSTEM_PROMPT = """
@@ -170,8 +1353,6 @@ TOOLS_DEFINITION = [
     }
 ]
 
-print("✅ 系统提示词和工具定义完成！")
-
 # 创建专注于蓝牙降噪耳机的产品数据库
 bluetooth_headphones_database = {
     "AirPods Pro": {
@@ -221,52 +1402,678 @@ bluetooth_headphones_database = {
     }
 }
 
-print(f"✅ 蓝牙降噪耳机产品数据库创建完成，包含 {len(bluetooth_headphones_database)} 个产品！")
-print("\n📱 产品列表：")
-for product_name in bluetooth_headphones_database.keys():
-    brand = bluetooth_headphones_database[product_name]["brand"]
-    price = bluetooth_headphones_database[product_name]["price_range"]
-    print(f"  - {product_name} ({brand}) - {price}")
+def _normalize_product_text(text: str) -> str:
+    """统一全半角、大小写，去掉空白和标点，便于中英文混合名称匹配"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if ch.isalnum())
+
+def _parse_price_range(price_range: str):
+    """把 "1800-2200元" 解析为 (1800, 2200)，无法解析时返回 None"""
+    numbers = [int(n) for n in re.findall(r"\d+", price_range or "")]
+    if not numbers:
+        return None
+    return min(numbers), max(numbers)
+
+class ProductCatalog:
+    """
+    带索引的产品目录。
+    
+    - 规范化名称的精确索引：O(1) 命中
+    - 字符 2/3-gram 倒排索引：中英文模糊查询只需比较共享 n-gram 的候选产品
+    - 品牌与价格区间二级索引
+    """
+    
+    NGRAM_SIZES = (2, 3)
+    # 目录较小时未命中提示会列出全部产品，较大时只给出最相近的若干个
+    FULL_LISTING_LIMIT = 20
+    # 倒排列表长度超过 max(该值, 目录规模的 10%) 的 n-gram 视为高频 n-gram
+    COMMON_GRAM_MIN = 256
+    # 最多用这么多个最稀有的 n-gram 召回候选，其余 n-gram 只参与打分
+    MAX_SEED_GRAMS = 4
+    
+    def __init__(self, products: Optional[Dict[str, Dict]] = None):
+        self._names = []           # 产品 id -> 产品名称
+        self._records = []         # 产品 id -> 产品信息
+        self._keys = []            # 产品 id -> 规范化名称
+        self._gram_counts = []     # 产品 id -> n-gram 数量
+        self._exact = {}           # 规范化名称 -> 产品 id
+        self._postings = {}        # n-gram -> [产品 id, ...]
+        self._brands = {}          # 规范化品牌 -> [产品 id, ...]
+        self._price_index = []     # [(最低价, 最高价, 产品 id)]，按最低价排序
+        self._formatted = {}       # 产品 id -> 格式化后的产品信息
+        self._listing = None       # 未命中时的产品列表提示
+        
+        for name, info in (products or {}).items():
+            self.add(name, info)
+    
+    def __len__(self):
+        return len(self._names)
+    
+    def __contains__(self, name: str) -> bool:
+        return self._lookup_id(_normalize_product_text(name)) is not None
+    
+    # ---- 存储访问钩子：子类（如 MappedProductCatalog）替换为磁盘索引实现 ----
+    
+    def _lookup_id(self, key: str) -> Optional[int]:
+        return self._exact.get(key)
+    
+    def _product_name(self, product_id: int) -> str:
+        return self._names[product_id]
+    
+    def _record(self, product_id: int) -> Dict:
+        return self._records[product_id]
+    
+    def _posting_sizes(self, grams) -> Dict[str, int]:
+        """返回目录中出现过的 n-gram 及其倒排列表长度"""
+        return {g: len(self._postings[g]) for g in grams if g in self._postings}
+    
+    def _count_shared(self, grams) -> Dict[int, tuple]:
+        """返回 产品 id -> (与 grams 的重合数, 规范化名称, n-gram 数量)"""
+        counts = {}
+        for gram in grams:
+            for product_id in self._postings[gram]:
+                counts[product_id] = counts.get(product_id, 0) + 1
+        return {product_id: (shared, self._keys[product_id], self._gram_counts[product_id])
+                for product_id, shared in counts.items()}
+    
+    def _brand_ids(self, brand_key: str) -> List[int]:
+        return self._brands.get(brand_key, [])
+    
+    def _price_ids(self, min_price: float, max_price: float) -> List[int]:
+        end = bisect.bisect_right(self._price_index, (max_price, float("inf"), len(self._names)))
+        return [product_id for low, high, product_id in self._price_index[:end] if high >= min_price]
+    
+    def _iter_names_and_brands(self):
+        for name, record in zip(self._names, self._records):
+            yield name, record.get("brand", "")
+    
+    @classmethod
+    def _ngrams(cls, key: str) -> set:
+        grams = set()
+        for n in cls.NGRAM_SIZES:
+            if len(key) < n:
+                continue
+            grams.update(key[i:i + n] for i in range(len(key) - n + 1))
+        # 单字查询（如 "索"）也能参与匹配
+        if not grams and key:
+            grams.add(key)
+        return grams
+    
+    def add(self, name: str, info: Dict):
+        """添加或覆盖一个产品，同时更新全部索引"""
+        key = _normalize_product_text(name)
+        if key in self._exact:
+            # 覆盖已有产品：只更新记录，名称相关的索引不变
+            product_id = self._exact[key]
+            self._remove_secondary(product_id)
+            self._records[product_id] = info
+            self._names[product_id] = name
+        else:
+            product_id = len(self._names)
+            self._names.append(name)
+            self._records.append(info)
+            self._keys.append(key)
+            self._exact[key] = product_id
+            grams = self._ngrams(key)
+            self._gram_counts.append(len(grams))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(product_id)
+        
+        brand = _normalize_product_text(info.get("brand", ""))
+        if brand:
+            self._brands.setdefault(brand, []).append(product_id)
+        price = _parse_price_range(info.get("price_range", ""))
+        if price:
+            bisect.insort(self._price_index, (price[0], price[1], product_id))
+        self._formatted.pop(product_id, None)
+        self._listing = None
+    
+    def _remove_secondary(self, product_id: int):
+        info = self._records[product_id]
+        brand = _normalize_product_text(info.get("brand", ""))
+        if brand in self._brands:
+            self._brands[brand].remove(product_id)
+        self._price_index = [entry for entry in self._price_index if entry[2] != product_id]
+    
+    def get(self, name: str) -> Optional[Dict]:
+        """按名称精确查找（忽略大小写、空格与标点）"""
+        product_id = self._lookup_id(_normalize_product_text(name))
+        return None if product_id is None else self._record(product_id)
+    
+    def search(self, query: str, top_k: int = 5, min_score: float = 0.3) -> List[tuple]:
+        """
+        模糊查询，返回按相关度降序排列的 [(产品名称, 分数)]。
+        
+        分数为查询与名称 n-gram 集合的 Dice 系数；一方包含另一方时额外加 1 分，
+        与旧版子串匹配的行为保持一致。
+        """
+        key = _normalize_product_text(query)
+        if not key:
+            return []
+        
+        query_grams = self._ngrams(key)
+        # "耳机"、"pro" 这类高频 n-gram 的倒排列表很长：只用最稀有的几个低频 n-gram 召回候选
+        # （全是高频 n-gram 时只用最稀有的一个），再用子串判断补齐候选与其余 n-gram 的重合数
+        common_limit = max(self.COMMON_GRAM_MIN, len(self) // 10)
+        posting_sizes = self._posting_sizes(query_grams)
+        matched_grams = sorted(posting_sizes, key=posting_sizes.get)
+        seed_count = sum(1 for g in matched_grams if posting_sizes[g] <= common_limit) or 1
+        seed_count = min(seed_count, self.MAX_SEED_GRAMS)
+        seed_grams, other_grams = matched_grams[:seed_count], matched_grams[seed_count:]
+        if not seed_grams:
+            return []
+        
+        scored = []
+        for product_id, (shared, product_key, gram_count) in self._count_shared(seed_grams).items():
+            shared += sum(1 for gram in other_grams if gram in product_key)
+            score = 2 * shared / (len(query_grams) + gram_count)
+            if key in product_key or product_key in key:
+                score += 1.0
+            if score >= min_score:
+                # 同分时优先返回先加入目录的产品
+                scored.append((score, -product_id))
+        
+        return [(self._product_name(-neg_id), round(score, 4))
+                for score, neg_id in heapq.nlargest(top_k, scored)]
+    
+    def resolve(self, query: str) -> Optional[str]:
+        """精确匹配优先，否则返回模糊查询的最佳结果"""
+        product_id = self._lookup_id(_normalize_product_text(query))
+        if product_id is not None:
+            return self._product_name(product_id)
+        matches = self.search(query, top_k=1)
+        return matches[0][0] if matches else None
+    
+    def by_brand(self, brand: str) -> List[str]:
+        """返回指定品牌的全部产品名称"""
+        return [self._product_name(i) for i in self._brand_ids(_normalize_product_text(brand))]
+    
+    def by_price(self, min_price: float = 0, max_price: float = float("inf")) -> List[str]:
+        """返回价格区间与 [min_price, max_price] 有交集的产品名称"""
+        return [self._product_name(i) for i in self._price_ids(min_price, max_price)]
+    
+    def format_product(self, name: str) -> str:
+        """生成供模型阅读的产品信息文本（结果会被缓存）"""
+        product_id = self._lookup_id(_normalize_product_text(name))
+        if product_id in self._formatted:
+            return self._formatted[product_id]
+        
+        product = self._record(product_id)
+        info = f"{self._product_name(product_id)} 详细产品信息：\n"
+        
+        if "brand" in product:
+            info += f"🏷️  品牌：{product['brand']}\n"
+        
+        if "features" in product:
+            info += f"✨ 主要特点：{', '.join(product['features'])}\n"
+        
+        if "battery_life" in product:
+            info += f"🔋 续航能力：{product['battery_life']}\n"
+        
+        if "connectivity" in product:
+            info += f"📡 连接技术：{product['connectivity']}\n"
+        
+        if "target_audience" in product:
+            info += f"👥 目标用户：{product['target_audience']}\n"
+        
+        if "price_range" in product:
+            info += f"💰 价格区间：{product['price_range']}\n"
+        
+        if "special_features" in product:
+            info += f"🌟 特色功能：{product['special_features']}"
+        
+        self._formatted[product_id] = info
+        return info
+    
+    def miss_message(self, query: str) -> str:
+        """未找到产品时的提示信息"""
+        if len(self) <= self.FULL_LISTING_LIMIT:
+            if self._listing is None:
+                self._listing = "\n".join(f"- {name} ({brand})" for name, brand in self._iter_names_and_brands())
+            return f"未找到产品 {query} 的信息。\n\n可用的蓝牙耳机产品：\n" + self._listing
+        
+        suggestions = self.search(query, top_k=5, min_score=0.0)
+        lines = "\n".join(f"- {name} ({self.get(name).get('brand', '')})" for name, _ in suggestions)
+        return f"未找到产品 {query} 的信息。\n\n目录共有 {len(self)} 个产品，最相近的是：\n" + lines
+
+CATALOG_INDEX_SUFFIX = ".index.sqlite3"
+
+def _catalog_source_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".csv":
+        return "csv"
+    if extension in (".db", ".sqlite", ".sqlite3"):
+        return "sqlite"
+    raise ValueError(f"不支持的产品目录格式: {path}（支持 .jsonl / .csv / .sqlite3）")
+
+def _csv_row_to_record(values: List[str], columns: List[str]) -> Dict:
+    """把 CSV 的一条记录转换为字典，以 [ 开头的字段按 JSON 数组解析（如 features）"""
+    record = {}
+    for column, value in zip(columns, values):
+        if value.startswith("["):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                pass
+        record[column] = value
+    return record
+
+def _parse_csv_record(text: str, columns: List[str]) -> Dict:
+    """解析一条 CSV 产品记录，引号内的字段可以跨行"""
+    return _csv_row_to_record(next(csv.reader(io.StringIO(text))), columns)
+
+def _iter_csv_records(f):
+    """
+    用同一个 csv.reader 逐条读取二进制文件对象，产出 (字段列表, 偏移, 长度)。
+    
+    csv.reader 只在引号内的字段跨行时才继续读取下一行，因此每条记录结束时已读取的字节数就是它的结束位置。
+    """
+    position = 0
+    
+    def lines():
+        nonlocal position
+        for raw_line in f:
+            position += len(raw_line)
+            yield raw_line.decode("utf-8")
+    
+    start = 0
+    for values in csv.reader(lines()):
+        end = position
+        if any(value.strip() for value in values):
+            yield values, start, end - start
+        start = end
+
+def _read_csv_header(f) -> List[str]:
+    f.seek(0)
+    header = next(_iter_csv_records(f), ([], 0, 0))[0]
+    f.seek(0)
+    return header
+
+def _iter_catalog_source(source_path: str, source_format: str, f=None):
+    """
+    逐条读取产品目录源文件，产出 (名称, 记录, 偏移, 长度)。
+    
+    文本格式从已打开的二进制文件对象 f 读取，偏移/长度为该记录在文件中的字节位置（CSV 记录可能跨多行）；
+    SQLite 格式按路径打开，偏移/长度为 rowid 与 0。
+    """
+    if source_format == "sqlite":
+        conn = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+        try:
+            for rowid, name, record_json in conn.execute("SELECT rowid, name, record FROM products"):
+                yield name, json.loads(record_json), rowid, 0
+        finally:
+            conn.close()
+        return
+    
+    f.seek(0)
+    if source_format == "csv":
+        columns = None
+        for values, offset, length in _iter_csv_records(f):
+            if columns is None:
+                columns = values
+                continue
+            record = _csv_row_to_record(values, columns)
+            yield record.pop("name"), record, offset, length
+        return
+    
+    offset = 0
+    for raw_line in f:
+        line_offset, offset = offset, offset + len(raw_line)
+        line = raw_line.decode("utf-8").strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        yield record.pop("name"), record, line_offset, len(raw_line)
+
+def build_catalog_index(source_path: str, index_path: Optional[str] = None) -> str:
+    """
+    为 JSONL / CSV / SQLite 产品目录构建紧凑的 SQLite 磁盘索引。
+    
+    索引只保存名称、n-gram 倒排、品牌、价格和记录在源文件中的位置，
+    产品详情按需从源文件读取。先写临时文件再原子替换，其他进程正在读取的旧索引不受影响。
+    """
+    source_format = _catalog_source_format(source_path)
+    index_path = index_path or source_path + CATALOG_INDEX_SUFFIX
+    if source_format == "sqlite":
+        return _write_catalog_index(source_path, None, os.stat(source_path), index_path)
+    with open(source_path, "rb") as f:
+        return _write_catalog_index(source_path, f, os.fstat(f.fileno()), index_path)
+
+def _write_catalog_index(source_path: str, f, stat, index_path: str) -> str:
+    """
+    按已打开的源文件 f（SQLite 格式为 None）及其 stat 写索引：
+    索引内容与记录的 stat 来自同一个文件，构建期间源文件被替换也不会错位。
+    """
+    source_format = _catalog_source_format(source_path)
+    tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript("""
+            CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE products (
+                id INTEGER PRIMARY KEY, name TEXT NOT NULL, key TEXT NOT NULL UNIQUE,
+                brand_key TEXT, price_low REAL, price_high REAL,
+                gram_count INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL
+            );
+            CREATE TABLE grams (gram TEXT NOT NULL, product_id INTEGER NOT NULL,
+                                PRIMARY KEY (gram, product_id)) WITHOUT ROWID;
+        """)
+        columns = _read_csv_header(f) if source_format == "csv" else []
+        count = 0
+        for name, record, offset, length in _iter_catalog_source(source_path, source_format, f):
+            key = _normalize_product_text(name)
+            price = _parse_price_range(record.get("price_range", "")) or (None, None)
+            brand_key = _normalize_product_text(record.get("brand", ""))
+            existing = conn.execute("SELECT id FROM products WHERE key = ?", (key,)).fetchone()
+            if existing:
+                # 与内存目录一致：同名产品以后出现的记录为准
+                conn.execute(
+                    "UPDATE products SET name = ?, brand_key = ?, price_low = ?, price_high = ?, "
+                    "offset = ?, length = ? WHERE id = ?",
+                    (name, brand_key, price[0], price[1], offset, length, existing[0])
+                )
+                continue
+            grams = ProductCatalog._ngrams(key)
+            cursor = conn.execute(
+                "INSERT INTO products (id, name, key, brand_key, price_low, price_high, gram_count, offset, length) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (count, name, key, brand_key, price[0], price[1], len(grams), offset, length)
+            )
+            conn.executemany("INSERT INTO grams (gram, product_id) VALUES (?, ?)",
+                             [(gram, cursor.lastrowid) for gram in grams])
+            count += 1
+        
+        conn.executescript("""
+            CREATE INDEX products_brand ON products (brand_key);
+            CREATE INDEX products_price ON products (price_low);
+        """)
+        conn.executemany("INSERT INTO meta (name, value) VALUES (?, ?)", [
+            ("source_mtime_ns", str(stat.st_mtime_ns)),
+            ("source_size", str(stat.st_size)),
+            ("format", source_format),
+            ("columns", json.dumps(columns, ensure_ascii=False)),
+            ("count", str(count)),
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    
+    os.replace(tmp_path, index_path)
+    return index_path
+
+def export_catalog_jsonl(products: Dict[str, Dict], path: str):
+    """把字典形式的产品数据库导出为 JSONL，每行一个产品"""
+    with open(path, "w", encoding="utf-8") as f:
+        for name, info in products.items():
+            f.write(json.dumps({"name": name, **info}, ensure_ascii=False) + "\n")
+
+class _MappedCatalogGeneration(ProductCatalog):
+    """
+    MappedProductCatalog 的一次加载：索引连接、源文件映射与记录缓存。
+    
+    加载后不再改变；重新加载时换成新的实例，正在使用旧实例的查询继续读旧的一份，
+    最后一个引用释放时句柄随之关闭。
+    """
+    
+    def __init__(self, source_path: str, index_path: str, source_format: str, f, stat):
+        super().__init__()
+        self.source_format = source_format
+        self.source_stat = (stat.st_mtime_ns, stat.st_size)
+        self._lock = threading.RLock()
+        self._record_cache = OrderedDict()
+        self._conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True, check_same_thread=False)
+        self._source_conn = None
+        self._mmap = None
+        meta = dict(self._conn.execute("SELECT name, value FROM meta"))
+        self._count = int(meta["count"])
+        self._columns = json.loads(meta["columns"])
+        # 打开索引前它可能已被其他进程按源文件的另一个版本重建
+        self.index_matches = (meta.get("source_mtime_ns") == str(stat.st_mtime_ns)
+                              and meta.get("source_size") == str(stat.st_size))
+        
+        if source_format == "sqlite":
+            self._source_conn = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True,
+                                                check_same_thread=False)
+        elif stat.st_size > 0:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def close(self):
+        with self._lock:
+            for handle in (self._conn, self._source_conn, self._mmap):
+                if handle is not None:
+                    handle.close()
+    
+    def _query(self, sql: str, params=()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+    
+    def __len__(self):
+        return self._count
+    
+    def _lookup_id(self, key: str) -> Optional[int]:
+        rows = self._query("SELECT id FROM products WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+    
+    def _product_name(self, product_id: int) -> str:
+        return self._query("SELECT name FROM products WHERE id = ?", (product_id,))[0][0]
+    
+    def _record(self, product_id: int) -> Dict:
+        # execute_tool_calls 会在线程池中并发查询，缓存的读取、调整顺序与淘汰都在锁内进行
+        with self._lock:
+            record = self._record_cache.get(product_id)
+            if record is not None:
+                self._record_cache.move_to_end(product_id)
+                return record
+            
+            offset, length = self._query("SELECT offset, length FROM products WHERE id = ?", (product_id,))[0]
+            if self.source_format == "sqlite":
+                record_json = self._source_conn.execute(
+                    "SELECT record FROM products WHERE rowid = ?", (offset,)
+                ).fetchone()[0]
+                record = json.loads(record_json)
+            else:
+                text = self._mmap[offset:offset + length].decode("utf-8")
+                if self.source_format == "csv":
+                    record = _parse_csv_record(text, self._columns)
+                else:
+                    record = json.loads(text)
+                record.pop("name", None)
+            self._record_cache[product_id] = record
+            if len(self._record_cache) > MappedProductCatalog.RECORD_CACHE_SIZE:
+                self._record_cache.popitem(last=False)
+            return record
+    
+    def _posting_sizes(self, grams) -> Dict[str, int]:
+        grams = list(grams)
+        placeholders = ",".join("?" * len(grams))
+        return dict(self._query(
+            f"SELECT gram, COUNT(*) FROM grams WHERE gram IN ({placeholders}) GROUP BY gram", grams
+        ))
+    
+    def _count_shared(self, grams) -> Dict[int, tuple]:
+        grams = list(grams)
+        placeholders = ",".join("?" * len(grams))
+        rows = self._query(
+            "SELECT p.id, COUNT(*), p.key, p.gram_count FROM grams g JOIN products p ON p.id = g.product_id "
+            f"WHERE g.gram IN ({placeholders}) GROUP BY p.id", grams
+        )
+        return {product_id: (shared, key, gram_count) for product_id, shared, key, gram_count in rows}
+    
+    def _brand_ids(self, brand_key: str) -> List[int]:
+        return [row[0] for row in self._query("SELECT id FROM products WHERE brand_key = ? ORDER BY id",
+                                              (brand_key,))]
+    
+    def _price_ids(self, min_price: float, max_price: float) -> List[int]:
+        return [row[0] for row in self._query(
+            "SELECT id FROM products WHERE price_low <= ? AND price_high >= ? ORDER BY price_low, id",
+            (max_price, min_price)
+        )]
+    
+    def _iter_names_and_brands(self):
+        for name, product_id in self._query("SELECT name, id FROM products ORDER BY id"):
+            yield name, self._record(product_id).get("brand", "")
+
+class MappedProductCatalog(ProductCatalog):
+    """
+    从 JSONL / CSV / SQLite 文件加载的只读产品目录。
+    
+    - 启动时只打开磁盘索引并 mmap 源文件，耗时与目录规模无关
+    - 产品详情在被查询时才从 mmap 中按偏移读取并解析
+    - 多个工作进程打开同一份文件，共享操作系统页缓存中的同一份只读数据
+    - 源文件修改后（按 reload_interval 节流检查）自动重建索引并重新映射
+    
+    每次查询在锁内取一份当前加载的快照，整个查询都用这一份的索引与映射，
+    重新加载不会让同一次查询混用新旧两份数据。
+    
+    更新源文件时只能在末尾追加，或写临时文件后用 os.replace 原子替换：原地改写已有内容时，
+    旧映射在重新加载前会按过期的偏移读到错位的记录，文件被截断时读取甚至会触发 SIGBUS。
+    """
+    
+    # 最近读取过的产品详情缓存条数
+    RECORD_CACHE_SIZE = 1024
+    
+    def __init__(self, source_path: str, index_path: Optional[str] = None, reload_interval: float = 1.0):
+        super().__init__()
+        self.source_path = source_path
+        self.index_path = index_path or source_path + CATALOG_INDEX_SUFFIX
+        self.reload_interval = reload_interval
+        self.source_format = _catalog_source_format(source_path)
+        self._reload_lock = threading.Lock()
+        self._generation = None
+        self._last_check = 0.0
+        with self._reload_lock:
+            self._open()
+    
+    def add(self, name: str, info: Dict):
+        raise TypeError("MappedProductCatalog 是只读的，请修改源文件，目录会自动重新加载")
+    
+    def _index_is_current(self, stat) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        conn = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True)
+        try:
+            meta = dict(conn.execute("SELECT name, value FROM meta"))
+        except sqlite3.DatabaseError:
+            return False
+        finally:
+            conn.close()
+        return (meta.get("source_mtime_ns") == str(stat.st_mtime_ns)
+                and meta.get("source_size") == str(stat.st_size))
+    
+    def _open(self):
+        """
+        打开（必要时先重建）索引并映射源文件，调用方需持有 _reload_lock。
+        
+        stat、索引构建与 mmap 都基于同一个已打开的文件，源文件在此期间被替换也不会混用两个版本。
+        """
+        with open(self.source_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            for _ in range(3):
+                if not self._index_is_current(stat):
+                    logger.info("🔧 正在为产品目录 %s 构建索引...", self.source_path)
+                    _write_catalog_index(self.source_path, f if self.source_format != "sqlite" else None,
+                                         stat, self.index_path)
+                generation = _MappedCatalogGeneration(self.source_path, self.index_path,
+                                                      self.source_format, f, stat)
+                if generation.index_matches:
+                    break
+                generation.close()
+            else:
+                raise RuntimeError(f"产品目录 {self.source_path} 的索引被并发改写，请稍后重试")
+        self._generation = generation
+        self._last_check = time.monotonic()
+    
+    def close(self):
+        with self._reload_lock:
+            if self._generation is not None:
+                self._generation.close()
+    
+    def _snapshot(self) -> _MappedCatalogGeneration:
+        """返回当前加载的快照；源文件发生变化时先重新加载（热更新）"""
+        with self._reload_lock:
+            now = time.monotonic()
+            if now - self._last_check >= self.reload_interval:
+                self._last_check = now
+                try:
+                    stat = os.stat(self.source_path)
+                except FileNotFoundError:
+                    stat = None
+                if stat is not None and (stat.st_mtime_ns, stat.st_size) != self._generation.source_stat:
+                    logger.info("🔄 产品目录 %s 已更新，重新加载", self.source_path)
+                    self._open()
+            return self._generation
+    
+    def __len__(self):
+        return len(self._snapshot())
+    
+    def __contains__(self, name: str) -> bool:
+        return name in self._snapshot()
+    
+    def get(self, name: str) -> Optional[Dict]:
+        return self._snapshot().get(name)
+    
+    def search(self, query: str, top_k: int = 5, min_score: float = 0.3) -> List[tuple]:
+        return self._snapshot().search(query, top_k=top_k, min_score=min_score)
+    
+    def resolve(self, query: str) -> Optional[str]:
+        return self._snapshot().resolve(query)
+    
+    def by_brand(self, brand: str) -> List[str]:
+        return self._snapshot().by_brand(brand)
+    
+    def by_price(self, min_price: float = 0, max_price: float = float("inf")) -> List[str]:
+        return self._snapshot().by_price(min_price, max_price)
+    
+    def format_product(self, name: str) -> str:
+        return self._snapshot().format_product(name)
+    
+    def miss_message(self, query: str) -> str:
+        return self._snapshot().miss_message(query)
+
+def load_product_catalog(path: Optional[str] = None) -> ProductCatalog:
+    """
+    加载产品目录：指定 path（或环境变量 REDNOTE_CATALOG_PATH）时从文件懒加载，
+    否则使用内置的蓝牙耳机数据库。
+    """
+    path = path or os.environ.get("REDNOTE_CATALOG_PATH")
+    if path:
+        return MappedProductCatalog(path)
+    return ProductCatalog(bluetooth_headphones_database)
+
+_catalog_lock = threading.Lock()
+
+def get_product_catalog() -> ProductCatalog:
+    """返回全局产品目录，首次调用时才建立索引"""
+    catalog = globals().get("product_catalog")
+    if catalog is None:
+        with _catalog_lock:
+            catalog = globals().get("product_catalog")
+            if catalog is None:
+                catalog = load_product_catalog()
+                globals()["product_catalog"] = catalog
+    return catalog
+
+def __getattr__(name: str):
+    """兼容直接访问模块属性 ollama_client / product_catalog 的旧代码，访问时才初始化"""
+    if name == "ollama_client":
+        return get_ollama_client()
+    if name == "product_catalog":
+        return get_product_catalog()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # 改进的产品查询函数（使用真实蓝牙耳机数据）
 def enhanced_query_product_database(product_name: str) -> str:
     """
     使用真实蓝牙耳机产品数据查询，替代模拟工具
     """
-    if product_name in bluetooth_headphones_database:
-        product = bluetooth_headphones_database[product_name]
-        info = f"{product_name} 详细产品信息：\n"
-        
-        if "brand" in product:
-            info += f"🏷️  品牌：{product['brand']}\n"
-        
-        if "features" in product:
-            info += f"✨ 主要特点：{', '.join(product['features'])}\n"
-        
-        if "battery_life" in product:
-            info += f"🔋 续航能力：{product['battery_life']}\n"
-        
-        if "connectivity" in product:
-            info += f"📡 连接技术：{product['connectivity']}\n"
-        
-        if "target_audience" in product:
-            info += f"👥 目标用户：{product['target_audience']}\n"
-        
-        if "price_range" in product:
-            info += f"💰 价格区间：{product['price_range']}\n"
-        
-        if "special_features" in product:
-            info += f"🌟 特色功能：{product['special_features']}"
-        
-        return info
-    else:
-        # 如果找不到精确匹配，尝试模糊匹配
-        for key in bluetooth_headphones_database.keys():
-            if product_name.lower() in key.lower() or key.lower() in product_name.lower():
-                return enhanced_query_product_database(key)
-        
-        return f"未找到产品 {product_name} 的信息。\n\n可用的蓝牙耳机产品：\n" + \
-               "\n".join([f"- {name} ({bluetooth_headphones_database[name]['brand']})" for name in bluetooth_headphones_database.keys()])
+    catalog = get_product_catalog()
+    matched_name = catalog.resolve(product_name)
+    if matched_name is not None:
+        return catalog.format_product(matched_name)
+    return catalog.miss_message(product_name)
 
 # 表情符号生成函数
 def mock_generate_emoji(context: str) -> list:
@@ -295,75 +2102,1117 @@ TOOLS = {
     "generate_emoji": mock_generate_emoji,
 }
 
-print("✅ 改进的工具函数创建完成！")
+# 同一轮中多个工具调用并发执行时的线程数上限
+TOOL_MAX_WORKERS = 4
+
+def _run_tool_call(tool_call: Dict) -> Dict:
+    """执行单个工具调用，返回可直接追加到对话历史的 tool 消息"""
+    function = tool_call.get("function", {})
+    function_name = function.get("name", "")
+    function_args = function.get("arguments") or {}
+    
+    with telemetry.span("tool.call", tool=function_name) as span:
+        try:
+            # Ollama 直接返回字典参数，OpenAI 风格的接口则返回 JSON 字符串
+            if isinstance(function_args, str):
+                function_args = json.loads(function_args) if function_args.strip() else {}
+            
+            if function_name in TOOLS:
+                logger.info("🛠️  调用工具 '%s'，参数：%s", function_name, function_args)
+                tool_result = TOOLS[function_name](**function_args)
+                if not isinstance(tool_result, str):
+                    tool_result = json.dumps(tool_result, ensure_ascii=False)
+                logger.debug("👀 工具返回结果：%s", tool_result[:200])
+                status = "ok"
+            else:
+                logger.warning("⚠️  未知的工具函数 '%s'", function_name)
+                tool_result = f"工具 '{function_name}' 不存在"
+                status = "unknown"
+        except Exception as e:
+            logger.error("❌ 工具 '%s' 执行失败: %s", function_name, e)
+            tool_result = f"工具 '{function_name}' 执行失败：{e}"
+            status = "error"
+            span.error = f"{e.__class__.__name__}: {e}"
+        span.set(status=status, result_chars=len(tool_result))
+    telemetry.tool_calls.inc(tool=function_name, status=status)
+    telemetry.tool_seconds.observe(span.duration, tool=function_name)
+    
+    tool_message = {"role": "tool", "tool_name": function_name, "content": tool_result}
+    if "id" in tool_call:
+        tool_message["tool_call_id"] = tool_call["id"]
+    return tool_message
+
+def execute_tool_calls(tool_calls: List[Dict], max_workers: int = TOOL_MAX_WORKERS) -> List[Dict]:
+    """
+    执行模型在一轮中发起的全部工具调用。
+    
+    多个调用在线程池中并发执行，返回的 tool 消息顺序与 tool_calls 保持一致。
+    """
+    if len(tool_calls) <= 1 or max_workers <= 1:
+        return [_run_tool_call(tool_call) for tool_call in tool_calls]
+    
+    # 每个任务在调用方上下文的副本中运行，工具调用的 span 挂在当前迭代下
+    contexts = [contextvars.copy_context() for _ in tool_calls]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tool_calls))) as executor:
+        return list(executor.map(lambda context, tool_call: context.run(_run_tool_call, tool_call),
+                                 contexts, tool_calls))
 
-def generate_rednote_with_private_model(product_name: str, tone_style: str = "科技酷炫", max_iterations: int = 5) -> str:
+class StreamingJsonExtractor:
     """
-    使用私有化部署的 DeepSeek-R1 模型生成小红书爆款文案。
+    增量提取模型输出中的 JSON 对象，取代只认 ```json 围栏的正则。
+    
+    - 跳过 DeepSeek-R1 的 <think>...</think> 推理段落；只出现 </think> 时（Ollama 模板省略了开启标签），
+      其之前的内容同样视为推理过程
+    - 按大括号配平扫描，字符串内的括号与转义字符不计入，嵌套对象也能完整取出；有没有围栏都能识别
+    - feed 每次只扫描新到达的文本，候选对象一闭合就返回
+    - 正文里不成对的 { 不会吞掉后面的真正答案：未闭合时遇到新的 ```json 围栏就从围栏处重新扫描；
+      闭合后无法解析（或到结束仍未闭合）的候选，从其起点之后的下一个 { 重新扫描
+    
+    每个候选是 {"text": 对象文本, "fenced": 是否位于 ``` 围栏内, "truncated": 是否未闭合}。
+    """
+    
+    THINK_OPEN = "<think>"
+    THINK_CLOSE = "</think>"
+    FENCE_OPEN = "```json"
+    _OUTSIDE = re.compile(r"[{<]")
+    
+    def __init__(self):
+        self.buffer = ""
+        self.candidates: List[Dict] = []
+        self._pos = 0
+        self._in_think = False
+        self._depth = 0
+        self._start = -1
+        self._in_string = False
+        self._escape = False
+    
+    def _reset_scan(self):
+        self._depth = 0
+        self._start = -1
+        self._in_string = False
+        self._escape = False
+    
+    def feed(self, text: str) -> Optional[Dict]:
+        """追加文本，返回本次新闭合的最后一个候选对象（没有则返回 None）"""
+        self.buffer += text
+        buffer = self.buffer
+        length = len(buffer)
+        completed = None
+        i = self._pos
+        
+        while i < length:
+            if self._in_think:
+                close = buffer.find(self.THINK_CLOSE, i)
+                if close < 0:
+                    # 结束标签可能被拆分在两个数据块之间，回退标签长度后下次再找
+                    i = max(i, length - len(self.THINK_CLOSE) + 1)
+                    break
+                self._in_think = False
+                i = close + len(self.THINK_CLOSE)
+                continue
+            
+            if self._depth == 0:
+                match = self._OUTSIDE.search(buffer, i)
+                if match is None:
+                    i = length
+                    break
+                i = match.start()
+                if buffer[i] == "{":
+                    self._start = i
+                    self._depth = 1
+                    i += 1
+                    continue
+                rest = buffer[i:i + len(self.THINK_CLOSE)]
+                if rest.startswith(self.THINK_OPEN):
+                    self._in_think = True
+                    i += len(self.THINK_OPEN)
+                elif rest == self.THINK_CLOSE:
+                    self.candidates.clear()
+                    i += len(self.THINK_CLOSE)
+                elif len(rest) < len(self.THINK_CLOSE) and (
+                        self.THINK_OPEN.startswith(rest) or self.THINK_CLOSE.startswith(rest)):
+                    break  # 可能是被拆开的标签，等待更多文本
+                else:
+                    i += 1
+                continue
+            
+            char = buffer[i]
+            if char == "`" and not self._in_string and (i == 0 or buffer[i - 1] == "\n"):
+                rest = buffer[i:i + len(self.FENCE_OPEN)]
+                if rest == self.FENCE_OPEN:
+                    # 候选未闭合就开始了新的 ```json 围栏：之前的 { 只是正文里的普通字符
+                    self._reset_scan()
+                    continue
+                if self.FENCE_OPEN.startswith(rest):
+                    break  # 可能是被拆开的围栏标记，等待更多文本
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self._candidate(buffer[self._start:i + 1], truncated=False)
+                    self.candidates.append(candidate)
+                    if _load_candidate(candidate["text"])[0] is None:
+                        # 无法解析：起点的 { 可能是正文里的普通字符，从下一个字符起重新找对象
+                        i = self._start + 1
+                        self._reset_scan()
+                        continue
+                    completed = candidate
+            i += 1
+        
+        self._pos = i
+        return completed
+    
+    def _candidate(self, text: str, truncated: bool) -> Dict:
+        prefix = self.buffer[max(0, self._start - 16):self._start].rstrip()
+        return {"text": text, "fenced": prefix.endswith("```json") or prefix.endswith("```"),
+                "truncated": truncated}
+    
+    def finish(self) -> List[Dict]:
+        """
+        数据流结束：未闭合的对象（输出被截断）也作为候选，返回全部候选。
+        
+        未闭合的对象之内可能还有完整的对象（起点的 { 是正文里的普通字符），重新扫描后一并加入；
+        未闭合的候选排在最后，与原先一样最先被尝试。
+        """
+        truncated = []
+        while self._depth > 0 and not self._in_think:
+            start = self._start
+            truncated.append(self._candidate(self.buffer[start:], truncated=True))
+            self._reset_scan()
+            self._pos = start + 1
+            self.feed("")
+        self.candidates.extend(reversed(truncated))
+        return self.candidates
+
+_JSON_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?")
+_JSON_WORD = re.compile(r"[^\W\d][\w$]*")
+_JSON_LITERALS = {"true": "true", "false": "false", "null": "null",
+                  "True": "true", "False": "false", "None": "null"}
+_STRING_QUOTES = {'"': '"', "'": "'", "“": "”"}
+
+def _read_string(text: str, start: int, closing: str):
+    """读取从 start（开引号之后）开始的字符串，返回 (JSON 字符串字面量, 结束位置)；未闭合时补上引号"""
+    parts = ['"']
+    i = start
+    while i < len(text) and text[i] != closing:
+        char = text[i]
+        if char == "\\" and i + 1 < len(text):
+            escaped = text[i + 1]
+            if escaped in '"\\/bfnrtu':
+                parts.append(text[i:i + 2])
+            elif escaped == "'":
+                parts.append("'")  # JSON 中 \' 不合法
+            else:
+                parts.append("\\\\" + escaped)
+            i += 2
+            continue
+        parts.append('\\"' if char == '"' else char)
+        i += 1
+    parts.append('"')
+    return "".join(parts), i + 1
+
+def repair_json(text: str) -> str:
+    """
+    本地修复模型常见的 JSON 格式问题，返回修复后的文本（不保证一定能解析）：
+    
+    尾随逗号、缺少的逗号、单引号或中文引号字符串、未加引号的键、注释、
+    Python 风格的 True/False/None、中文逗号与冒号，以及输出被截断时缺少的引号和括号。
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    previous = None  # 上一个有效记号：open / comma / colon / value
+    i = 0
+    length = len(text)
+    
+    def emit_value(token: str):
+        nonlocal previous
+        if previous == "value":
+            out.append(",")
+        out.append(token)
+        previous = "value"
+    
+    def close_container(closing: str):
+        nonlocal previous
+        if previous == "comma":
+            del out[len(out) - 1 - out[::-1].index(",")]
+        elif previous == "colon":
+            out.append("null")
+        out.append(closing)
+        previous = "value"
+    
+    while i < length:
+        char = text[i]
+        if char in _STRING_QUOTES:
+            literal, i = _read_string(text, i + 1, _STRING_QUOTES[char])
+            emit_value(literal)
+        elif char in "{[":
+            emit_value(char)
+            stack.append("}" if char == "{" else "]")
+            previous = "open"
+            i += 1
+        elif char in "}]":
+            if stack:
+                # 括号不匹配时先补齐内层
+                while stack and stack[-1] != char and char in stack:
+                    close_container(stack.pop())
+                if stack and stack[-1] == char:
+                    close_container(stack.pop())
+            i += 1
+        elif char in ",，":
+            if previous == "value":
+                out.append(",")
+                previous = "comma"
+            i += 1
+        elif char in ":：":
+            out.append(":")
+            previous = "colon"
+            i += 1
+        elif text.startswith("//", i):
+            newline = text.find("\n", i)
+            i = length if newline < 0 else newline + 1
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = length if end < 0 else end + 2
+        elif char == "-" or char.isdigit():
+            match = _JSON_NUMBER.match(text, i)
+            if match:
+                emit_value(match.group())
+                i = match.end()
+            else:
+                i += 1
+        elif _JSON_WORD.match(text, i):
+            word = _JSON_WORD.match(text, i).group()
+            i += len(word)
+            if word in _JSON_LITERALS:
+                emit_value(_JSON_LITERALS[word])
+            else:
+                emit_value(json.dumps(word))  # 未加引号的键或值
+        else:
+            i += 1  # 空白与无法识别的字符
+    
+    while stack:
+        close_container(stack.pop())
+    return "".join(out)
+
+REDNOTE_TEXT_FIELDS = ("title", "body")
+REDNOTE_LIST_FIELDS = ("hashtags", "emojis")
+
+def validate_rednote(data) -> tuple:
+    """
+    按小红书文案结构校验并规范化，返回 (规范化后的字典或 None, 问题列表)。
+    
+    四个字段都必须存在：title / body 为非空字符串，hashtags / emojis 为字符串数组；
+    以空格或逗号分隔的字符串会拆成数组，缺少 # 的标签会补上，{"rednote": {...}} 这类包裹层会被去掉。
+    """
+    if not isinstance(data, dict):
+        return None, ["顶层必须是 JSON 对象"]
+    fields = REDNOTE_TEXT_FIELDS + REDNOTE_LIST_FIELDS
+    if len(data) == 1 and not any(key in data for key in fields):
+        inner = next(iter(data.values()))
+        if isinstance(inner, dict):
+            data = inner
+    
+    result = dict(data)
+    errors = []
+    missing = [key for key in fields if key not in data]
+    if missing:
+        errors.append(f"缺少字段 {', '.join(missing)}")
+    for key in REDNOTE_TEXT_FIELDS:
+        value = data.get(key)
+        if key in missing:
+            continue
+        if not isinstance(value, str) or not value.strip():
+            errors.append(f"字段 {key} 必须是非空字符串")
+        else:
+            result[key] = value.strip()
+    for key in REDNOTE_LIST_FIELDS:
+        value = data.get(key)
+        if key in missing:
+            continue
+        if isinstance(value, str):
+            value = re.split(r"[\s,，、]+", value)
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            errors.append(f"字段 {key} 必须是字符串数组")
+            continue
+        result[key] = [item.strip() for item in value if item.strip()]
+    if errors:
+        return None, errors
+    result["hashtags"] = [tag if tag.startswith("#") else f"#{tag}" for tag in result["hashtags"]]
+    return result, []
+
+def _load_candidate(text: str):
+    """先按原样解析，失败时修复后再解析；返回 (对象或 None, 是否经过修复)"""
+    try:
+        return json.loads(text, strict=False), False
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair_json(text), strict=False), True
+    except json.JSONDecodeError:
+        return None, True
+
+def parse_rednote_json(content: str) -> Dict:
+    """
+    从完整的模型回复中取出小红书文案。
+    
+    从后往前尝试各个候选对象（最终答案通常在最后），返回
+    {"data", "json", "repaired", "errors"}：成功时 data 为规范化后的字典、json 为其序列化结果；
+    失败时 errors 给出最后一个候选的具体问题，可以直接反馈给模型。
+    """
+    extractor = StreamingJsonExtractor()
+    extractor.feed(content)
+    candidates = extractor.finish()
+    errors = ["未找到 JSON 对象"] if not candidates else []
+    for candidate in reversed(candidates):
+        data, repaired = _load_candidate(candidate["text"])
+        problems = ["JSON 语法错误，本地无法修复"] if data is None else []
+        if data is not None:
+            data, problems = validate_rednote(data)
+        if not problems:
+            return {"data": data, "json": json.dumps(data, ensure_ascii=False, indent=2),
+                    "repaired": repaired or candidate["truncated"], "errors": []}
+        if not errors:
+            errors = problems
+    return {"data": None, "json": None, "repaired": False, "errors": errors}
+
+# Ollama 在非流式响应和流式的最后一个数据块中给出的耗时（纳秒）与 token 统计
+OLLAMA_STATS_FIELDS = ("total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                       "eval_count", "eval_duration")
+
+class StreamCollector:
     """
+    把流式数据块拼装成与非流式调用相同结构的响应，同步与异步数据流共用。
+    
+    一旦收到完整的最终 JSON（围栏内可解析的对象，或符合文案结构的裸对象），
+    add 返回 True 提示调用方停止读取，结果中 early_stop 为 True；
+    读到最后一个数据块时，结果中带有 Ollama 的 OLLAMA_STATS_FIELDS 统计字段。
+    """
+    
+    def __init__(self, on_token: Optional[Callable[[str], None]] = None):
+        self.on_token = on_token
+        self.extractor = StreamingJsonExtractor()
+        self.content_parts = []
+        self.tool_calls = []
+        self.error = None
+        self.done = False
+        self.early_stop = False
+        self.stats = {}
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+    
+    def add(self, chunk: Dict) -> bool:
+        """处理一个数据块，返回 True 表示无需继续读取"""
+        if "error" in chunk:
+            self.error = chunk["error"]
+            return True
+        
+        message = chunk.get("message", {})
+        token = message.get("content", "")
+        self.tool_calls.extend(message.get("tool_calls") or [])
+        
+        if token:
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter() - self.start_time
+                logger.info("⚡ 首个 token 延迟: %.2f 秒", self.first_token_time)
+            self.content_parts.append(token)
+            if self.on_token:
+                self.on_token(token)
+            
+            candidate = self.extractor.feed(token)
+            if candidate is not None and self._is_final(candidate):
+                self.early_stop = True
+                logger.info("✂️  已收到完整 JSON，提前结束生成")
+                return True
+        
+        if chunk.get("done"):
+            self.done = True
+            self.stats = {field: chunk[field] for field in OLLAMA_STATS_FIELDS if field in chunk}
+            return True
+        return False
     
-    print(f"\n🚀 启动私有化模型小红书文案生成助手，产品：{product_name}，风格：{tone_style}")
-    print(f"🔧 使用模型：{ollama_client.model_name}")
-    print(f"🌐 模型地址：{ollama_client.base_url}")
+    @staticmethod
+    def _is_final(candidate: Dict) -> bool:
+        """围栏内的对象能解析即可；没有围栏的对象还必须符合文案结构，避免在中间输出的 JSON 片段处停下"""
+        data, _ = _load_candidate(candidate["text"])
+        if data is None:
+            return False
+        return candidate["fenced"] or validate_rednote(data)[0] is not None
+    
+    def result(self) -> Dict:
+        """返回与 chat_completion 相同结构的响应字典"""
+        if self.error is not None:
+            return {"error": self.error}
+        
+        message = {"role": "assistant", "content": "".join(self.content_parts)}
+        if self.tool_calls:
+            message["tool_calls"] = self.tool_calls
+        return {
+            "message": message,
+            "done": self.done,
+            "early_stop": self.early_stop,
+            "time_to_first_token": self.first_token_time,
+            **self.stats,
+        }
+
+def collect_stream_response(chunks: Iterator[Dict],
+                            on_token: Optional[Callable[[str], None]] = None) -> Dict:
+    """
+    消费流式数据块并拼装成与非流式调用相同结构的响应。
     
-    # 存储对话历史，包括系统提示词和用户请求
-    messages = [
+    一旦收到完整的最终 JSON 就关闭数据流，返回结果中 early_stop 为 True。
+    """
+    collector = StreamCollector(on_token)
+    try:
+        for chunk in chunks:
+            if collector.add(chunk):
+                break
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+    return collector.result()
+
+def build_rednote_messages(product_name: str, tone_style: str) -> List[Dict]:
+    """构造初始对话：系统提示词 + 用户请求（同步与异步 Agent 共用）"""
+    return [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": f"请为产品「{product_name}」生成一篇小红书爆款文案。要求：语气{tone_style}，包含标题、正文、至少5个相关标签和5个表情符号。请以完整的JSON格式输出，并确保JSON内容用markdown代码块包裹（例如：```json{{...}}```）。"}
     ]
+
+_THINK_BLOCK = re.compile(r"<think>.*?</think>", re.DOTALL)
+
+def strip_think_blocks(content: str) -> str:
+    """
+    去掉 DeepSeek-R1 的推理段落：完整的 <think>...</think>、
+    缺少开启标签时最后一个 </think> 之前的内容，以及未闭合的 <think> 之后的内容（流式提前结束）。
+    """
+    content = _THINK_BLOCK.sub("", content)
+    if StreamingJsonExtractor.THINK_CLOSE in content:
+        content = content.rsplit(StreamingJsonExtractor.THINK_CLOSE, 1)[1]
+    if StreamingJsonExtractor.THINK_OPEN in content:
+        content = content.split(StreamingJsonExtractor.THINK_OPEN, 1)[0]
+    return content.strip()
+
+class ConversationHistory:
+    """
+    Agent 循环的对话历史，控制每轮请求的提示长度。
+    
+    - 系统提示词与用户请求构成固定前缀，每轮原样发送；连同 TOOLS_DEFINITION 一起逐字节不变，
+      Ollama 就能复用上一轮的 KV 缓存，只需预填充前缀之后的消息
+    - 助手回复去掉 <think> 推理段落后再写回历史，推理过程不会逐轮累积
+    - 工具调用及其结果完整保留；未通过校验的草稿只保留最近 keep_drafts 份（连同对应的纠正提示），
+      更早的草稿直接丢弃
+    """
+    
+    def __init__(self, product_name: str, tone_style: str, keep_drafts: int = 1):
+        self.prefix = tuple(build_rednote_messages(product_name, tone_style))
+        self.keep_drafts = keep_drafts
+        self.turns = []  # [(kind, [message, ...])]，kind 为 "tool" 或 "draft"
+        self.dropped_drafts = 0
+    
+    def add_tool_round(self, content: str, tool_calls: List[Dict], results: List[Dict]):
+        """记录一轮工具调用：助手消息（去掉推理段落）与各工具的返回结果"""
+        assistant = {"role": "assistant", "content": strip_think_blocks(content), "tool_calls": tool_calls}
+        self.turns.append(("tool", [assistant] + list(results)))
+    
+    def add_failed_draft(self, content: str, correction: str):
+        """记录一份未通过校验的草稿和纠正提示，超出 keep_drafts 的旧草稿被丢弃"""
+        self.turns.append(("draft", [{"role": "assistant", "content": strip_think_blocks(content)},
+                                     {"role": "user", "content": correction}]))
+        drafts = [index for index, (kind, _) in enumerate(self.turns) if kind == "draft"]
+        for index in reversed(drafts[:max(0, len(drafts) - self.keep_drafts)]):
+            del self.turns[index]
+            self.dropped_drafts += 1
+    
+    def messages(self) -> List[Dict]:
+        """本轮请求要发送的消息列表"""
+        messages = list(self.prefix)
+        for _, turn in self.turns:
+            messages.extend(turn)
+        return messages
+    
+    def prompt_chars(self) -> int:
+        """消息内容的总字符数，用于粗略观察提示长度的变化"""
+        return sum(len(message.get("content") or "") for message in self.messages())
+
+def extract_final_json(content: str, messages) -> Optional[str]:
+    """
+    从模型回复中提取最终 JSON 文案。
+    
+    跳过 <think> 推理段落，有无 ```json 围栏都能识别，嵌套对象和常见格式问题在本地修复，
+    并按 title / body / hashtags / emojis 结构校验。成功时返回规范化后的 JSON 字符串；
+    失败时把回复和带有具体问题的纠正提示记录到 messages 并返回 None。
+    messages 可以是消息列表（原样追加），也可以是 ConversationHistory（按其规则压缩）。
+    """
+    result = parse_rednote_json(content)
+    
+    if result["data"] is not None:
+        suffix = "（已在本地修复格式问题）" if result["repaired"] else ""
+        logger.info("✅ 任务完成，成功解析最终JSON文案。%s", suffix)
+        return result["json"]
+    
+    if result["errors"] == ["未找到 JSON 对象"]:
+        logger.warning("⚠️  未找到完整JSON格式，继续迭代...")
+        correction = "请生成包含完整JSON格式的文案。"
+    else:
+        problems = "；".join(result["errors"])
+        logger.warning("❌ JSON格式验证失败: %s", problems)
+        correction = f"请重新生成正确格式的JSON文案。存在的问题：{problems}"
+    
+    if isinstance(messages, ConversationHistory):
+        messages.add_failed_draft(content, correction)
+    else:
+        messages.append({"role": "assistant", "content": content})
+        messages.append({"role": "user", "content": correction})
+    return None
+
+def agent_chat_options(options: Optional[Dict] = None) -> Dict:
+    """Agent 请求的 Ollama options：固定的 num_ctx，调用方传入的参数优先"""
+    return {"num_ctx": default_num_ctx(), **(options or {})}
+
+def record_prompt_usage(iteration: int, response: Dict, history: ConversationHistory,
+                        iteration_stats: Optional[List[Dict]] = None) -> Dict:
+    """
+    打印并记录本轮请求的提示规模。
+    
+    prompt_eval_count 是 Ollama 实际预填充的 token 数：命中提示缓存时只统计前缀之后的部分；
+    流式生成提前结束时 Ollama 不会返回该字段，记为 None。
+    """
+    usage = {
+        "iteration": iteration,
+        "messages": len(history.messages()),
+        "prompt_chars": history.prompt_chars(),
+        "prompt_eval_count": response.get("prompt_eval_count"),
+        "prompt_eval_seconds": response.get("prompt_eval_duration", 0) / 1e9 or None,
+    }
+    if usage["prompt_eval_count"] is None:
+        logger.info("📏 提示 %d 条消息 / %d 字符，预填充 tokens 未知", usage["messages"], usage["prompt_chars"])
+    else:
+        seconds = f"，{usage['prompt_eval_seconds']:.2f} 秒" if usage["prompt_eval_seconds"] else ""
+        logger.info("📏 提示 %d 条消息 / %d 字符，预填充 %d tokens%s",
+                    usage["messages"], usage["prompt_chars"], usage["prompt_eval_count"], seconds)
+    span = telemetry.current_span()
+    if span is not None:
+        span.set(messages=usage["messages"], prompt_chars=usage["prompt_chars"],
+                 prompt_eval_count=usage["prompt_eval_count"],
+                 time_to_first_token=response.get("time_to_first_token"))
+    if iteration_stats is not None:
+        iteration_stats.append(usage)
+    return usage
+
+class _CacheStats:
+    """缓存命中统计"""
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+    
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self),
+        }
+
+class MemoryLRUCache(_CacheStats):
+    """线程安全的内存 LRU 缓存，条目写入 ttl 秒后过期（ttl=None 表示永不过期）"""
+    
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 3600):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+    
+    def set(self, key: str, value: str):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SQLiteCache(_CacheStats):
+    """基于 SQLite 的磁盘缓存，进程重启后依然有效，可被多个进程共享"""
+    
+    def __init__(self, path: str = "rednote_cache.sqlite3", ttl: Optional[float] = None):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rednote_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        self._conn.commit()
+    
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM rednote_cache").fetchone()[0]
+    
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM rednote_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and (row[1] is None or row[1] > now):
+                self.hits += 1
+                return row[0]
+            if row is not None:
+                self._conn.execute("DELETE FROM rednote_cache WHERE key = ?", (key,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+    
+    def set(self, key: str, value: str):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rednote_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+            self._conn.commit()
+    
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM rednote_cache")
+            self._conn.commit()
+    
+    def close(self):
+        self._conn.close()
+
+# 文案缓存，可替换为 SQLiteCache 或设为 None 关闭缓存
+rednote_cache = MemoryLRUCache()
+
+def rednote_cache_key(model_name: str, product_name: str, tone_style: str,
+                      options: Optional[Dict] = None) -> str:
+    """
+    计算文案缓存键：模型、产品、风格、采样参数以及提示词与工具定义的哈希。
+    
+    修改 SYSTEM_PROMPT 或 TOOLS_DEFINITION 后旧缓存自然失效。
+    """
+    digest = hashlib.sha256()
+    parts = (
+        model_name,
+        product_name,
+        tone_style,
+        SYSTEM_PROMPT,
+        json.dumps(TOOLS_DEFINITION, sort_keys=True, ensure_ascii=False),
+        json.dumps(options or {}, sort_keys=True),
+    )
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _lookup_rednote_cache(model_name: str, product_name: str, tone_style: str,
+                          options: Optional[Dict], use_cache: bool):
+    """返回 (缓存键, 命中的文案)；未启用缓存时缓存键为 None"""
+    if rednote_cache is None:
+        return None, None
+    cache_key = rednote_cache_key(model_name, product_name, tone_style, options)
+    if not use_cache:
+        return cache_key, None
+    cached = rednote_cache.get(cache_key)
+    telemetry.cache_requests.inc(result="miss" if cached is None else "hit")
+    if cached is not None:
+        telemetry.agent_runs.inc(outcome="cache_hit")
+        logger.info("⚡ 命中文案缓存：%s（%s）", product_name, tone_style)
+    return cache_key, cached
+
+class GenerationCancelled(Exception):
+    """
+    调用方要求停止生成，例如 on_token 写出时发现客户端已断开。
+    
+    Agent 循环不把它当作模型错误记录堆栈，而是原样抛给调用方，也不会写入文案缓存。
+    """
+
+def _record_iteration(span: Span, outcome: str, error: Optional[str] = None):
+    """记录一轮 Agent 迭代的结果：tool_calls / final / retry / error / cancelled"""
+    span.set(outcome=outcome)
+    if error is not None:
+        span.error = error
+    telemetry.agent_iterations.inc(outcome=outcome)
+
+def _record_run(span: Span, success: bool, iterations: int, history: ConversationHistory):
+    """记录一次文案生成的结果、迭代次数与总耗时"""
+    outcome = "success" if success else "failure"
+    span.set(outcome=outcome, iterations=iterations, dropped_drafts=history.dropped_drafts)
+    telemetry.agent_runs.inc(outcome=outcome)
+    telemetry.agent_seconds.observe(span.duration, outcome=outcome)
+    logger.info("⏱️  文案生成%s，%d 轮迭代，耗时 %.2f 秒", "完成" if success else "失败", iterations, span.duration)
+
+def generate_rednote_with_private_model(product_name: str, tone_style: str = "科技酷炫", max_iterations: int = 5,
+                                       stream: bool = False,
+                                       on_token: Optional[Callable[[str], None]] = None,
+                                       options: Optional[Dict] = None,
+                                       use_cache: bool = True,
+                                       iteration_stats: Optional[List[Dict]] = None) -> str:
+    """
+    使用私有化部署的 DeepSeek-R1 模型生成小红书爆款文案。
+    
+    stream=True 时以流式方式读取模型输出，检测到闭合的 ```json 代码块即提前结束，
+    on_token 回调会收到每个新生成的文本片段；回调抛出 GenerationCancelled 时停止生成并向上抛出。
+    
+    对话历史由 ConversationHistory 管理：推理段落和旧草稿不会回传给模型，
+    每轮请求的提示规模打印出来，传入 iteration_stats 列表时同时追加到其中。
+    
+    相同模型、产品、风格和采样参数的结果会写入 rednote_cache；
+    use_cache=False 时跳过缓存读取，总是重新生成（新结果仍会刷新缓存）。
+    """
+    
+    ollama_client = get_ollama_client()
+    cache_key, cached = _lookup_rednote_cache(ollama_client.model_name, product_name, tone_style,
+                                              options, use_cache)
+    if cached is not None:
+        return cached
+    
+    logger.info("🚀 启动私有化模型小红书文案生成助手，产品：%s，风格：%s", product_name, tone_style)
+    logger.info("🔧 使用模型：%s，模型地址：%s", ollama_client.model_name, ollama_client.base_url)
+    
+    # 存储对话历史：固定的系统提示词和用户请求前缀，加上压缩后的工具调用与草稿
+    history = ConversationHistory(product_name, tone_style)
+    chat_options = agent_chat_options(options)
     
     iteration_count = 0
     final_response = None
     
-    while iteration_count < max_iterations:
-        iteration_count += 1
-        print(f"\n-- 迭代 {iteration_count} --")
-        
-        try:
-            # 调用私有化部署的模型，传入对话历史和工具定义
-            response = ollama_client.chat_completion(
-                messages=messages,
-                tools=TOOLS_DEFINITION
-            )
-            
-            if "error" in response:
-                print(f"❌ 模型调用失败: {response['error']}")
-                break
-            
-            response_message = response.get("message", {})
-            content = response_message.get("content", "")
+    with telemetry.span("agent.run", product=product_name, tone=tone_style,
+                        model=ollama_client.model_name, stream=stream) as run_span:
+        while iteration_count < max_iterations:
+            iteration_count += 1
+            logger.info("-- 迭代 %d --", iteration_count)
             
-            print(f"🤖 模型响应: {content[:200]}...")
-            
-            # 检查是否包含完整的JSON格式文案
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', content, re.DOTALL)
-            
-            if json_match:
+            with telemetry.span("agent.iteration", iteration=iteration_count) as span:
                 try:
-                    json_str = json_match.group(1)
-                    json.loads(json_str)  # 验证JSON格式
-                    final_response = json_str
-                    print("✅ 任务完成，成功解析最终JSON文案。")
+                    # 调用私有化部署的模型，传入对话历史和工具定义
+                    if stream:
+                        response = collect_stream_response(
+                            ollama_client.chat_completion_stream(messages=history.messages(),
+                                                                 tools=TOOLS_DEFINITION, options=chat_options),
+                            on_token=on_token
+                        )
+                    else:
+                        response = ollama_client.chat_completion(
+                            messages=history.messages(),
+                            tools=TOOLS_DEFINITION,
+                            options=chat_options
+                        )
+                    
+                    if "error" in response:
+                        logger.error("❌ 模型调用失败: %s", response["error"])
+                        _record_iteration(span, "error")
+                        break
+                    
+                    record_prompt_usage(iteration_count, response, history, iteration_stats)
+                    response_message = response.get("message", {})
+                    content = response_message.get("content", "")
+                    tool_calls = response_message.get("tool_calls") or []
+                    
+                    logger.debug("🤖 模型响应: %s...", content[:200])
+                    
+                    # ReAct 模式：模型决定调用工具时执行工具，并把结果作为 tool 消息回传
+                    if tool_calls:
+                        logger.info("🔧 模型请求调用 %d 个工具", len(tool_calls))
+                        history.add_tool_round(content, tool_calls, execute_tool_calls(tool_calls))
+                        _record_iteration(span, "tool_calls")
+                        continue
+                    
+                    # 检查是否包含完整的JSON格式文案
+                    final_response = extract_final_json(content, history)
+                    _record_iteration(span, "final" if final_response else "retry")
+                    if final_response:
+                        break
+                
+                except GenerationCancelled:
+                    logger.info("⏹️  调用方已取消生成")
+                    _record_iteration(span, "cancelled")
+                    raise
+                except Exception as e:
+                    logger.exception("❌ 错误：%s", e)
+                    _record_iteration(span, "error", f"{e.__class__.__name__}: {e}")
                     break
-                except json.JSONDecodeError as e:
-                    print(f"❌ JSON格式验证失败: {e}")
-                    messages.append({"role": "assistant", "content": content})
-                    messages.append({"role": "user", "content": "请重新生成正确格式的JSON文案。"})
-            else:
-                print("⚠️  未找到完整JSON格式，继续迭代...")
-                messages.append({"role": "assistant", "content": content})
-                messages.append({"role": "user", "content": "请生成包含完整JSON格式的文案。"})
         
-        except Exception as e:
-            print(f"❌ 错误：{e}")
-            break
+        _record_run(run_span, final_response is not None, iteration_count, history)
+    
+    if final_response:
+        if cache_key is not None:
+            rednote_cache.set(cache_key, final_response)
+        return final_response
+    else:
+        return "{\"error\": \"文案生成失败，请重试\"}"
+
+async def collect_stream_response_async(chunks, on_token: Optional[Callable[[str], None]] = None) -> Dict:
+    """collect_stream_response 的异步版本，消费异步数据流"""
+    collector = StreamCollector(on_token)
+    try:
+        async for chunk in chunks:
+            if collector.add(chunk):
+                break
+    finally:
+        await chunks.aclose()
+    return collector.result()
+
+async def execute_tool_calls_async(tool_calls: List[Dict]) -> List[Dict]:
+    """在默认线程池中并发执行工具调用，不阻塞事件循环"""
+    import asyncio
+    
+    return list(await asyncio.gather(
+        *(asyncio.to_thread(_run_tool_call, tool_call) for tool_call in tool_calls)
+    ))
+
+async def generate_rednote_with_private_model_async(product_name: str, tone_style: str = "科技酷炫",
+                                                    max_iterations: int = 5,
+                                                    client: Optional[AsyncOllamaClient] = None,
+                                                    stream: bool = False,
+                                                    on_token: Optional[Callable[[str], None]] = None,
+                                                    options: Optional[Dict] = None,
+                                                    use_cache: bool = True,
+                                                    iteration_stats: Optional[List[Dict]] = None) -> str:
+    """
+    generate_rednote_with_private_model 的异步版本，共用同一套提示词、工具定义与文案缓存。
+    
+    未传入 client 时会临时创建一个 AsyncOllamaClient（沿用全局 OllamaClient 的地址与模型），
+    服务场景下应在多个请求间共享同一个 client 以复用连接池。
+    """
+    sync_client = get_ollama_client() if client is None else None
+    model_name = client.model_name if client is not None else sync_client.model_name
+    cache_key, cached = _lookup_rednote_cache(model_name, product_name, tone_style, options, use_cache)
+    if cached is not None:
+        return cached
+    
+    owns_client = client is None
+    if owns_client:
+        client = AsyncOllamaClient(sync_client.base_url, keep_alive=getattr(sync_client, "keep_alive", None))
+        client.model_name = sync_client.model_name
+    
+    logger.info("🚀 启动异步私有化模型文案生成，产品：%s，风格：%s", product_name, tone_style)
+    history = ConversationHistory(product_name, tone_style)
+    chat_options = agent_chat_options(options)
+    final_response = None
+    iteration_count = 0
+    
+    try:
+        with telemetry.span("agent.run", product=product_name, tone=tone_style,
+                            model=client.model_name, stream=stream) as run_span:
+            for iteration_count in range(1, max_iterations + 1):
+                logger.info("-- 异步迭代 %d --", iteration_count)
+                
+                with telemetry.span("agent.iteration", iteration=iteration_count) as span:
+                    try:
+                        if stream:
+                            response = await collect_stream_response_async(
+                                client.chat_completion_stream(messages=history.messages(),
+                                                              tools=TOOLS_DEFINITION, options=chat_options),
+                                on_token=on_token
+                            )
+                        else:
+                            response = await client.chat_completion(messages=history.messages(),
+                                                                    tools=TOOLS_DEFINITION, options=chat_options)
+                        
+                        if "error" in response:
+                            logger.error("❌ 模型调用失败: %s", response["error"])
+                            _record_iteration(span, "error")
+                            break
+                        
+                        record_prompt_usage(iteration_count, response, history, iteration_stats)
+                        response_message = response.get("message", {})
+                        content = response_message.get("content", "")
+                        tool_calls = response_message.get("tool_calls") or []
+                        
+                        logger.debug("🤖 模型响应: %s...", content[:200])
+                        
+                        if tool_calls:
+                            logger.info("🔧 模型请求调用 %d 个工具", len(tool_calls))
+                            history.add_tool_round(content, tool_calls, await execute_tool_calls_async(tool_calls))
+                            _record_iteration(span, "tool_calls")
+                            continue
+                        
+                        final_response = extract_final_json(content, history)
+                        _record_iteration(span, "final" if final_response else "retry")
+                        if final_response:
+                            break
+                    
+                    except GenerationCancelled:
+                        logger.info("⏹️  调用方已取消生成")
+                        _record_iteration(span, "cancelled")
+                        raise
+                    except Exception as e:
+                        logger.exception("❌ 错误：%s", e)
+                        _record_iteration(span, "error", f"{e.__class__.__name__}: {e}")
+                        break
+            
+            _record_run(run_span, final_response is not None, iteration_count, history)
+    finally:
+        if owns_client:
+            await client.aclose()
     
     if final_response:
+        if cache_key is not None:
+            rednote_cache.set(cache_key, final_response)
         return final_response
     else:
         return "{\"error\": \"文案生成失败，请重试\"}"
 
-print("✅ 私有化模型文案生成函数创建完成！")
+def default_batch_concurrency() -> int:
+    """批量生成的默认并发数，与 Ollama 服务端的 OLLAMA_NUM_PARALLEL 保持一致"""
+    try:
+        return max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", "4")))
+    except ValueError:
+        return 4
+
+def _normalize_batch_job(job) -> Dict:
+    """把 (产品, 风格[, 优先级]) 元组或字典统一成任务字典"""
+    if not isinstance(job, dict):
+        job = dict(zip(("product_name", "tone_style", "priority"), job))
+    job = dict(job)
+    job.setdefault("tone_style", "科技酷炫")
+    job.setdefault("priority", 0)
+    job.setdefault("job_id", f"{job['product_name']}::{job['tone_style']}")
+    return job
+
+def load_batch_checkpoint(output_path: str) -> Dict[str, Dict]:
+    """
+    读取已写出的 JSONL 结果，返回成功完成的任务（job_id -> 记录）。
+    
+    进程崩溃时最后一行可能只写了一半，解析失败的行直接忽略。
+    """
+    completed = {}
+    if not output_path or not os.path.exists(output_path):
+        return completed
+    
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("status") == "ok":
+                completed[record["job_id"]] = record
+    return completed
+
+def generate_rednotes_batch(jobs: List, concurrency: Optional[int] = None,
+                            output_path: Optional[str] = None, resume: bool = True,
+                            max_iterations: int = 5) -> Dict[str, str]:
+    """
+    批量生成小红书文案。
+    
+    - jobs：任务列表，每项为 {"product_name", "tone_style", "priority", "job_id"} 字典
+      或 (product_name, tone_style[, priority]) 元组，priority 越大越先执行
+    - concurrency：并发数，默认取 OLLAMA_NUM_PARALLEL，超出服务端并行度只会排队
+    - output_path：每个任务完成后立即追加一行 JSONL 结果
+    - resume：从 output_path 中读取已成功的任务并跳过，实现断点续跑
+    
+    job_id 相同且产品、风格也相同的任务只执行一次（保留优先级最高的一个）；
+    job_id 相同但内容不同时抛出 ValueError，避免结果在断点文件中互相覆盖。
+    单个任务抛出异常时记为 status "error"，不影响其余任务的执行与写出。
+    
+    返回 job_id -> 文案 JSON 字符串。
+    """
+    concurrency = concurrency or default_batch_concurrency()
+    normalized = []
+    seen = {}
+    # 稳定排序：同优先级的任务保持提交顺序，重复的任务保留优先级最高的一个
+    for job in sorted((_normalize_batch_job(job) for job in jobs), key=lambda job: -job["priority"]):
+        content = (job["product_name"], job["tone_style"])
+        if job["job_id"] in seen:
+            if seen[job["job_id"]] != content:
+                raise ValueError(f"重复的 job_id: {job['job_id']}")
+            continue
+        seen[job["job_id"]] = content
+        normalized.append(job)
+    
+    results = {}
+    if resume and output_path:
+        for job_id, record in load_batch_checkpoint(output_path).items():
+            results[job_id] = record["result"]
+    pending = [job for job in normalized if job["job_id"] not in results]
+    
+    logger.info("📦 批量生成：共 %d 个任务，已完成 %d 个，待执行 %d 个，并发数 %d",
+                len(normalized), len(normalized) - len(pending), len(pending), concurrency)
+    
+    def run_job(job: Dict) -> Dict:
+        start = time.perf_counter()
+        try:
+            result = generate_rednote_with_private_model(job["product_name"], job["tone_style"],
+                                                         max_iterations=max_iterations)
+            status = "error" if "error" in json.loads(result) else "ok"
+        except json.JSONDecodeError:
+            status = "error"
+        except Exception as e:
+            logger.exception("❌ 批量任务 %s 失败: %s", job["job_id"], e)
+            result = json.dumps({"error": f"文案生成失败: {e}"}, ensure_ascii=False)
+            status = "error"
+        return {
+            "job_id": job["job_id"],
+            "product_name": job["product_name"],
+            "tone_style": job["tone_style"],
+            "status": status,
+            "result": result,
+            "elapsed": round(time.perf_counter() - start, 3),
+        }
+    
+    output_file = None
+    if output_path:
+        # 上次崩溃可能留下不完整的最后一行，先补换行，避免新记录与之拼在一起
+        needs_newline = False
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            with open(output_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        output_file = open(output_path, "a", encoding="utf-8")
+        if needs_newline:
+            output_file.write("\n")
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # 线程池按提交顺序取任务，因此高优先级任务先开始执行
+            futures = [executor.submit(run_job, job) for job in pending]
+            for done_count, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                results[record["job_id"]] = record["result"]
+                if output_file:
+                    output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output_file.flush()
+                logger.info("📦 [%d/%d] %s %s，耗时 %s 秒", done_count, len(pending), record['job_id'], record['status'],
+                            record['elapsed'])
+    finally:
+        if output_file:
+            output_file.close()
+    
+    return results
 
 def format_rednote_for_markdown(json_string: str) -> str:
     """
@@ -397,10 +3246,41 @@ def format_rednote_for_markdown(json_string: str) -> str:
         
     return markdown_output.strip()
 
-print("✅ 格式化函数创建完成！")
-
 # 主程序：生成蓝牙降噪耳机的小红书文案
-if __name__ == "__main__":
+def configure_logging(level: Optional[str] = None):
+    """命令行输出：日志只打印消息本身，级别取 REDNOTE_LOG_LEVEL（默认 INFO，DEBUG 时包含模型响应与 span）"""
+    level = (level or os.environ.get("REDNOTE_LOG_LEVEL", "INFO")).upper()
+    logging.basicConfig(level=getattr(logging, level, logging.INFO), format="%(message)s")
+
+def main():
+    """
+    命令行入口：检查私有化模型状态并生成蓝牙降噪耳机的小红书文案。
+    
+    设置 REDNOTE_METRICS_PORT 时在该端口提供 /metrics；设置 OTEL_EXPORTER_OTLP_ENDPOINT 时，
+    结束前把调用链与指标推送到 OpenTelemetry Collector。
+    """
+    global ollama_client
+    
+    configure_logging()
+    if os.environ.get("REDNOTE_METRICS_PORT"):
+        start_metrics_server(int(os.environ["REDNOTE_METRICS_PORT"]))
+    
+    print("🔧 第六章作业环境准备中...")
+    client = create_ollama_client(discover_model=False)
+    print("✅ 私有化 DeepSeek-R1 模型客户端初始化完成！")
+    print(f"🌐 Ollama API 地址: {client.base_url}")
+    if not os.environ.get("OLLAMA_MODEL"):
+        select_deepseek_model(client)
+    print(f"\n🎯 当前使用的模型: {client.model_name}")
+    ollama_client = client
+    
+    print(f"\n✅ 蓝牙降噪耳机产品数据库包含 {len(bluetooth_headphones_database)} 个产品！")
+    print("\n📱 产品列表：")
+    for product_name in bluetooth_headphones_database.keys():
+        brand = bluetooth_headphones_database[product_name]["brand"]
+        price = bluetooth_headphones_database[product_name]["price_range"]
+        print(f"  - {product_name} ({brand}) - {price}")
+    
     print("🎯 开始生成蓝牙降噪耳机的小红书文案...")
     print("="*60)
     print("📱 第六章作业：使用私有化部署的 DeepSeek-R1 模型")
@@ -414,7 +3294,7 @@ if __name__ == "__main__":
     
     product_name = "AirPods Pro"
     tone_style = "科技酷炫"
-    result = generate_rednote_with_private_model(product_name, tone_style)
+    result = generate_rednote_with_private_model(product_name, tone_style, stream=True)
     
     print("\n--- 生成的文案 (AirPods Pro) ---")
     print(result)
@@ -428,15 +3308,16 @@ if __name__ == "__main__":
     print("\n🔍 测试其他蓝牙耳机产品的文案生成...")
     print("-"*40)
     
-    # 测试 Sony WH-1000XM5
-    print("\n📝 测试 Sony WH-1000XM5 - 专业音质风格")
-    result_sony = generate_rednote_with_private_model("Sony WH-1000XM5", "专业音质")
+    # 批量生成 Sony WH-1000XM5 和小米 Buds 4 Pro 的文案
+    print("\n📝 批量测试 Sony WH-1000XM5（专业音质风格）和小米 Buds 4 Pro（性价比风格）")
+    batch_results = generate_rednotes_batch([
+        ("Sony WH-1000XM5", "专业音质"),
+        ("小米 Buds 4 Pro", "性价比"),
+    ])
+    result_sony = batch_results["Sony WH-1000XM5::专业音质"]
+    result_xiaomi = batch_results["小米 Buds 4 Pro::性价比"]
     print(f"\n✅ Sony 文案生成完成，长度: {len(result_sony)} 字符")
-    
-    # 测试小米 Buds 4 Pro
-    print("\n📝 测试小米 Buds 4 Pro - 性价比风格")
-    result_xiaomi = generate_rednote_with_private_model("小米 Buds 4 Pro", "性价比")
-    print(f"\n✅ 小米文案生成完成，长度: {len(result_xiaomi)} 字符")
+    print(f"✅ 小米文案生成完成，长度: {len(result_xiaomi)} 字符")
     
     # 测试改进后的产品查询系统
     print("\n🔍 测试改进后的蓝牙耳机产品查询系统")
@@ -535,3 +3416,10 @@ if __name__ == "__main__":
     print("请将此 Python 文件上传至 GitHub 或 Gitee，")
     print("然后将文件链接复制粘贴到作业提交页面。")
     print("="*60)
+    
+    print(f"\n📈 运行统计: {json.dumps(telemetry.summary(), ensure_ascii=False)}")
+    if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        print(f"📤 OTLP 导出: {telemetry.export_otlp()}")
+
+if __name__ == "__main__":
+    main()
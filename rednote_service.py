@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+第六章小红书文案助手的 HTTP 服务
+
+把 generate_rednote_with_private_model 包装成长期运行的服务：
+- POST /generate          {"product_name": "AirPods Pro", "tone_style": "科技酷炫", "options": {...}}
+                          返回文案 JSON、Markdown 以及是否命中缓存 / 合并到其他请求
+- POST /generate/stream   同样的请求体，以 NDJSON 逐段返回模型输出 {"token": ...}，
+                          最后一行为 {"done": true, "rednote": {...}}；客户端断开时停止生成
+- GET  /catalog?q=索尼&top_k=5   产品目录查询
+- GET  /healthz           运行中 / 排队中的生成任务数
+- GET  /metrics           Prometheus 指标（包括 rednote_ch6 的 LLM、工具与缓存指标）
+
+过载保护：
+- 有界准入：最多 max_inflight 个生成任务同时调用 Ollama（默认取 OLLAMA_NUM_PARALLEL），
+  最多 max_queue 个排队，其余立即返回 429 和 Retry-After
+- 按客户端限速：令牌桶，客户端以 X-Client-Id 请求头区分，没有时按来源 IP
+- 请求合并：产品、风格、模型与采样参数都相同的在途请求只触发一次生成，其余请求等待同一个结果，
+  不占用准入名额；流式请求各自独立生成，不参与合并
+
+用法：python rednote_service.py [--port 8080] [--max-inflight 4] [--max-queue 16] [--rate 1 --burst 5]
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import rednote_ch6_assignment as ch6
+from rednote_ch6_assignment import logger, telemetry
+
+MAX_BODY_BYTES = 64 * 1024
+MAX_PRODUCT_NAME_CHARS = 100
+
+service_requests = telemetry.counter("rednote_service_requests_total", "HTTP 请求数", ("endpoint", "status"))
+service_seconds = telemetry.histogram("rednote_service_request_seconds", "HTTP 请求耗时", ("endpoint",))
+service_coalesced = telemetry.counter("rednote_service_coalesced_total", "合并到在途生成任务的请求数")
+service_rejected = telemetry.counter("rednote_service_rejected_total", "被拒绝的请求数", ("reason",))
+
+
+class ServiceError(Exception):
+    """以指定 HTTP 状态码返回给客户端的错误"""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    有界准入：最多 max_inflight 个任务同时运行，最多 max_queue 个任务排队等待（最长 queue_timeout 秒），
+    超出时抛出 429 ServiceError。
+    """
+
+    def __init__(self, max_inflight: int, max_queue: int = 16, queue_timeout: float = 30.0):
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            if self.inflight >= self.max_inflight:
+                if self.waiting >= self.max_queue:
+                    service_rejected.inc(reason="queue_full")
+                    raise ServiceError(429, "服务繁忙，排队已满，请稍后重试", retry_after=1)
+                self.waiting += 1
+                try:
+                    admitted = self._cond.wait_for(lambda: self.inflight < self.max_inflight, self.queue_timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    service_rejected.inc(reason="queue_timeout")
+                    raise ServiceError(429, "服务繁忙，排队超时，请稍后重试", retry_after=1)
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.inflight -= 1
+                self._cond.notify()
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {"inflight": self.inflight, "waiting": self.waiting,
+                    "max_inflight": self.max_inflight, "max_queue": self.max_queue}
+
+
+class RateLimiter:
+    """
+    按客户端的令牌桶：每秒补充 rate 个令牌，桶容量为 burst。rate=None 表示不限速。
+    最多记录 max_clients 个客户端，超出时淘汰最久未访问的。
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: int = 5, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client_id: str) -> float:
+        """取一个令牌，成功返回 0，否则返回需要等待的秒数"""
+        if self.rate is None:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client_id, (float(self.burst), now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate if self.rate > 0 else float("inf")
+            self._buckets[client_id] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RequestCoalescer:
+    """相同键的在途请求只执行一次，其余调用方等待并共享同一个结果（或异常）"""
+
+    def __init__(self):
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, operation: Callable[[], object]) -> Tuple[object, bool]:
+        """返回 (结果, 是否合并到了其他请求)"""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = operation()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def __len__(self):
+        return len(self._inflight)
+
+
+class RednoteService:
+    """文案服务的业务逻辑，与 HTTP 层分离，便于直接调用和测试"""
+
+    def __init__(self, max_inflight: Optional[int] = None, max_queue: int = 16, queue_timeout: float = 30.0,
+                 rate: Optional[float] = None, burst: int = 5, max_iterations: int = 5):
+        self.admission = AdmissionController(max_inflight or ch6.default_batch_concurrency(),
+                                             max_queue, queue_timeout)
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.coalescer = RequestCoalescer()
+        self.max_iterations = max_iterations
+
+    def check_rate(self, client_id: str):
+        wait = self.rate_limiter.acquire(client_id)
+        if wait:
+            service_rejected.inc(reason="rate_limited")
+            raise ServiceError(429, "请求过于频繁，请稍后重试", retry_after=min(wait, 3600))
+
+    @staticmethod
+    def parse_request(body: Dict) -> Tuple[str, str, Optional[Dict]]:
+        product_name = body.get("product_name")
+        tone_style = body.get("tone_style") or "科技酷炫"
+        options = body.get("options")
+        if not isinstance(product_name, str) or not product_name.strip():
+            raise ServiceError(400, "缺少 product_name")
+        if len(product_name) > MAX_PRODUCT_NAME_CHARS or not isinstance(tone_style, str):
+            raise ServiceError(400, "product_name 或 tone_style 不合法")
+        if options is not None and not isinstance(options, dict):
+            raise ServiceError(400, "options 必须是对象")
+        return product_name.strip(), tone_style, options
+
+    @staticmethod
+    def _lookup_cache(cache_key: str) -> Optional[str]:
+        cache = ch6.rednote_cache
+        return cache.get(cache_key) if cache is not None else None
+
+    @staticmethod
+    def _response(product_name: str, tone_style: str, result: str, **flags) -> Dict:
+        rednote = json.loads(result)
+        if "error" in rednote:
+            raise ServiceError(502, rednote["error"])
+        return {"product_name": product_name, "tone_style": tone_style, "rednote": rednote,
+                "markdown": ch6.format_rednote_for_markdown(result), **flags}
+
+    def generate(self, body: Dict) -> Dict:
+        """缓存命中直接返回；否则合并相同的在途请求，由其中一个请求占用准入名额执行生成"""
+        product_name, tone_style, options = self.parse_request(body)
+        model_name = ch6.get_ollama_client().model_name
+        cache_key = ch6.rednote_cache_key(model_name, product_name, tone_style, options)
+        cached = self._lookup_cache(cache_key)
+        if cached is not None:
+            return self._response(product_name, tone_style, cached, cached=True, coalesced=False)
+
+        def run() -> str:
+            with self.admission.slot():
+                return ch6.generate_rednote_with_private_model(
+                    product_name, tone_style, max_iterations=self.max_iterations,
+                    options=options, use_cache=False)
+
+        result, coalesced = self.coalescer.run(cache_key, run)
+        if coalesced:
+            service_coalesced.inc()
+        return self._response(product_name, tone_style, result, cached=False, coalesced=coalesced)
+
+    def catalog(self, query: str, top_k: int = 5) -> Dict:
+        if not query.strip():
+            raise ServiceError(400, "缺少查询参数 q")
+        catalog = ch6.get_product_catalog()
+        return {
+            "query": query,
+            "resolved": catalog.resolve(query),
+            "matches": [{"name": name, "score": round(score, 4)}
+                        for name, score in catalog.search(query, top_k=max(1, min(top_k, 50)))],
+            "text": ch6.enhanced_query_product_database(query),
+        }
+
+    def health(self) -> Dict:
+        return {"status": "ok", "coalescing": len(self.coalescer), **self.admission.snapshot()}
+
+
+def make_handler(service: RednoteService):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logger.debug("%s %s", self.address_string(), format % args)
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        @property
+        def client_id(self) -> str:
+            return self.headers.get("X-Client-Id") or self.client_address[0]
+
+        def _send_json(self, status: int, body: Dict, retry_after: Optional[float] = None):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            if retry_after is not None:
+                self.send_header("Retry-After", str(max(1, round(retry_after))))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_text(self, text: str, content_type: str):
+            data = text.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self) -> Dict:
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0 or length > MAX_BODY_BYTES:
+                # 请求体没有读取，连接上剩余的数据无法再解析为下一个请求
+                self.close_connection = True
+                if length < 0:
+                    raise ServiceError(400, "Content-Length 不合法")
+                raise ServiceError(413, "请求体过大")
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                raise ServiceError(400, "请求体不是合法的 JSON") from None
+            if not isinstance(body, dict):
+                raise ServiceError(400, "请求体必须是 JSON 对象")
+            return body
+
+        def _start_chunked(self, content_type: str):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.chunked = True
+
+        def _write_chunk(self, record: Dict):
+            line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+
+        def _end_chunked(self, record: Optional[Dict] = None):
+            if record is not None:
+                self._write_chunk(record)
+            self.wfile.write(b"0\r\n\r\n")
+            self.chunked = False
+
+        def _dispatch(self, endpoint: str, handler: Callable[[], Optional[Dict]]):
+            started = time.perf_counter()
+            status = 200
+            self.chunked = False
+            try:
+                body = handler()
+                if body is not None:
+                    self._send_json(200, body)
+            except ServiceError as e:
+                status = e.status
+                self._send_json(e.status, {"error": str(e)}, e.retry_after)
+            except (BrokenPipeError, ConnectionResetError, ch6.GenerationCancelled):
+                status = 499  # 客户端已断开
+                self.close_connection = True
+            except Exception as e:
+                status = 500
+                logger.exception("❌ 处理 %s 失败: %s", endpoint, e)
+                if not self.chunked:
+                    self._send_json(500, {"error": "服务内部错误"})
+                    return
+                # 响应头已经发出，不能再写一个新的 500 响应：以错误行结束分块传输并关闭连接
+                self.close_connection = True
+                try:
+                    self._end_chunked({"done": True, "error": "服务内部错误"})
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            finally:
+                service_requests.inc(endpoint=endpoint, status=str(status))
+                service_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/healthz":
+                self._send_json(200, service.health())
+            elif url.path == "/metrics":
+                self._send_text(telemetry.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            elif url.path == "/catalog":
+                params = parse_qs(url.query)
+
+                def lookup():
+                    service.check_rate(self.client_id)
+                    try:
+                        top_k = int(params.get("top_k", ["5"])[0])
+                    except ValueError:
+                        raise ServiceError(400, "top_k 必须是整数") from None
+                    return service.catalog(params.get("q", [""])[0], top_k)
+                self._dispatch("catalog", lookup)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            if path == "/generate":
+                def generate():
+                    body = self._read_json()
+                    service.check_rate(self.client_id)
+                    return service.generate(body)
+                self._dispatch("generate", generate)
+            elif path == "/generate/stream":
+                self._dispatch("generate_stream", self._generate_stream)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def _generate_stream(self) -> None:
+            """准入与参数检查在发送响应头之前完成，失败时仍能返回 4xx；之后以分块传输逐行写出"""
+            body = self._read_json()
+            service.check_rate(self.client_id)
+            product_name, tone_style, options = service.parse_request(body)
+            with service.admission.slot():
+                self._start_chunked("application/x-ndjson; charset=utf-8")
+
+                def on_token(token: str):
+                    # 客户端断开时让 Agent 循环安静地结束，并关闭与 Ollama 的流式连接
+                    try:
+                        self._write_chunk({"token": token})
+                    except (BrokenPipeError, ConnectionResetError) as e:
+                        raise ch6.GenerationCancelled("客户端已断开") from e
+
+                # 其他异常由 _dispatch 以 {"done": true, "error": ...} 行结束数据流
+                result = ch6.generate_rednote_with_private_model(
+                    product_name, tone_style, max_iterations=service.max_iterations, stream=True,
+                    on_token=on_token, options=options)
+                rednote = json.loads(result)
+                if "error" in rednote:
+                    self._end_chunked({"done": True, "error": rednote["error"]})
+                else:
+                    self._end_chunked({"done": True, "rednote": rednote,
+                                       "markdown": ch6.format_rednote_for_markdown(result)})
+
+    return Handler
+
+
+def create_server(service: RednoteService, host: str = "127.0.0.1", port: int = 8080) -> ThreadingHTTPServer:
+    """创建 HTTP 服务（未启动），每个连接一个线程；生成任务的并发由 service.admission 控制"""
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="第六章小红书文案助手 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-inflight", type=int, help="同时调用 Ollama 的生成任务数，默认 OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--max-queue", type=int, default=16, help="排队等待的生成任务上限，超出返回 429")
+    parser.add_argument("--queue-timeout", type=float, default=30.0, help="排队等待的最长秒数")
+    parser.add_argument("--rate", type=float, help="每个客户端每秒的请求数，默认不限速")
+    parser.add_argument("--burst", type=int, default=5, help="每个客户端的突发请求数")
+    args = parser.parse_args()
+
+    ch6.configure_logging()
+    client = ch6.get_ollama_client()
+    service = RednoteService(args.max_inflight, args.max_queue, args.queue_timeout, args.rate, args.burst)
+    server = create_server(service, args.host, args.port)
+    logger.info("🚀 文案服务运行在 http://%s:%d，模型 %s（%s），最多 %d 个并发生成",
+                args.host, server.server_address[1], client.model_name, client.base_url,
+                service.admission.max_inflight)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
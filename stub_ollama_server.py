@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ollama 替身 HTTP 服务
+
+在本地线程中实现 Ollama 的 /api/tags、/api/ps、/api/embed 与 /api/chat，
+用于在没有 GPU、没有下载模型的环境中对 OllamaClient、第六章 Agent 循环和本地 RAG 链路做集成测试和基准测试：
+- /api/embed 用 HashEmbeddingFunction 生成确定性向量，语义上足够让检索命中正确的 chunk
+- /api/chat 返回带 <think> 段落的回答，并附带 Ollama 的耗时与 token 统计字段；
+  stream=true 时按 chunk_chars 切分内容，以 NDJSON 分块传输逐段返回
+- reply 可以返回字符串或 {"content": ..., "tool_calls": [...]}，ScriptedReply 按顺序回放一组脚本化回复
+  （工具调用、格式错误的 JSON、最终文案等）
+- embed_latency / chat_latency 模拟预填充耗时，token_latency 模拟流式输出中每个数据块的生成耗时，
+  fail_statuses 让最先到达的若干个 /api/chat 请求依次返回指定状态码（如 503 模型加载中）
+
+用法：
+    with StubOllamaServer() as server:
+        client = OllamaClient(server.base_url)
+
+也可以单独运行：python stub_ollama_server.py --port 11434
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Union
+
+from rag.embedding import HashEmbeddingFunction
+
+
+def default_reply(messages: List[Dict]) -> str:
+    """默认回答：报告收到的提示长度，足以在测试中确认提示词已送达"""
+    prompt = messages[-1].get("content", "") if messages else ""
+    return f"<think>检查上下文</think>\n收到 {len(prompt)} 个字符的提示。"
+
+
+class ScriptedReply:
+    """
+    按顺序回放脚本化回复，用完后重复最后一条；可直接作为 StubOllamaServer 的 reply。
+    
+    对话以第一条 user 消息区分，各自从头回放：不含 assistant 消息的请求视为新对话。
+    按请求次数而不是历史中的 assistant 消息数推进，Agent 压缩历史、丢弃旧草稿后脚本照样前进；
+    内容相同的对话并发进行时会共用同一个进度。
+    """
+    
+    def __init__(self, replies: List[Union[str, Dict]]):
+        self.replies = list(replies)
+        self._turns: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def __call__(self, messages: List[Dict]) -> Union[str, Dict]:
+        key = next((m.get("content") or "" for m in messages if m.get("role") == "user"), "")
+        fresh = not any(m.get("role") == "assistant" for m in messages)
+        with self._lock:
+            turn = 0 if fresh else self._turns.get(key, 0)
+            self._turns[key] = turn + 1
+        return self.replies[min(turn, len(self.replies) - 1)]
+
+class StubOllamaServer:
+    """Ollama 替身服务，记录收到的每个请求（路径与请求体）"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 chat_models=("deepseek-r1:8b",), embed_models=("nomic-embed-text",),
+                 dim: int = 64, chat_latency: float = 0.0, embed_latency: float = 0.0,
+                 reply: Callable[[List[Dict]], Union[str, Dict]] = default_reply,
+                 token_latency: float = 0.0, chunk_chars: int = 8, fail_statuses=()):
+        self.chat_models = list(chat_models)
+        self.embed_models = list(embed_models)
+        self.embedding = HashEmbeddingFunction(dim=dim)
+        self.chat_latency = chat_latency
+        self.embed_latency = embed_latency
+        self.token_latency = token_latency
+        self.chunk_chars = max(1, chunk_chars)
+        self.fail_statuses = list(fail_statuses)
+        self.reply = reply
+        self.requests: List[Dict] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, path: str) -> int:
+        with self._lock:
+            return sum(1 for request in self.requests if request["path"] == path)
+
+    def start(self) -> "StubOllamaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """在当前线程中运行（命令行模式）"""
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _record(self, path: str, payload: Dict):
+        with self._lock:
+            self.requests.append({"path": path, "payload": payload})
+
+    def _models(self) -> List[Dict]:
+        return [{"name": name, "model": name, "size": 0} for name in self.chat_models + self.embed_models]
+
+    def _embed(self, payload: Dict):
+        if payload.get("model") not in self.embed_models:
+            return 404, {"error": f"model \"{payload.get('model')}\" not found, try pulling it first"}
+        texts = payload.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        started = time.perf_counter()
+        if self.embed_latency:
+            time.sleep(self.embed_latency)
+        vectors = self.embedding.encode_documents(texts)
+        return 200, {
+            "model": payload["model"],
+            "embeddings": vectors,
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+            "prompt_eval_count": sum(len(text.split()) for text in texts),
+        }
+
+    def _next_failure(self) -> Optional[int]:
+        with self._lock:
+            return self.fail_statuses.pop(0) if self.fail_statuses else None
+    
+    def _chat_reply(self, payload: Dict):
+        """返回 (状态码, 错误响应) 或 (200, 回复消息, 预填充耗时)"""
+        if payload.get("model") not in self.chat_models:
+            return 404, {"error": f"model \"{payload.get('model')}\" not found, try pulling it first"}
+        status = self._next_failure()
+        if status is not None:
+            return status, {"error": "model is loading"}
+        started = time.perf_counter()
+        if self.chat_latency:
+            time.sleep(self.chat_latency)
+        reply = self.reply(payload.get("messages", []))
+        message = {"role": "assistant", **(reply if isinstance(reply, dict) else {"content": reply})}
+        message.setdefault("content", "")
+        return 200, message, time.perf_counter() - started
+    
+    def _chat_stats(self, payload: Dict, message: Dict, prompt_seconds: float, eval_seconds: float) -> Dict:
+        """最终响应（或最后一个数据块）中的 Ollama 统计字段"""
+        prompt_ns, eval_ns = int(prompt_seconds * 1e9), int(eval_seconds * 1e9)
+        return {
+            "model": payload["model"],
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": prompt_ns + eval_ns,
+            "load_duration": 0,
+            "prompt_eval_count": max(1, sum(len(m.get("content") or "") for m in payload.get("messages", [])) // 4),
+            "prompt_eval_duration": prompt_ns // 2 if not eval_ns else prompt_ns,
+            "eval_count": max(1, len(message["content"]) // 4),
+            "eval_duration": eval_ns or prompt_ns - prompt_ns // 2,
+        }
+    
+    def _chat(self, payload: Dict):
+        result = self._chat_reply(payload)
+        if result[0] != 200:
+            return result
+        _, message, elapsed = result
+        return 200, {"message": message, **self._chat_stats(payload, message, elapsed, 0.0)}
+    
+    def _chat_chunks(self, payload: Dict, message: Dict, prompt_seconds: float):
+        """流式响应：内容按 chunk_chars 切分，工具调用单独一个数据块，最后是带统计字段的 done 数据块"""
+        started = time.perf_counter()
+        content = message["content"]
+        for offset in range(0, len(content), self.chunk_chars):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield {"model": payload["model"], "done": False,
+                   "message": {"role": "assistant", "content": content[offset:offset + self.chunk_chars]}}
+        if message.get("tool_calls"):
+            yield {"model": payload["model"], "done": False,
+                   "message": {"role": "assistant", "content": "", "tool_calls": message["tool_calls"]}}
+        final = self._chat_stats(payload, message, prompt_seconds, time.perf_counter() - started)
+        yield {"message": {"role": "assistant", "content": ""}, **final}
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # 响应头和响应体分两次写出，不关 Nagle 算法会与客户端的延迟 ACK 叠加出约 40ms 的停顿
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, format, *args):
+                pass
+            
+            def handle(self):
+                # 客户端提前断开（流式生成提前结束、连接池关闭）属于正常情况
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _send_stream(self, chunks):
+                """以分块传输编码逐行写出 NDJSON；客户端提前断开时停止生成"""
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for chunk in chunks:
+                        line = json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n"
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+            
+            def _send(self, status: int, body: Dict):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                stub._record(self.path, {})
+                if self.path == "/api/tags":
+                    self._send(200, {"models": stub._models()})
+                elif self.path == "/api/ps":
+                    self._send(200, {"models": []})
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self._send(400, {"error": "invalid JSON"})
+                    return
+                stub._record(self.path, payload)
+                if self.path == "/api/embed":
+                    self._send(*stub._embed(payload))
+                elif self.path == "/api/chat" and payload.get("stream", True):
+                    result = stub._chat_reply(payload)
+                    if result[0] != 200:
+                        self._send(*result)
+                    else:
+                        self._send_stream(stub._chat_chunks(payload, result[1], result[2]))
+                elif self.path == "/api/chat":
+                    self._send(*stub._chat(payload))
+                else:
+                    self._send(404, {"error": "not found"})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama 替身 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--chat-latency", type=float, default=0.0, help="模拟生成耗时（秒）")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="模拟嵌入耗时（秒）")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="流式输出中每个数据块的耗时（秒）")
+    args = parser.parse_args()
+
+    server = StubOllamaServer(args.host, args.port, dim=args.dim, chat_latency=args.chat_latency,
+                              embed_latency=args.embed_latency, token_latency=args.token_latency)
+    print(f"🚀 Ollama 替身服务运行在 {server.base_url}，Ctrl+C 退出")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,787 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG 流水线测试脚本
+
+全部使用本地确定性嵌入和内存假客户端，不依赖网络、API Key 或 Milvus 服务
+"""
+
+import sys
+import os
+import tempfile
+
+# 添加当前目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeMilvusClient:
+    """在内存中保存数据、记录每次写入的假 Milvus 客户端（单个 collection）"""
+
+    def __init__(self):
+        self.inserts = []
+        self.deletes = []
+        self.rows = {}
+        self.collections = {}
+        self.indexes = {}
+        self.searches = []
+
+    def has_collection(self, collection_name):
+        return collection_name in self.collections
+
+    def create_collection(self, collection_name, dimension=None, schema=None, index_params=None, **kwargs):
+        self.collections[collection_name] = dimension or schema.dimension
+        if index_params is not None:
+            self.create_index(collection_name, index_params)
+
+    def create_schema(self, **kwargs):
+        return FakeSchema()
+
+    def drop_collection(self, collection_name):
+        self.collections.pop(collection_name, None)
+        self.rows.clear()
+
+    def describe_collection(self, collection_name):
+        return {"fields": [{"name": "vector", "params": {"dim": self.collections[collection_name]}}]}
+
+    def get_collection_stats(self, collection_name):
+        return {"row_count": len(self.rows)}
+
+    def insert(self, collection_name, data):
+        self.inserts.append((collection_name, len(data)))
+        for row in data:
+            self.rows[row["id"]] = row
+        return {"insert_count": len(data)}
+
+    def upsert(self, collection_name, data):
+        self.insert(collection_name, data)
+        return {"upsert_count": len(data)}
+
+    def prepare_index_params(self):
+        return FakeIndexParams()
+
+    def list_indexes(self, collection_name):
+        return list(self.indexes.get(collection_name, {}))
+
+    def describe_index(self, collection_name, index_name):
+        return self.indexes[collection_name][index_name]
+
+    def create_index(self, collection_name, index_params):
+        self.indexes.setdefault(collection_name, {})["vector"] = dict(index_params.indexes[0])
+
+    def drop_index(self, collection_name, index_name):
+        self.indexes[collection_name].pop(index_name)
+
+    def release_collection(self, collection_name):
+        pass
+
+    def load_collection(self, collection_name):
+        pass
+
+    def search(self, collection_name, data, limit, search_params, output_fields, filter="", **kwargs):
+        self.searches.append({"data": data, "limit": limit, "search_params": search_params, **kwargs})
+        results = []
+        for query in data:
+            scored = sorted(
+                ((sum(a * b for a, b in zip(query, row["vector"])), row) for row in self.rows.values()),
+                key=lambda item: -item[0]
+            )[:limit]
+            results.append([
+                {"id": row["id"], "distance": score,
+                 "entity": {field: row[field] for field in output_fields if field in row}}
+                for score, row in scored
+            ])
+        return results
+
+    def query_iterator(self, collection_name, batch_size, filter, output_fields):
+        rows = [{"id": row["id"], **{field: row.get(field) for field in output_fields}}
+                for row in self.rows.values()]
+        batches = iter([rows[i:i + batch_size] for i in range(0, len(rows), batch_size)])
+
+        class Iterator:
+            def next(self):
+                return next(batches, [])
+
+            def close(self):
+                pass
+
+        return Iterator()
+
+    def delete(self, collection_name, ids):
+        self.deletes.append(list(ids))
+        for i in ids:
+            self.rows.pop(i, None)
+        return {"delete_count": len(ids)}
+
+
+class FakeSchema:
+    def __init__(self):
+        self.dimension = None
+
+    def add_field(self, name, datatype, **kwargs):
+        self.dimension = kwargs.get("dim", self.dimension)
+
+
+class FakeIndexParams:
+    def __init__(self):
+        self.indexes = []
+
+    def add_index(self, field_name, index_type, metric_type, params):
+        self.indexes.append({"field_name": field_name, "index_type": index_type,
+                             "metric_type": metric_type, **params})
+
+
+class CountingEmbedding:
+    """统计实际嵌入文本数量的嵌入函数包装，可指定前几次调用失败"""
+
+    def __init__(self, inner, fail_times=0):
+        self.inner = inner
+        self.model_name = inner.model_name
+        self.calls = 0
+        self.texts = 0
+        self.fail_times = fail_times
+
+    def encode_documents(self, texts):
+        self.calls += 1
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise RuntimeError("embedding service unavailable")
+        self.texts += len(texts)
+        return self.inner.encode_documents(texts)
+
+
+def test_embedding_pipeline():
+    """测试分批嵌入、磁盘缓存和流式写入"""
+    from rag import EmbeddingCache, HashEmbeddingFunction, ingest_chunks
+
+    hash_embedding = HashEmbeddingFunction(dim=32)
+    first = hash_embedding.encode_documents(["How does Milvus store data?"])[0]
+    again = hash_embedding.encode_queries(["How does Milvus store data?"])[0]
+    assert first == again and len(first) == 32
+    assert abs(sum(v * v for v in first) - 1.0) < 1e-6
+    print("✅ 本地嵌入替身结果确定且已归一化")
+
+    texts = [f"FAQ chunk number {i}" for i in range(10)]
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "embeddings.sqlite3")
+        cache = EmbeddingCache(cache_path)
+        embedding = CountingEmbedding(hash_embedding)
+        client = FakeMilvusClient()
+        stats = ingest_chunks(client, "faq", iter(texts), embedding,
+                              batch_size=3, concurrency=2, cache=cache)
+        assert [size for _, size in client.inserts] == [3, 3, 3, 1]
+        assert stats == {"chunks": 10, "batches": 4, "embedded": 10, "cached": 0}
+        assert sorted(client.rows) == list(range(10))
+        assert client.rows[4]["text"] == texts[4]
+        assert client.rows[4]["vector"] == hash_embedding.encode_documents([texts[4]])[0]
+        print("✅ 按批嵌入并逐批写入 Milvus，顺序与编号正确")
+        cache.close()
+
+        # 新进程重新入库：只有改动和新增的文本需要嵌入
+        cache = EmbeddingCache(cache_path)
+        embedding = CountingEmbedding(hash_embedding)
+        changed = texts[:9] + ["FAQ chunk number 9 (edited)", "brand new chunk"]
+        chunks = [{"text": text, "source": "faq.md"} for text in changed]
+        stats = ingest_chunks(FakeMilvusClient(), "faq", chunks, embedding,
+                              batch_size=4, concurrency=3, cache=cache)
+        assert embedding.texts == 2
+        assert stats["embedded"] == 2 and stats["cached"] == 9
+        print("✅ 重新入库时只嵌入新增或改动的文本")
+
+        # 其他模型名的缓存互不干扰
+        other = CountingEmbedding(HashEmbeddingFunction(dim=16))
+        ingest_chunks(FakeMilvusClient(), "faq", texts[:2], other, cache=cache)
+        assert other.texts == 2
+        print("✅ 缓存按模型名隔离")
+        cache.close()
+
+    embedding = CountingEmbedding(hash_embedding, fail_times=1)
+    client = FakeMilvusClient()
+    stats = ingest_chunks(client, "faq", texts, embedding, batch_size=5,
+                          concurrency=1, max_retries=1)
+    assert stats["chunks"] == 10 and embedding.calls == 3
+    print("✅ 单批嵌入失败后退避重试成功")
+    return True
+
+
+def test_markdown_chunker():
+    """测试结构感知的 Markdown 切块"""
+    from rag import chunk_markdown, count_tokens, iter_markdown_chunks
+
+    document = """---
+id: demo.md
+title: Demo
+---
+
+# Demo FAQ
+
+<!-- TOC -->
+
+#### How is data stored?
+
+Milvus stores vectors in segments. Segments are flushed to object storage. Each segment has an index.
+
+#### How to configure?
+
+```yaml
+# this is not a heading
+datacoord.segment.maxSize: 512
+```
+"""
+    chunks = list(chunk_markdown(document, source="demo.md"))
+    assert [c["heading"] for c in chunks] == ["How is data stored?", "How to configure?"]
+    assert chunks[0]["heading_path"] == "Demo FAQ > How is data stored?"
+    assert chunks[0]["source"] == "demo.md" and chunks[1]["chunk_index"] == 1
+    assert chunks[0]["text"].startswith("How is data stored?\n\nMilvus stores vectors")
+    assert "# this is not a heading" in chunks[1]["text"]
+    assert all("id: demo.md" not in c["text"] and "TOC" not in c["text"] for c in chunks)
+    print("✅ 按标题切分，跳过 front matter、注释，代码块内的 # 不当作标题")
+
+    long_section = "#### Long answer\n\n" + " ".join(
+        f"Sentence number {i} explains one more detail about Milvus." for i in range(40)
+    )
+    chunks = list(chunk_markdown(long_section, max_tokens=64, overlap_tokens=16))
+    assert len(chunks) > 3
+    assert all(c["tokens"] <= 64 and c["tokens"] == count_tokens(c["text"]) for c in chunks)
+    for previous, current in zip(chunks, chunks[1:]):
+        last_sentence = previous["text"].rsplit(". ", 1)[-1]
+        assert last_sentence in current["text"]
+    assert "Sentence number 39" in chunks[-1]["text"]
+    print("✅ chunk 不超过 token 预算，相邻 chunk 之间有重叠")
+
+    token = "a1b2c3d4" * 100
+    chunks = list(chunk_markdown(f"#### Checksum\n\nSee https://example.com/{token} for details.",
+                                 max_tokens=64, overlap_tokens=8))
+    assert all(c["tokens"] <= 64 for c in chunks)
+    assert token in "".join(c["text"].split("\n\n", 1)[1] for c in chunks).replace(" ", "")
+    print("✅ 超长的单个 token（URL、哈希等）按预算硬切")
+
+    faq_chunks = list(iter_markdown_chunks(["performance_faq.md", "product_faq.md"], max_tokens=128))
+    assert {c["source"] for c in faq_chunks} == {"performance_faq.md", "product_faq.md"}
+    assert max(c["tokens"] for c in faq_chunks) <= 128
+    print(f"✅ FAQ 文档切分为 {len(faq_chunks)} 个 chunk")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "nested"))
+        for name in ("a.md", os.path.join("nested", "b.md"), "notes.txt"):
+            with open(os.path.join(tmp, name), "w", encoding="utf-8") as file:
+                file.write(f"# {name}\n\nSome text.\n")
+        sources = {c["source"] for c in iter_markdown_chunks(tmp)}
+        assert sources == {"a.md", "b.md"}
+    print("✅ 目录参数递归展开为其中的 Markdown 文件")
+    return True
+
+
+def test_incremental_sync():
+    """测试增量、幂等的索引同步"""
+    from rag import HashEmbeddingFunction, ensure_collection, load_manifest, sync_index
+
+    embedding = HashEmbeddingFunction(dim=32)
+    client = FakeMilvusClient()
+    assert ensure_collection(client, "faq", 32) is True
+    assert ensure_collection(client, "faq", 32) is False
+    try:
+        ensure_collection(client, "faq", 64)
+        return False
+    except ValueError:
+        print("✅ collection 已存在时不再重建，维度不一致时报错")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        docs = os.path.join(tmp, "docs")
+        os.makedirs(docs)
+        for name in ("a.md", "b.md"):
+            with open(os.path.join(docs, name), "w", encoding="utf-8") as file:
+                file.write(f"# {name}\n\n#### Question one\n\nAnswer one in {name}.\n\n"
+                           f"#### Question two\n\nAnswer two in {name}.\n")
+        pattern = os.path.join(docs, "*.md")
+        manifest_path = os.path.join(tmp, "manifest.json")
+
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["upserted"] == 4 and stats["generation"] == 1
+        ids = set(client.rows)
+        print("✅ 首次同步写入全部 chunk")
+
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["changed_files"] == 0 and stats["upserted"] == 0 and stats["deleted"] == 0
+        assert set(client.rows) == ids and stats["generation"] == 1
+        os.utime(os.path.join(docs, "a.md"))
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["changed_files"] == 0 and stats["upserted"] == 0
+        print("✅ 未改动或仅被 touch 的文件不会重新入库")
+
+        with open(os.path.join(docs, "a.md"), "w", encoding="utf-8") as file:
+            file.write("# a.md\n\n#### Question one\n\nAnswer one in a.md.\n\n"
+                       "#### Question two\n\nA brand new answer.\n")
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["changed_files"] == 1 and stats["upserted"] == 1 and stats["deleted"] == 1
+        assert stats["embedded"] == 1 and stats["generation"] == 2
+        assert len(client.rows) == 4
+        assert any(row["text"].endswith("A brand new answer.") for row in client.rows.values())
+        print("✅ 改动文件只 upsert 新 chunk 并删除旧 chunk")
+
+        os.remove(os.path.join(docs, "b.md"))
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["removed_files"] == 1 and stats["deleted"] == 2
+        assert {row["source"] for row in client.rows.values()} == {"docs/a.md"}
+        manifest = load_manifest(manifest_path)
+        assert sorted(client.rows) == manifest["files"]["docs/a.md"]["ids"]
+        print("✅ 删除的文件其 chunk 一并清理，manifest 与 collection 一致")
+
+        # 换一个工作目录同步同一个 manifest，文件的键和 chunk id 都不变
+        cwd = os.getcwd()
+        try:
+            for folder in (docs, tmp):
+                os.chdir(folder)
+                stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+                assert stats["changed_files"] == 0 and stats["upserted"] == 0 and stats["deleted"] == 0
+        finally:
+            os.chdir(cwd)
+        assert sorted(client.rows) == load_manifest(manifest_path)["files"]["docs/a.md"]["ids"]
+        print("✅ 从不同工作目录同步时没有任何改动")
+
+        # collection 被清空后，即使文件未变也会重新全部入库
+        client.drop_collection("faq")
+        ensure_collection(client, "faq", 32)
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["upserted"] == 2 and len(client.rows) == 2
+        print("✅ collection 重建后自动重新入库")
+
+    # 不同目录下的同名文件内容相同时，chunk 主键也不能相同，否则修改其中一个会删掉另一个的向量
+    with tempfile.TemporaryDirectory() as tmp:
+        client = FakeMilvusClient()
+        ensure_collection(client, "faq", 32)
+        for folder in ("a", "b"):
+            os.makedirs(os.path.join(tmp, folder))
+            with open(os.path.join(tmp, folder, "faq.md"), "w", encoding="utf-8") as file:
+                file.write("# FAQ\n\n#### Shared question\n\nShared answer.\n")
+        pattern = os.path.join(tmp, "*", "faq.md")
+        manifest_path = os.path.join(tmp, "manifest.json")
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["upserted"] == 2 and len(client.rows) == 2
+
+        os.remove(os.path.join(tmp, "a", "faq.md"))
+        stats = sync_index(client, "faq", pattern, embedding, manifest_path)
+        assert stats["deleted"] == 1 and len(client.rows) == 1
+        manifest = load_manifest(manifest_path)
+        assert sorted(client.rows) == manifest["files"]["b/faq.md"]["ids"]
+        print("✅ 不同目录下的同名文件各自拥有独立的 chunk")
+    return True
+
+
+def test_index_config():
+    """测试 ANN 索引配置与按次一致性级别"""
+    from rag import HashEmbeddingFunction, IndexConfig, ensure_collection, search_collection
+
+    hnsw = IndexConfig("hnsw", search_params={"ef": 32})
+    assert hnsw.index_type == "HNSW" and hnsw.params == {"M": 16, "efConstruction": 200}
+    assert hnsw.to_search_params() == {"metric_type": "IP", "params": {"ef": 32}}
+    assert hnsw.to_search_params(ef=128)["params"]["ef"] == 128
+    ivf = IndexConfig.ivf(10000, "IVF_SQ8")
+    assert ivf.params == {"nlist": 400} and ivf.search_params == {"nprobe": 50}
+    try:
+        IndexConfig("DISKANN_TYPO")
+        return False
+    except ValueError:
+        pass
+    print("✅ 索引默认参数、nlist 经验值与搜索参数覆盖正确")
+
+    client = FakeMilvusClient()
+    assert ensure_collection(client, "faq", 32, index=hnsw) is True
+    assert client.describe_index("faq", "vector")["index_type"] == "HNSW"
+    ensure_collection(client, "faq", 32, index=hnsw)
+    assert client.describe_index("faq", "vector")["M"] == 16
+    ensure_collection(client, "faq", 32, index=ivf)
+    assert client.describe_index("faq", "vector") == {
+        "field_name": "vector", "index_type": "IVF_SQ8", "metric_type": "IP", "nlist": 400
+    }
+    print("✅ 新建 collection 时建索引，索引配置变化时就地重建")
+
+    embedding = HashEmbeddingFunction(dim=32)
+    texts = ["Milvus stores data in segments", "HNSW is a graph index", "nprobe controls IVF recall"]
+    client.insert("faq", [{"id": i, "text": t, "vector": v}
+                          for i, (t, v) in enumerate(zip(texts, embedding.encode_documents(texts)))])
+    result = search_collection(client, "faq", embedding.encode_queries(["graph index HNSW"]), limit=1,
+                               index=ivf, consistency_level="Bounded", nprobe=8)
+    assert result[0][0]["entity"]["text"] == "HNSW is a graph index"
+    assert client.searches[-1]["search_params"] == {"metric_type": "IP", "params": {"nprobe": 8}}
+    assert client.searches[-1]["consistency_level"] == "Bounded"
+    search_collection(client, "faq", embedding.encode_queries(["x"]))
+    assert "consistency_level" not in client.searches[-1]
+    try:
+        search_collection(client, "faq", embedding.encode_queries(["x"]), consistency_level="Weak")
+        return False
+    except ValueError:
+        pass
+    print("✅ 搜索使用索引参数，一致性级别可按次指定")
+    return True
+
+
+def test_query_caches():
+    """测试查询向量缓存与语义答案缓存"""
+    from rag import HashEmbeddingFunction, QueryEmbeddingCache, SemanticAnswerCache, normalize_question
+
+    class CountingQueries(HashEmbeddingFunction):
+        def __init__(self):
+            super().__init__(dim=32)
+            self.encoded = []
+
+        def encode_queries(self, texts):
+            self.encoded.extend(texts)
+            return super().encode_queries(texts)
+
+    assert normalize_question("  How is data   stored in Milvus?? ") == "how is data stored in milvus"
+    embedding = CountingQueries()
+    cache = QueryEmbeddingCache(embedding)
+    first = cache.encode(["How is data stored in Milvus?", "What is HNSW?"])
+    second = cache.encode(["how is data stored in milvus", "What is HNSW?", "New question"])
+    assert embedding.encoded == ["how is data stored in milvus", "what is hnsw", "new question"]
+    assert second[0] == first[0] and second[1] == first[1]
+    assert cache.stats()["hits"] == 2
+    cache.set_generation(1)
+    cache.set_generation(2)
+    cache.encode(["What is HNSW?"])
+    assert embedding.encoded[-1] == "what is hnsw"
+    print("✅ 规范化后的重复问题不再请求嵌入，语料版本变化后缓存失效")
+
+    try:
+        from pymilvus import MilvusClient
+    except ImportError:
+        print("⚠️  未安装 pymilvus，跳过语义答案缓存测试")
+        return True
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = MilvusClient(os.path.join(tmp, "answer_cache.db"))
+        answers = SemanticAnswerCache(client, dimension=32, threshold=0.8,
+                                      namespace="deepseek-chat", generation=1)
+        question = "How is data stored in Milvus?"
+        vector = cache.encode([question])[0]
+        assert answers.lookup(vector) is None
+        answers.store(question, vector, "Milvus stores data in object storage.")
+        hit = answers.lookup(cache.encode(["How is data stored in Milvus"])[0])
+        assert hit["answer"] == "Milvus stores data in object storage." and hit["score"] >= 0.8
+        assert answers.lookup(cache.encode(["Which GPUs are supported for indexing?"])[0]) is None
+        print("✅ 相似问题命中语义缓存，不相关问题不命中")
+
+        other = SemanticAnswerCache(client, dimension=32, threshold=0.8, namespace="deepseek-r1", generation=1)
+        assert other.lookup(vector) is None
+        answers.set_generation(2)
+        assert answers.lookup(vector) is None
+        answers.store(question, vector, "new answer")
+        answers.ttl = -1
+        assert answers.lookup(vector) is None
+        print("✅ 按命名空间隔离，重新索引和 TTL 过期后失效")
+        client.close()
+    return True
+
+
+def test_retrieve_batch():
+    """测试批量检索"""
+    from rag import HashEmbeddingFunction, ingest_chunks, retrieve_batch
+
+    class CountingQueries(HashEmbeddingFunction):
+        def __init__(self):
+            super().__init__(dim=32)
+            self.batches = []
+
+        def encode_queries(self, texts):
+            self.batches.append(len(texts))
+            return super().encode_queries(texts)
+
+    embedding = CountingQueries()
+    client = FakeMilvusClient()
+    texts = ["Milvus stores data in segments", "HNSW is a graph index", "nprobe controls IVF recall"]
+    ingest_chunks(client, "faq", texts, embedding)
+
+    questions = [texts[i % 3] for i in range(7)]
+    hits = retrieve_batch(client, "faq", questions, embedding, top_k=2, batch_size=3,
+                          consistency_level="Bounded")
+    assert embedding.batches == [3, 3, 1] and len(client.searches) == 3
+    assert [len(search["data"]) for search in client.searches] == [3, 3, 1]
+    assert hits.ids.shape == (7, 2) and hits.distances.dtype.name == "float32"
+    assert list(hits.ids[:, 0]) == [0, 1, 2, 0, 1, 2, 0]
+    assert hits.texts(4)[0] == texts[1] and len(hits.entities) == 3
+    assert hits.hits(0)[0][1] > hits.hits(0)[1][1]
+    print("✅ 按批嵌入、按批搜索，结果为紧凑数组")
+
+    hits = retrieve_batch(client, "faq", ["only one"], embedding, top_k=5)
+    assert list(hits.ids[0, 3:]) == [-1, -1] and len(hits.hits(0)) == 3
+    assert len(retrieve_batch(client, "faq", [], embedding)) == 0
+    print("✅ 命中不足 top_k 时以 -1 填充，空输入返回空结果")
+    return True
+
+
+def test_hybrid_retrieval():
+    """测试 BM25 + 向量混合检索与重排"""
+    from rag import (BM25Index, HashEmbeddingFunction, HybridRetriever, TermOverlapReranker,
+                     chunk_id, ingest_chunks, iter_markdown_chunks, reciprocal_rank_fusion, tokenize)
+
+    assert tokenize("What is datacoord.segment.maxSize?") == [
+        "datacoord.segment.maxsize", "datacoord", "segment", "maxsize"
+    ]
+    fused = reciprocal_rank_fusion([[1, 2, 3], [3, 1]], k=60)
+    assert [doc_id for doc_id, _ in fused] == [1, 3, 2]
+    assert abs(fused[0][1] - (1 / 61 + 1 / 62)) < 1e-12
+    print("✅ 术语分词与 RRF 融合正确")
+
+    bm25 = BM25Index()
+    bm25.add(1, "nprobe controls recall of IVF indexes")
+    bm25.add(2, "Milvus stores data in object storage")
+    bm25.add(3, "HNSW uses the ef parameter")
+    assert bm25.search("how to tune nprobe")[0][0] == 1
+    bm25.remove(1)
+    assert bm25.search("nprobe") == [] and len(bm25) == 2
+    print("✅ BM25 索引检索与删除正确")
+
+    chunks = list(iter_markdown_chunks(["performance_faq.md", "operational_faq.md", "product_faq.md"]))
+    for chunk in chunks:
+        chunk["id"] = chunk_id(chunk["source"], chunk["text"])
+    client = FakeMilvusClient()
+    embedding = HashEmbeddingFunction(dim=64)
+    ingest_chunks(client, "faq", chunks, embedding)
+    retriever = HybridRetriever(client, "faq", embedding)
+    assert len(retriever.bm25) == len(chunks)
+    retriever.reranker = TermOverlapReranker(retriever.bm25)
+    dense_only = HybridRetriever(client, "faq", embedding, bm25=BM25Index())
+
+    questions = {
+        "datacoord.segment.maxSize": "datacoord.segment.maxSize",
+        "What is nprobe?": "nprobe",
+        "How does milvus flush data?": "flush",
+    }
+    for question, term in questions.items():
+        hits = retriever.search(question, top_k=3)
+        assert term.lower() in hits[0]["text"].lower(), question
+        assert hits[0]["sparse_rank"] is not None and "rerank_score" in hits[0]
+    dense_top1 = sum(term.lower() in dense_only.search(q, top_k=1)[0]["text"].lower()
+                     for q, term in questions.items())
+    assert dense_top1 < len(questions)
+    print(f"✅ 精确术语问题混合检索 top-1 全部命中（纯向量 {dense_top1}/{len(questions)}）")
+
+    batch = retriever.search_batch(list(questions), top_k=2)
+    assert [hits[0]["id"] for hits in batch] == [retriever.search(q, top_k=2)[0]["id"] for q in questions]
+    print("✅ 批量混合检索与逐条结果一致")
+    return True
+
+
+def test_context_builder():
+    """测试按 token 预算组装上下文"""
+    from rag import build_context, chunk_markdown, context_budget, count_tokens
+
+    assert context_budget("deepseek-r1:1.5b") == 1200
+    assert context_budget("deepseek-r1:8b-llama-distill-q4_K_M") == 1500
+    assert context_budget("unknown-model", default=999) == 999
+    print("✅ 按模型取上下文预算")
+
+    section = "#### Long answer\n\n" + " ".join(
+        f"Sentence number {i} explains one more detail about Milvus." for i in range(60)
+    )
+    chunks = list(chunk_markdown(section, max_tokens=80, overlap_tokens=24))
+    hits = [{"id": i, "text": chunk["text"], "score": 1.0 - i / 100} for i, chunk in enumerate(chunks)]
+    hits.append({"id": 99, "text": chunks[0]["text"], "score": 0.1})
+
+    result = build_context(list(reversed(hits)), max_tokens=10000)
+    assert result["ids"][0] == 0 and 99 not in result["ids"]
+    assert result["context"].count("Sentence number 5 ") == 1
+    assert result["context"].count("Long answer") == 1
+    assert result["tokens"] == count_tokens(result["context"])
+    print("✅ 按分数排序，重复 chunk 与重叠句子只保留一份")
+
+    result = build_context(hits, max_tokens=200)
+    assert result["tokens"] <= 200 and result["truncated"]
+    assert result["context"].rstrip().endswith(".")
+    assert result["skipped"] == len(hits) - result["used"]
+    print(f"✅ 超出预算时在句子边界截断（{result['tokens']}/200 tokens）")
+
+    legacy = build_context([("Milvus is a vector database.", 0.9), ("It supports HNSW.", 0.8)])
+    assert legacy["context"] == "Milvus is a vector database.\n\nIt supports HNSW."
+    assert build_context([])["tokens"] == 0
+    print("✅ 兼容 (text, distance) 形式的检索结果")
+
+    raw_l2 = [{"id": 1, "distance": 9.0, "entity": {"text": "Far away chunk about something else."}},
+              {"id": 2, "distance": 0.1, "entity": {"text": "Nearest chunk about HNSW."}}]
+    assert build_context(raw_l2, metric_type="L2")["ids"] == [2, 1]
+    assert build_context(raw_l2, max_tokens=8, metric_type="L2")["ids"] == [2]
+    assert build_context(raw_l2, metric_type="IP")["ids"] == [1, 2]
+    print("✅ L2 索引按距离从小到大放入上下文")
+    return True
+
+
+class RecordingLLM:
+    """记录收到的消息并返回固定答案的 LLM 后端"""
+
+    provider = "fake"
+    model_name = "deepseek-r1:1.5b"
+
+    def __init__(self):
+        self.calls = []
+
+    def chat(self, messages, **options):
+        self.calls.append(messages)
+        return "Milvus stores data in object storage."
+
+
+def test_rag_pipeline():
+    """测试 Ingestor / Retriever / Answerer 组合与命令行入口"""
+    import importlib.util
+    import io
+    import shutil
+    from contextlib import redirect_stdout
+    from rag import HashEmbeddingFunction, Ingestor, OllamaLLM, RAGPipeline, Retriever
+    from rag.cli import main as cli_main
+
+    embedding = HashEmbeddingFunction(dim=64)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ["performance_faq.md", "operational_faq.md"]:
+            shutil.copy(name, tmp)
+        client = FakeMilvusClient()
+        ingestor = Ingestor(client, "faq", embedding, manifest_path=os.path.join(tmp, "manifest.json"),
+                            cache=None)
+        retriever = Retriever(client, "faq", embedding)
+        llm = RecordingLLM()
+        pipeline = RAGPipeline(ingestor, retriever, llm=llm)
+        stats = pipeline.ingest(os.path.join(tmp, "*.md"))
+        assert stats["upserted"] > 0 and retriever.query_cache.generation == stats["generation"]
+        print(f"✅ Ingestor 建 collection 并同步 {stats['upserted']} 个 chunk")
+
+        hits = pipeline.retrieve("What is nprobe?")
+        assert len(hits) == 3 and "nprobe" in hits[0]["text"].lower()
+        dense = Retriever(client, "faq", embedding, hybrid=False).retrieve("What is nprobe?", top_k=2)
+        assert len(dense) == 2 and set(dense[0]) == {"id", "text", "score"}
+        print("✅ Retriever 混合检索与纯向量检索返回统一格式")
+
+        result = pipeline.query("What is nprobe?")
+        assert result["answer"] == "Milvus stores data in object storage." and not result["cached"]
+        assert 0 < result["context_tokens"] <= 1200  # 按 deepseek-r1:1.5b 的预算组装上下文
+        assert "<question>\nWhat is nprobe?\n</question>" in llm.calls[0][1]["content"]
+        assert pipeline.answerer is pipeline.answerer and pipeline.llm is llm
+        print("✅ Answerer 按模型预算组装上下文并调用 LLM，组件只创建一次")
+
+    class FakeOllamaClient:
+        model_name = "deepseek-r1:8b"
+
+        def __init__(self):
+            self.models = []
+
+        def chat_completion(self, messages, tools=None, options=None, model=None):
+            self.models.append(model)
+            return {"message": {"content": "<think>让我想想</think>\n答案"}}
+
+    shared = FakeOllamaClient()
+    assert OllamaLLM(client=shared).chat([]) == "答案"
+    assert OllamaLLM(client=shared).model_name == "deepseek-r1:8b"
+    OllamaLLM("deepseek-r1:14b", client=shared).chat([])
+    assert shared.models == [None, "deepseek-r1:14b"] and shared.model_name == "deepseek-r1:8b"
+    print("✅ Ollama 后端去掉 <think> 推理过程，指定的模型按请求传递，不修改共享客户端")
+
+    if importlib.util.find_spec("pymilvus") is None:
+        print("⚠️  未安装 pymilvus，跳过命令行测试")
+        return True
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy("product_faq.md", tmp)
+        common = ["--uri", os.path.join(tmp, "cli.db"), "--embedding", "hash",
+                  "--manifest", os.path.join(tmp, "manifest.json"),
+                  "--embedding-cache", os.path.join(tmp, "cache.sqlite3")]
+        output = io.StringIO()
+        with redirect_stdout(output):
+            assert cli_main(["ingest", os.path.join(tmp, "*.md")] + common) == 0
+            assert cli_main(["query", "Is Milvus free?", "--retrieve-only"] + common) == 0
+        assert "同步完成" in output.getvalue() and "1. [" in output.getvalue()
+        print("✅ python -m rag ingest / query 可用")
+    return True
+
+
+def test_local_rag_with_stub_ollama():
+    """测试完全本地的 RAG 链路：Ollama /api/embed 嵌入 + OllamaClient 生成（连接 Ollama 替身服务）"""
+    from rag import Answerer, Ingestor, OllamaEmbeddingFunction, OllamaLLM, Retriever
+    from rednote_ch6_assignment import OllamaBackendPool, OllamaClient
+    from stub_ollama_server import StubOllamaServer
+
+    with StubOllamaServer(dim=64) as stub:
+        client = OllamaClient(stub.base_url, max_retries=0)
+        embedding = OllamaEmbeddingFunction("nomic-embed-text", client=client, batch_size=16)
+        vectors = embedding.encode_documents([f"text {i}" for i in range(40)])
+        assert len(vectors) == 40 and embedding.dim == 64
+        assert stub.count("/api/embed") == 3
+        payload = stub.requests[-1]["payload"]
+        assert payload["input"][0].startswith("search_document: ") and payload["keep_alive"] == "30m"
+        assert embedding.encode_queries(["q"]) and stub.requests[-1]["payload"]["input"] == ["search_query: q"]
+        print("✅ /api/embed 按批请求，nomic-embed-text 自动加任务前缀")
+
+        try:
+            OllamaEmbeddingFunction("missing-model", client=client).encode_queries(["q"])
+            assert False, "未下载的模型应当报错"
+        except RuntimeError as e:
+            assert "HTTP 404" in str(e)
+        print("✅ 嵌入模型不存在时抛出 RuntimeError")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            milvus = FakeMilvusClient()
+            ingestor = Ingestor(milvus, "faq", embedding, manifest_path=os.path.join(tmp, "m.json"), cache=None)
+            stats = ingestor.ingest(["performance_faq.md"])
+            client.model_name = "deepseek-r1:1.5b"  # 共享客户端上第六章文案使用的模型
+            answerer = Answerer(Retriever(milvus, "faq", embedding), OllamaLLM("deepseek-r1:8b", client=client))
+            result = answerer.answer("How to set nlist and nprobe?")
+        chat = [r["payload"] for r in stub.requests if r["path"] == "/api/chat"]
+        assert stats["upserted"] > 0 and len(chat) == 1
+        assert chat[0]["model"] == "deepseek-r1:8b" and "How to set nlist and nprobe?" in chat[0]["messages"][1]["content"]
+        assert client.model_name == "deepseek-r1:1.5b", "RAG 指定的模型不应改动共享客户端"
+        assert "nprobe" in result["hits"][0]["text"] and "<think>" not in result["answer"]
+        assert set(result["timings"]) == {"embed", "retrieve", "generate", "total"}
+        print(f"✅ 本地链路入库、检索与生成全部经由 Ollama（{result['timings']['total'] * 1000:.1f} ms）")
+
+        pool = OllamaBackendPool(["http://127.0.0.1:9", stub.base_url], max_retries=0)
+        try:
+            response = pool.embed(["failover"], model="nomic-embed-text")
+            assert len(response["embeddings"]) == 1
+            assert not pool.backends[0].healthy
+        finally:
+            pool.close()
+        print("✅ 多节点池的嵌入请求在节点故障时自动转移")
+    return True
+
+
+def main():
+    """主测试函数"""
+    print("🧪 开始 RAG 流水线测试")
+    print("="*50)
+
+    tests = [
+        ("嵌入流水线测试", test_embedding_pipeline),
+        ("Markdown 切块测试", test_markdown_chunker),
+        ("增量索引同步测试", test_incremental_sync),
+        ("ANN 索引配置测试", test_index_config),
+        ("问题缓存测试", test_query_caches),
+        ("批量检索测试", test_retrieve_batch),
+        ("混合检索测试", test_hybrid_retrieval),
+        ("上下文预算测试", test_context_builder),
+        ("RAG 流水线组件测试", test_rag_pipeline),
+        ("本地 Ollama RAG 测试", test_local_rag_with_stub_ollama),
+    ]
+
+    passed = 0
+    total = len(tests)
+
+    for test_name, test_func in tests:
+        print(f"\n🔍 {test_name}")
+        print("-" * 30)
+        try:
+            if test_func():
+                passed += 1
+                print(f"✅ {test_name} 通过")
+            else:
+                print(f"❌ {test_name} 失败")
+        except Exception as e:
+            print(f"❌ {test_name} 异常: {e}")
+
+    print("\n" + "="*50)
+    print(f"📊 测试结果: {passed}/{total} 通过")
+
+    if passed == total:
+        print("🎉 所有测试通过！RAG 流水线功能正常")
+        return True
+    else:
+        print("⚠️  部分测试失败，请检查相关功能")
+        return False
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)